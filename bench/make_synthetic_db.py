@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# make_synthetic_db.py -- Generates a database directory that looks like one built by make_groseq_database.py
+#
+# Everything is made up, so no network access is needed. The mix of species, entry types, protocols,
+# fetched matrices and SRA lists roughly follows that of a real GEO database, and the same seed always
+# produces the same database. A manifest of sample IDs and accessions for the benchmarks to query is
+# written to dbdir/.bench.json, which the tools ignore like every other dot file.
+
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from geo_store import DirStore
+
+
+MANIFEST_NAME=".bench.json"
+
+# (protocol, share of all IDs):
+PROTOCOLS=[("gro-seq", 0.15), ("pro-seq", 0.1), ("chip-seq", 0.4), ("rna-seq", 0.35)]
+
+# (taxon field, weight). Some series name more than one species:
+TAXA=[("Homo sapiens", 45), ("Mus musculus", 30), ("Drosophila melanogaster", 6), ("Saccharomyces cerevisiae", 4),
+      ("Caenorhabditis elegans", 3), ("Danio rerio", 3), ("Arabidopsis thaliana", 3), ("Rattus norvegicus", 2),
+      ("Escherichia coli", 1), ("Homo sapiens; Mus musculus", 2), ("Sus scrofa", 1)]
+
+# (entry type, weight, first ID). GEO numbers series, samples and datasets in different ranges:
+TYPES=[("GSE", 35, 200000000), ("GSM", 60, 300000000), ("GDS", 5, 1000)]
+
+SURNAMES=["Smith", "Wang", "Li", "Zhang", "Garcia", "Kim", "Muller", "Rossi", "Tanaka", "Lis", "Kraus", "Danko",
+          "Core", "Adelman", "Shilatifard", "Fuda", "Yu", "Chen", "Johnson", "Nguyen"]
+
+WORDS=["transcription", "polymerase", "enhancer", "RNA", "promoter", "pausing", "heat", "shock", "chromatin",
+       "nascent", "elongation", "factor", "binding", "genome-wide", "profiling", "cells", "response", "histone",
+       "methylation", "knockdown", "expression", "regulation", "sequencing", "run-on", "initiation", "termination",
+       "stem", "differentiation", "inflammation", "estrogen", "receptor", "signaling", "time", "course", "treated"]
+
+# Share of series with fetched matrices, and of those, the shares with a cached name and with an SRA list:
+MATRIX_SHARE=0.05
+NAMECACHE_SHARE=0.5
+SRALIST_SHARE=0.6
+
+MINIML_HEADER='<?xml version="1.0" encoding="UTF-8"?>\n<MINiML xmlns="http://www.ncbi.nlm.nih.gov/geo/info/MINiML" version="0.5.0">\n'
+
+
+def pickWeighted(rng, choices):
+    total=sum([c[1] for c in choices])
+    r=rng.uniform(0, total)
+    for c in choices:
+        r-=c[1]
+        if r<=0:
+            return c
+    return choices[-1]
+
+
+def makeText(rng, minWords, maxWords):
+    return " ".join([rng.choice(WORDS) for i in range(rng.randint(minWords, maxWords))])
+
+
+def makeMiniml(rng, seriesAcc, surname, year, numSamples):
+    """Returns the contents of a MINiML series matrix file and the SRA experiments of its samples."""
+    parts=[MINIML_HEADER]
+    for c in range(rng.randint(1, 4)):
+        last=surname if c==0 else rng.choice(SURNAMES)
+        parts.append('<Contributor iid="contrib%d"><Person><First>A</First><Last>%s</Last></Person></Contributor>\n' % (c+1, last))
+
+    experiments=[]
+    for s in range(numSamples):
+        srx="SRX%07d" % rng.randint(0, 9999999)
+        experiments.append(srx)
+        parts.append('<Sample iid="GSM%d"><Status><Release-Date>%d-03-01</Release-Date></Status><Title>%s</Title>'
+                     '<Type>SRA</Type><Library-Strategy>%s</Library-Strategy>'
+                     '<Relation type="SRA" target="https://www.ncbi.nlm.nih.gov/sra?term=%s" />'
+                     '<Supplementary-Data type="SRA Experiment">ftp://ftp-trace.ncbi.nlm.nih.gov/sra/sra-instant/reads/ByExp/sra/SRX/%s/%s</Supplementary-Data>'
+                     '</Sample>\n' % (rng.randint(1, 9999999), year, makeText(rng, 2, 6), rng.choice(["OTHER", "RNA-Seq", "ChIP-Seq"]),
+                                      srx, srx[:6], srx))
+
+    parts.append('<Series iid="%s"><Status><Submission-Date>%d-01-01</Submission-Date><Release-Date>%d-03-01</Release-Date>'
+                 '</Status><Title>%s</Title></Series>\n</MINiML>\n' % (seriesAcc, year, year, makeText(rng, 4, 12)))
+    return ("".join(parts), experiments)
+
+
+def makeEntry(rng, idNum, entryType):
+    acc="%s%d" % (entryType, idNum%1000000)
+    return {"title": makeText(rng, 4, 16).capitalize(),
+            "posted": "%d/%02d/%02d" % (rng.randint(2005, 2024), rng.randint(1, 12), rng.randint(1, 28)),
+            "accession": acc,
+            "taxon": pickWeighted(rng, TAXA)[0],
+            "entryType": entryType,
+            "matrixUrl": "ftp://ftp.ncbi.nlm.nih.gov/geo/series/%snnn/%s/" % (acc[:-3], acc) if entryType=="GSE" else None,
+            "summary": makeText(rng, 40, 250),
+            "datalist": [("GSM%d" % rng.randint(1, 9999999), makeText(rng, 1, 3).replace(" ", "_")) for i in range(rng.randint(0, 6))],
+            "relations": [("SRA", "https://www.ncbi.nlm.nih.gov/sra?term=SRP%06d" % rng.randint(0, 999999))]}
+
+
+def makeDatabase(numIds, dbDir, seed=1, log=None):
+    """Writes numIds elements spread across PROTOCOLS into dbDir. Returns the manifest."""
+    rng=random.Random(seed)
+    store=DirStore(dbDir)
+    if not os.path.exists(dbDir):
+        os.makedirs(dbDir)
+
+    # Draw every element first, so that some IDs can be shared between protocols as in real searches:
+    nextId=dict([(t[0], t[2]) for t in TYPES])
+    drawn=[]
+    for i in range(numIds):
+        entryType=pickWeighted(rng, TYPES)[0]
+        drawn.append((nextId[entryType], entryType))
+        nextId[entryType]+=rng.randint(1, 3)
+
+    manifest={"numIds": numIds, "seed": seed, "ids": [], "accessions": [], "protocols": {}}
+    entries={}
+    start=0
+    for p, share in PROTOCOLS:
+        count=int(round(numIds*share)) if p!=PROTOCOLS[-1][0] else numIds-start
+        elements=drawn[start:start+count]
+        start+=count
+
+        # About a tenth of each protocol also turns up in the next one's results:
+        if len(manifest["protocols"])>0:
+            elements+=rng.sample(lastElements, min(len(lastElements), count//10))
+        lastElements=drawn[start-count:start]
+
+        ids=sorted(set(elements))
+        store.prepareEntries(p, [str(i) for i, t in ids])
+        manifest["protocols"][p]=len(ids)
+
+        for idNum, entryType in ids:
+            # An element shared by two protocols has the same summary in both:
+            if idNum not in entries:
+                entries[idNum]=makeEntry(rng, idNum, entryType)
+            entry=entries[idNum]
+            store.putEntry(p, str(idNum), entry)
+            path=store.entryPath(p, str(idNum))
+
+            if rng.random()<0.01:
+                manifest["ids"].append(str(idNum))
+            if rng.random()<0.02:
+                manifest["accessions"].append(entry["accession"])
+
+            if entryType!="GSE" or rng.random()>=MATRIX_SHARE:
+                continue
+
+            surname=rng.choice(SURNAMES)
+            year=rng.randint(2005, 2024)
+            os.makedirs(os.path.join(path, "matrices"))
+            contents, experiments=makeMiniml(rng, entry["accession"], surname, year, rng.randint(2, 24))
+            with open(os.path.join(path, "matrices", "%s_family.xml" % entry["accession"]), "w") as f:
+                f.write(contents)
+
+            if rng.random()<NAMECACHE_SHARE:
+                store.setContribName(path, "%s%d" % (surname, year))
+            if rng.random()<SRALIST_SHARE:
+                with open(os.path.join(path, "%d.sralist" % idNum), "w") as f:
+                    for srx in experiments:
+                        srr="SRR%07d" % rng.randint(0, 9999999)
+                        f.write("ftp://ftp-trace.ncbi.nlm.nih.gov/sra/sra-instant/reads/ByRun/sra/SRR/%s/%s/%s.sra\n" % (srr[:6], srr, srr))
+
+        store.commit()
+        if log is not None:
+            log("Wrote %d elements for %s\n" % (len(ids), p))
+
+    store.close()
+    with open(os.path.join(dbDir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def main(args):
+    seed=1
+    newArgs=[]
+    for a in args:
+        if a.startswith("-seed="):
+            seed=int(a.split('=')[1])
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if len(args)!=3 or not args[1].isdigit():
+        print("Usage: %s [-seed=<n>] numids dbdir" % args[0])
+        print("Generates a synthetic database of numids elements in dbdir for benchmarking the query tools.")
+        return
+
+    if os.path.exists(args[2]) and len(os.listdir(args[2]))>0:
+        print("%s already exists and isn't empty." % args[2])
+        return
+
+    makeDatabase(int(args[1]), args[2], seed, sys.stdout.write)
+
+
+if __name__=="__main__":
+    main(sys.argv)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# measure.py -- Runs one of the tools in this process and records what the run cost.
+#
+# The tool's output is thrown away. Wall and CPU time, the read and write system calls and bytes counted
+# by /proc/self/io, and the peak resident set size are written as JSON to the given file.
+
+import os
+import sys
+import json
+import time
+import runpy
+import resource
+
+
+def readProcIo():
+    """Returns the counters in /proc/self/io, or an empty dictionary where it isn't available."""
+    counters={}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for l in f.read().splitlines():
+                ltoks=l.split(':')
+                if len(ltoks)==2:
+                    counters[ltoks[0].strip()]=int(ltoks[1])
+    except IOError:
+        pass
+    return counters
+
+
+def main(args):
+    if len(args)<3:
+        print("Usage: %s outfile script [args]" % args[0])
+        print("Runs a python script as if it were the main program and writes what the run cost to outfile.")
+        return
+
+    outPath=args[1]
+    script=os.path.abspath(args[2])
+    sys.argv=args[2:]
+    sys.path.insert(0, os.path.dirname(script))
+
+    # Send the tool's output to /dev/null at the file descriptor level, so that writes still cost what they normally do:
+    devNull=os.open(os.devnull, os.O_WRONLY)
+    savedStdout=os.dup(1)
+    os.dup2(devNull, 1)
+
+    before=readProcIo()
+    startUsage=resource.getrusage(resource.RUSAGE_SELF)
+    startTime=time.time()
+    error=None
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            error="exit status %s" % e.code
+    except Exception as e:
+        error="%s: %s" % (type(e).__name__, e)
+    wall=time.time()-startTime
+
+    sys.stdout.flush()
+    os.dup2(savedStdout, 1)
+    after=readProcIo()
+    usage=resource.getrusage(resource.RUSAGE_SELF)
+
+    result={"wall": wall,
+            "userTime": usage.ru_utime-startUsage.ru_utime,
+            "sysTime": usage.ru_stime-startUsage.ru_stime,
+            # ru_maxrss is in kilobytes on Linux:
+            "maxRssKb": usage.ru_maxrss,
+            "error": error}
+    for counter, name in [("syscr", "readSyscalls"), ("syscw", "writeSyscalls"), ("rchar", "bytesRead"),
+                          ("wchar", "bytesWritten"), ("read_bytes", "diskBytesRead")]:
+        if counter in after:
+            result[name]=after[counter]-before.get(counter, 0)
+
+    with open(outPath, "w") as f:
+        json.dump(result, f)
+
+
+if __name__=="__main__":
+    main(sys.argv)
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# mock_ncbi.py -- A local stand-in for the parts of NCBI that the tools talk to.
+#
+# The server answers esearch, esummary and epost requests for a made up GEO database (gds) and for SRA,
+# and serves the matching MINiML archives and SRA run files as an HTTP file tree. The tools are pointed
+# at it with EUTILS_BASE and GEO_MIRROR, as printed when it starts. FTP URLs are served over HTTP.
+#
+# Responses can be delayed and their bodies throttled. E-utility requests are rate limited per client
+# the same way NCBI limits them, and a share of responses can be replaced by errors. This makes it
+# possible to exercise and measure concurrency and retry behaviour without network access.
+#
+# Records are generated from the seed and their ID with the same functions that make_synthetic_db.py
+# uses, so the server gives the same answers every time it's run.
+
+import re
+import sys
+import json
+import time
+import random
+import socket
+import tarfile
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+from make_synthetic_db import PROTOCOLS, TYPES, SURNAMES, pickWeighted, makeEntry, makeMiniml
+
+
+EUTILS_PATH="/entrez/eutils/"
+FILES_PATH="/files/"
+
+MATRIX_HOST="ftp.ncbi.nlm.nih.gov"
+SRA_HOST="ftp-trace.ncbi.nlm.nih.gov"
+
+# Requests per second allowed for each client, without and with an API key, as at NCBI:
+CLIENT_RATE=3
+API_KEY_RATE=10
+
+# Ways a response can fail: an HTTP error status, a connection closed without a response, or a body cut short.
+ERROR_KINDS=["status", "reset", "truncate"]
+
+# Modification date of records that haven't changed, and the share of records that changed today:
+OLD_MDAT="2015/01/01"
+CHANGED_SHARE=0.05
+
+# Average size of an SRA run file:
+SRA_SIZE=1048576
+
+CHUNK_SIZE=64*1024
+
+
+class RemoteCatalog(object):
+    """The made up contents of GEO and SRA. Only the IDs are drawn up front; everything else is
+    generated when it's requested."""
+
+    def __init__(self, numIds, seed=1, changedShare=CHANGED_SHARE, sraSize=SRA_SIZE):
+        rng=random.Random(seed)
+        self.seed=seed
+        self.sraSize=sraSize
+
+        nextId=dict([(t[0], t[2]) for t in TYPES])
+        drawn=[]
+        for i in range(numIds):
+            entryType=pickWeighted(rng, TYPES)[0]
+            drawn.append((nextId[entryType], entryType))
+            nextId[entryType]+=rng.randint(1, 3)
+
+        # ID -> entry type, protocol -> sorted IDs, series accession -> ID:
+        self.types=dict(drawn)
+        self.byProtocol={}
+        self.series={}
+
+        start=0
+        lastElements=[]
+        for p, share in PROTOCOLS:
+            count=int(round(numIds*share)) if p!=PROTOCOLS[-1][0] else numIds-start
+            elements=drawn[start:start+count]
+            start+=count
+            # As in make_synthetic_db.py, about a tenth of each protocol turns up in the next one's results:
+            elements+=rng.sample(lastElements, min(len(lastElements), count//10))
+            lastElements=drawn[start-count:start]
+            self.byProtocol[p]=sorted(set([i for i, t in elements]))
+
+        for idNum, entryType in drawn:
+            if entryType=="GSE":
+                self.series["GSE%d" % (idNum%1000000)]=idNum
+
+        self.changed=set([i for i, t in drawn if rng.random()<changedShare])
+        self.today=time.strftime("%Y/%m/%d")
+
+        # A block of noise that SRA files are cut from:
+        self.noise="".join([chr(rng.randint(0, 255)) for i in range(CHUNK_SIZE)])
+        self.archives={}
+        self.lock=threading.Lock()
+
+    def getModDate(self, idNum):
+        return self.today if idNum in self.changed else OLD_MDAT
+
+    def search(self, term, minDate=None, maxDate=None):
+        """Returns the IDs matching a gds search term, which is taken to be a protocol name."""
+        ids=self.byProtocol.get(term.strip().lower(), [])
+        if minDate is not None or maxDate is not None:
+            ids=[i for i in ids if (minDate or "")<=self.getModDate(i)<=(maxDate or "9999")]
+        return ids
+
+    def getEntry(self, idNum):
+        return makeEntry(random.Random("%d:%d" % (self.seed, idNum)), idNum, self.types[idNum])
+
+    def getArchive(self, accession):
+        """Returns the MINiML archive of a series, as a tar.gz file in a string."""
+        with self.lock:
+            if accession in self.archives:
+                return self.archives[accession]
+
+        rng=random.Random("%d:%s" % (self.seed, accession))
+        contents=makeMiniml(rng, accession, rng.choice(SURNAMES), rng.randint(2005, 2024), rng.randint(2, 24))[0]
+
+        out=StringIO()
+        archive=tarfile.open(fileobj=out, mode="w:gz")
+        info=tarfile.TarInfo("%s_family.xml" % accession)
+        info.size=len(contents)
+        info.mtime=0
+        archive.addfile(info, StringIO(contents))
+        archive.close()
+
+        with self.lock:
+            self.archives[accession]=out.getvalue()
+        return self.archives[accession]
+
+    def getRuns(self, srx):
+        """Returns the run accessions of an SRA experiment. Every experiment exists and has one to three runs."""
+        rng=random.Random(srx)
+        return ["SRR%07d" % rng.randint(0, 9999999) for i in range(rng.randint(1, 3))]
+
+    def getSraSize(self, srr):
+        return int(self.sraSize*random.Random(srr).uniform(0.5, 1.5))
+
+    def iterSraData(self, srr, start, end):
+        """Yields the bytes of a run file from start up to end."""
+        shift=random.Random(srr).randint(0, CHUNK_SIZE-1)
+        pos=start
+        while pos<end:
+            offset=(pos+shift)%CHUNK_SIZE
+            chunk=self.noise[offset:offset+min(CHUNK_SIZE-offset, end-pos)]
+            pos+=len(chunk)
+            yield chunk
+
+
+class RateLimit(object):
+    """Allows rate requests per second, in bursts of up to a second's worth."""
+
+    def __init__(self, rate):
+        self.rate=float(rate)
+        self.tokens=self.rate
+        self.last=time.time()
+        self.lock=threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now=time.time()
+            self.tokens=min(self.rate, self.tokens+(now-self.last)*self.rate)
+            self.last=now
+            if self.tokens<1:
+                return False
+            self.tokens-=1
+            return True
+
+
+class Stats(object):
+    """Counts what the server was asked for and what it did about it."""
+
+    fields=["requests", "throttled", "status", "reset", "truncate", "bytesSent"]
+
+    def __init__(self):
+        self.byKind={}
+        self.lock=threading.Lock()
+
+    def add(self, kind, **counts):
+        with self.lock:
+            cur=self.byKind.setdefault(kind, dict([(f, 0) for f in self.fields]))
+            for k, v in counts.items():
+                cur[k]+=v
+
+    def snapshot(self):
+        """Returns a copy of the counters by kind of request (an E-utility name or "files"), along with their totals."""
+        with self.lock:
+            result=dict([(k, dict(v)) for k, v in self.byKind.items()])
+        result["total"]=dict([(f, sum([v[f] for v in result.values()])) for f in self.fields])
+        return result
+
+
+def diffStats(before, after):
+    """Returns the counters of a snapshot minus those of an earlier one."""
+    result={}
+    for kind, counts in after.items():
+        old=before.get(kind, {})
+        result[kind]=dict([(f, v-old.get(f, 0)) for f, v in counts.items()])
+    return result
+
+
+def getParam(params, name, default=None):
+    return params[name][0] if name in params else default
+
+
+def formatItem(name, value, itemType="String"):
+    return '<Item Name="%s" Type="%s">%s</Item>' % (name, itemType, escape(value or ""))
+
+
+def formatGdsDocSum(idNum, entry):
+    """Returns an esummary <DocSum> for a gds record, laid out like NCBI's."""
+    parts=["<DocSum><Id>%d</Id>" % idNum,
+           formatItem("Accession", entry["accession"]),
+           formatItem("title", entry["title"]),
+           formatItem("summary", entry["summary"]),
+           formatItem("taxon", entry["taxon"]),
+           formatItem("entryType", entry["entryType"]),
+           formatItem("PDAT", entry["posted"]),
+           '<Item Name="Samples" Type="List">']
+    for accession, title in entry["datalist"]:
+        parts.append('<Item Name="Sample" Type="Structure">%s%s</Item>' % (formatItem("Accession", accession), formatItem("Title", title)))
+    parts.append('</Item><Item Name="ExtRelations" Type="List">')
+    for relationType, url in entry["relations"]:
+        parts.append('<Item Name="ExtRelation" Type="Structure">%s%s%s</Item>' %
+                     (formatItem("RelationType", relationType), formatItem("TargetObject", url.split('=')[-1]),
+                      formatItem("TargetFTPLink", url)))
+    parts.append('</Item>%s<Item Name="n_samples" Type="Integer">%d</Item></DocSum>' %
+                 (formatItem("FTPLink", entry["matrixUrl"]), len(entry["datalist"])))
+    return "".join(parts)
+
+
+def formatSraDocSum(srx, runs):
+    """Returns an esummary <DocSum> for an SRA experiment. As at NCBI, the interesting parts are escaped XML."""
+    expXml='<Summary><Title>%s</Title></Summary><Experiment acc="%s" ver="1" status="public" name=""/>' % (srx, srx)
+    runXml="".join(['<Run acc="%s" total_spots="1000000" total_bases="50000000" load_done="true" is_public="true"/>' % r for r in runs])
+    return "<DocSum><Id>%s</Id>%s%s</DocSum>" % (srx[3:], formatItem("ExpXml", expXml), formatItem("Runs", runXml))
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open between requests, as NCBI does:
+    protocol_version="HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.respond(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        body=self.rfile.read(int(self.headers.getheader("Content-Length", "0")))
+        params=urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        params.update(urlparse.parse_qs(body))
+        self.respond(params)
+
+    def respond(self, params):
+        server=self.server
+        path=urlparse.urlparse(self.path).path
+
+        if path=="/stats":
+            self.sendResponse(200, "application/json", json.dumps(server.stats.snapshot()))
+            return
+
+        if path.startswith(EUTILS_PATH) and path.endswith(".fcgi"):
+            kind=path[len(EUTILS_PATH):-len(".fcgi")]
+        elif path.startswith(FILES_PATH):
+            kind="files"
+        else:
+            self.sendResponse(404, "text/plain", "Not found\n")
+            return
+
+        server.stats.add(kind, requests=1)
+        if server.latency>0 or server.jitter>0:
+            time.sleep(server.latency+random.uniform(0, server.jitter))
+
+        if kind!="files" and not server.allowRequest(self.client_address[0], getParam(params, "api_key")):
+            server.stats.add(kind, throttled=1)
+            self.sendResponse(429, "application/json", '{"error":"API rate limit exceeded"}', kind)
+            return
+
+        error=server.pickError()
+        if error=="status":
+            server.stats.add(kind, status=1)
+            self.sendResponse(random.choice([500, 502, 503]), "text/plain", "Service unavailable\n", kind)
+            return
+        if error=="reset":
+            server.stats.add(kind, reset=1)
+            self.close_connection=1
+            return
+
+        try:
+            if kind=="files":
+                response=self.getFile(path[len(FILES_PATH):])
+            else:
+                response=self.getUtilResponse(kind, params)
+        except (KeyError, ValueError) as e:
+            response=(400, "text/plain", "Bad request: %s\n" % e, {})
+
+        status, contentType, body, headers=response
+        if error=="truncate":
+            server.stats.add(kind, truncate=1)
+        self.sendResponse(status, contentType, body, kind, headers, error=="truncate")
+
+    def sendResponse(self, status, contentType, body, kind=None, headers={}, truncate=False):
+        """Sends a response, throttling the body to the server's bandwidth. The body is a string or
+        (length, iterator of strings). A truncated response stops halfway and closes the connection."""
+        if isinstance(body, str):
+            length=len(body)
+            chunks=[body]
+        else:
+            length, chunks=body
+
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(length))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+        limit=length//2 if truncate else length
+        sent=0
+        startTime=time.time()
+        try:
+            for chunk in chunks:
+                chunk=chunk[:limit-sent]
+                self.wfile.write(chunk)
+                sent+=len(chunk)
+                if self.server.bandwidth:
+                    delay=sent/float(self.server.bandwidth)-(time.time()-startTime)
+                    if delay>0:
+                        time.sleep(delay)
+                if sent>=limit:
+                    break
+        finally:
+            if kind is not None:
+                self.server.stats.add(kind, bytesSent=sent)
+
+        if truncate:
+            self.wfile.flush()
+            self.close_connection=1
+
+    def getUtilResponse(self, util, params):
+        server=self.server
+        catalog=server.catalog
+        db=getParam(params, "db", "gds")
+        retStart=int(getParam(params, "retstart", "0"))
+        retMax=int(getParam(params, "retmax", "20" if util=="esearch" else "10000"))
+
+        if db not in ["gds", "sra"]:
+            return (200, "text/xml", "<eResult><ERROR>Invalid db name specified: %s</ERROR></eResult>" % escape(db), {})
+
+        if util=="esearch":
+            term=getParam(params, "term", "")
+            if db=="gds":
+                if getParam(params, "datetype")=="mdat":
+                    ids=catalog.search(term, getParam(params, "mindate"), getParam(params, "maxdate"))
+                else:
+                    ids=catalog.search(term)
+                ids=[str(i) for i in ids]
+            else:
+                ids=[]
+                for srx in re.findall(r'([SED]RX\d+)\[Accession\]', term):
+                    if srx not in ids:
+                        ids.append(srx)
+
+            parts=["<eSearchResult><Count>%d</Count><RetMax>%d</RetMax><RetStart>%d</RetStart>" %
+                   (len(ids), len(ids[retStart:retStart+retMax]), retStart)]
+            if getParam(params, "usehistory")=="y":
+                parts.append("<QueryKey>%d</QueryKey><WebEnv>%s</WebEnv>" % server.postIds(ids)[::-1])
+            parts.append("<IdList>%s</IdList></eSearchResult>" % "".join(["<Id>%s</Id>" % i for i in ids[retStart:retStart+retMax]]))
+            return (200, "text/xml", "".join(parts), {})
+
+        if util=="epost":
+            ids=[i.strip() for i in getParam(params, "id", "").split(',') if len(i.strip())>0]
+            webEnv, queryKey=server.postIds(ids, getParam(params, "WebEnv"))
+            return (200, "text/xml", "<ePostResult><QueryKey>%d</QueryKey><WebEnv>%s</WebEnv></ePostResult>" % (queryKey, webEnv), {})
+
+        if util=="esummary":
+            if "WebEnv" in params:
+                ids=server.getPosted(getParam(params, "WebEnv"), int(getParam(params, "query_key", "1")))
+                if ids is None:
+                    return (200, "text/xml", "<eSummaryResult><ERROR>Invalid query_key</ERROR></eSummaryResult>", {})
+            else:
+                ids=[i.strip() for i in getParam(params, "id", "").split(',') if len(i.strip())>0]
+
+            parts=["<eSummaryResult>"]
+            for i in ids[retStart:retStart+retMax]:
+                if db=="sra":
+                    parts.append(formatSraDocSum(i, catalog.getRuns(i)))
+                elif i.isdigit() and int(i) in catalog.types:
+                    parts.append(formatGdsDocSum(int(i), catalog.getEntry(int(i))))
+            parts.append("</eSummaryResult>")
+            return (200, "text/xml", "".join(parts), {})
+
+        return (404, "text/plain", "Unknown utility %s\n" % util, {})
+
+    def getFile(self, path):
+        catalog=self.server.catalog
+        host, path=path.split('/', 1)
+        notFound=(404, "text/html", "<html><body>Not found</body></html>\n", {})
+
+        if host==MATRIX_HOST:
+            m=re.match(r'geo/series/[^/]+/(GSE\d+)/miniml/(.*)$', path)
+            if m is None or m.group(1) not in catalog.series:
+                return notFound
+            accession, name=m.groups()
+            archiveName="%s_family.xml.tgz" % accession
+            if name=="":
+                listing='<html><body><a href="/geo/series/">Parent Directory</a>\n<a href="%s">%s</a>\n</body></html>\n' % (archiveName, archiveName)
+                return (200, "text/html", listing, {})
+            if name!=archiveName:
+                return notFound
+            return (200, "application/x-gzip", catalog.getArchive(accession), {})
+
+        if host==SRA_HOST:
+            m=re.match(r'sra/sra-instant/reads/ByRun/sra/SRR/\w+/(SRR\d+)/(SRR\d+)\.sra$', path)
+            if m is None or m.group(1)!=m.group(2):
+                return notFound
+            srr=m.group(1)
+            size=catalog.getSraSize(srr)
+
+            start=0
+            status=200
+            headers={"Accept-Ranges": "bytes"}
+            rangeHeader=self.headers.getheader("Range")
+            if rangeHeader is not None and re.match(r'bytes=\d+-$', rangeHeader):
+                start=int(rangeHeader[6:-1])
+                if start>=size:
+                    return (416, "text/plain", "", {"Content-Range": "bytes */%d" % size})
+                status=206
+                headers["Content-Range"]="bytes %d-%d/%d" % (start, size-1, size)
+            return (status, "application/octet-stream", (size-start, catalog.iterSraData(srr, start, size)), headers)
+
+        return notFound
+
+
+class MockNcbi(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The mock server. It listens on localhost, on a free port unless one is given."""
+
+    daemon_threads=True
+    allow_reuse_address=True
+
+    def __init__(self, catalog, port=0, verbose=False, **settings):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), MockHandler)
+        self.catalog=catalog
+        self.verbose=verbose
+        self.stats=Stats()
+        self.limits={}
+        self.history={}
+        self.lock=threading.Lock()
+        self.thread=None
+        self.configure(**settings)
+
+    def configure(self, latency=0.0, jitter=0.0, rateLimit=True, errorRate=0.0, errorKinds=ERROR_KINDS, bandwidth=None):
+        """Sets how the server behaves. latency is added to every request, plus up to jitter more. errorRate
+        is the share of requests answered by one of errorKinds. bandwidth caps each response, in bytes per second."""
+        self.latency=latency
+        self.jitter=jitter
+        self.rateLimit=rateLimit
+        self.errorRate=errorRate
+        self.errorKinds=errorKinds
+        self.bandwidth=bandwidth
+
+    def allowRequest(self, client, apiKey):
+        if not self.rateLimit:
+            return True
+        key=(client, apiKey)
+        with self.lock:
+            if key not in self.limits:
+                self.limits[key]=RateLimit(API_KEY_RATE if apiKey else CLIENT_RATE)
+            limit=self.limits[key]
+        return limit.allow()
+
+    def pickError(self):
+        if self.errorRate>0 and random.random()<self.errorRate:
+            return random.choice(self.errorKinds)
+        return None
+
+    def postIds(self, ids, webEnv=None):
+        """Keeps a list of IDs on the "History server". Returns (WebEnv, query key)."""
+        with self.lock:
+            if webEnv not in self.history:
+                webEnv="MCID_%d" % (len(self.history)+1)
+                self.history[webEnv]=[]
+            self.history[webEnv].append(ids)
+            return (webEnv, len(self.history[webEnv]))
+
+    def getPosted(self, webEnv, queryKey):
+        with self.lock:
+            lists=self.history.get(webEnv, [])
+            if queryKey<1 or queryKey>len(lists):
+                return None
+            return lists[queryKey-1]
+
+    def handle_error(self, request, clientAddress):
+        # Clients hanging up mid-response are expected, especially when errors are being injected:
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+    def getEutilsBase(self):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], EUTILS_PATH)
+
+    def getMirror(self):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], FILES_PATH.rstrip('/'))
+
+    def start(self):
+        """Serves requests on a background thread."""
+        self.thread=threading.Thread(target=self.serve_forever)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(args):
+    port=0
+    seed=1
+    sraSize=SRA_SIZE
+    verbose=False
+    settings={}
+
+    newArgs=[]
+    for a in args:
+        aToks=a.split('=', 1)
+        if aToks[0]=="-port":
+            port=int(aToks[1])
+        elif aToks[0]=="-seed":
+            seed=int(aToks[1])
+        elif aToks[0]=="-latency":
+            settings["latency"]=float(aToks[1])
+        elif aToks[0]=="-jitter":
+            settings["jitter"]=float(aToks[1])
+        elif aToks[0]=="-bw":
+            settings["bandwidth"]=int(aToks[1])
+        elif aToks[0]=="-errors":
+            settings["errorRate"]=float(aToks[1])
+        elif aToks[0]=="-errorkinds":
+            settings["errorKinds"]=aToks[1].split(',')
+        elif aToks[0]=="-sra":
+            sraSize=int(aToks[1])
+        elif a=="--norate":
+            settings["rateLimit"]=False
+        elif a=="-v":
+            verbose=True
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if len(args)!=2 or not args[1].isdigit() or len([k for k in settings.get("errorKinds", []) if k not in ERROR_KINDS])>0:
+        print("Usage: %s [-port=<n>] [-seed=<n>] [-latency=<s>] [-jitter=<s>] [-bw=<bytes/s>] [-errors=<share>]" % args[0])
+        print("       [-errorkinds=<kinds>] [-sra=<bytes>] [--norate] [-v] numids")
+        print("Serves a made up GEO database of numids elements, and its matrices and SRA files, in place of NCBI.")
+        print("-latency and -jitter delay every response by latency plus up to jitter seconds.")
+        print("-bw caps the rate at which each response is sent.")
+        print("-errors=<share> answers that share of requests with an error, picked from -errorkinds")
+        print("       (a comma separated list of %s; all of them by default)." % ", ".join(ERROR_KINDS))
+        print("-sra sets the average size of an SRA run file (default %d bytes)." % SRA_SIZE)
+        print("--norate turns off the limit of %d requests per second (%d with an API key) for each client." % (CLIENT_RATE, API_KEY_RATE))
+        print("-v logs every request.")
+        return
+
+    server=MockNcbi(RemoteCatalog(int(args[1]), seed, sraSize=sraSize), port, verbose, **settings)
+    print("Serving %s elements. To use this server, set:" % args[1])
+    print("export EUTILS_BASE=%s" % server.getEutilsBase())
+    print("export GEO_MIRROR=%s" % server.getMirror())
+    print("Request counts are available at http://127.0.0.1:%d/stats" % server.server_address[1])
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__=="__main__":
+    main(sys.argv)
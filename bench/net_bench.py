@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# net_bench.py -- Measures end-to-end search, ingest and fetch throughput against mock_ncbi.py.
+#
+# A mock server holding a made up GEO database is started in this process. The tools are run against
+# it in their own processes, the same way a user runs them:
+#   - query_geo.py searches for every protocol
+#   - make_groseq_database.py ingests the results, and later picks up changed elements with --update
+#   - query_groseq_database.py fetches matrices, resolves SRA runs and downloads run files for a sample
+#     of the series
+# This is repeated under several network profiles, from a fast and reliable network to a slow or flaky
+# one. For every step, the report records its time and throughput, the requests the server saw
+# (throttled and failed ones included) and whether it produced everything it should have.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+
+from mock_ncbi import MockNcbi, RemoteCatalog, diffStats, SRA_SIZE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from geo_store import openStore
+
+
+BENCH_DIR=os.path.dirname(os.path.abspath(__file__))
+REPO_DIR=os.path.abspath(os.path.join(BENCH_DIR, ".."))
+QUERY_GEO=os.path.join(REPO_DIR, "query_geo.py")
+MAKE_DB=os.path.join(REPO_DIR, "make_groseq_database.py")
+QUERY_TOOL=os.path.join(REPO_DIR, "query_groseq_database.py")
+MEASURE=os.path.join(BENCH_DIR, "measure.py")
+
+# Settings for MockNcbi.configure:
+PROFILES={"local": {},
+          "wan": {"latency": 0.1, "jitter": 0.05, "bandwidth": 2*1048576},
+          "flaky": {"latency": 0.02, "jitter": 0.02, "errorRate": 0.05}}
+DEFAULT_PROFILES=["local", "wan", "flaky"]
+
+DEFAULT_IDS=2000
+DEFAULT_MATRICES=40
+DEFAULT_SRALISTS=10
+DEFAULT_DOWNLOADS=4
+DEFAULT_WORKERS=4
+
+
+def runStep(python, args, workDir, env):
+    """Runs one of the tools under measure.py and returns its measurements."""
+    outPath=os.path.join(workDir, "measure.json")
+    subprocess.call([python, MEASURE, outPath]+args, cwd=workDir, env=env)
+    with open(outPath, "r") as f:
+        result=json.load(f)
+    os.remove(outPath)
+    return result
+
+
+def findElementDir(dbDir, idNum):
+    """Returns the directory of an element in whichever protocol it was fetched for, or None."""
+    for p in sorted(os.listdir(dbDir)):
+        path=os.path.join(dbDir, p, str(idNum))
+        if not p.startswith('.') and os.path.exists(os.path.join(path, "type.txt")):
+            return path
+    return None
+
+
+def readSraRuns(path):
+    with open(path, "r") as f:
+        return [l.split('/')[-1].split('.')[0] for l in f.read().splitlines() if len(l.strip())>0]
+
+
+class NetBench(object):
+    """Runs every step for one profile in a fresh directory, checking each step's results against the catalog."""
+
+    def __init__(self, server, python, workDir, numWorkers, sampleSizes, env):
+        self.server=server
+        self.catalog=server.catalog
+        self.python=python
+        self.workDir=workDir
+        self.dbDir=os.path.join(workDir, "db")
+        self.numWorkers=numWorkers
+        self.env=env
+        self.stepStart=None
+
+        # The same series are fetched under every profile:
+        numMatrices, numSraLists, numDownloads=sampleSizes
+        self.matrixIds=sorted(self.catalog.series.values())[:numMatrices]
+        self.sraListIds=self.matrixIds[:numSraLists]
+        self.downloadIds=self.sraListIds[:numDownloads]
+
+    def getIdFiles(self):
+        return [os.path.join("ids", "%s.txt" % p) for p in sorted(self.catalog.byProtocol.keys())]
+
+    def getSteps(self):
+        """Returns (name, tool arguments, unit, check) for every step. A check returns (units expected, units missing)."""
+        j="-j=%d" % self.numWorkers
+        return [("search", [QUERY_GEO, "-d=ids"]+sorted(self.catalog.byProtocol.keys()), "ids", self.checkSearch),
+                ("ingest", [MAKE_DB, j]+self.getIdFiles()+["db"], "elements", self.checkIngest),
+                ("update", [MAKE_DB, "--update", j]+self.getIdFiles()+["db"], "elements", self.checkUpdate),
+                ("matrices", [QUERY_TOOL, j, "db", "fetchmatrices"]+[str(i) for i in self.matrixIds], "series", self.checkMatrices),
+                ("sralists", [QUERY_TOOL, "db", "getsralist"]+[str(i) for i in self.sraListIds], "series", self.checkSraLists),
+                ("download", [QUERY_TOOL, j, "db", "downloadall", "downloads"]+[str(i) for i in self.downloadIds], "files", self.checkDownloads)]
+
+    def checkSearch(self):
+        expected=0
+        missing=0
+        for p, ids in self.catalog.byProtocol.items():
+            found=set()
+            path=os.path.join(self.workDir, "ids", "%s.txt" % p)
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    found=set(f.read().splitlines()[1:])
+            expected+=len(ids)
+            missing+=len([i for i in ids if str(i) not in found])
+        return (expected, missing)
+
+    def checkIngest(self):
+        store=openStore(self.dbDir)
+        expected=0
+        missing=0
+        for p, ids in self.catalog.byProtocol.items():
+            fetched=set(store.listFetchedIds(p)) if p in store.listProtocols() else set()
+            expected+=len(ids)
+            missing+=len([i for i in ids if str(i) not in fetched])
+        store.close()
+        return (expected, missing)
+
+    def checkUpdate(self):
+        # Every changed element should have been written again while the step ran:
+        expected=0
+        missing=0
+        for p in self.catalog.byProtocol.keys():
+            for i in self.catalog.search(p, self.catalog.today):
+                expected+=1
+                path=os.path.join(self.dbDir, p, str(i), "summary.txt")
+                if not os.path.exists(path) or os.path.getmtime(path)<self.stepStart:
+                    missing+=1
+        return (expected, missing)
+
+    def checkMatrices(self):
+        missing=0
+        for i in self.matrixIds:
+            path=findElementDir(self.dbDir, i)
+            if path is None or not os.path.exists(os.path.join(path, "matrices", "GSE%d_family.xml" % (i%1000000))):
+                missing+=1
+        return (len(self.matrixIds), missing)
+
+    def checkSraLists(self):
+        missing=0
+        for i in self.sraListIds:
+            path=findElementDir(self.dbDir, i)
+            if path is None or not os.path.exists(os.path.join(path, "%d.sralist" % i)) or len(readSraRuns(os.path.join(path, "%d.sralist" % i)))==0:
+                missing+=1
+        return (len(self.sraListIds), missing)
+
+    def checkDownloads(self):
+        expected=0
+        missing=0
+        for i in self.downloadIds:
+            path=findElementDir(self.dbDir, i)
+            if path is None or not os.path.exists(os.path.join(path, "%d.sralist" % i)):
+                continue
+            for srr in readSraRuns(os.path.join(path, "%d.sralist" % i)):
+                expected+=1
+                filePath=os.path.join(self.workDir, "downloads", str(i), "%s.sra" % srr)
+                if not os.path.exists(filePath) or os.path.getsize(filePath)!=self.catalog.getSraSize(srr):
+                    missing+=1
+        return (expected, missing)
+
+    def run(self, profile, log):
+        results=[]
+        for name, args, unit, check in self.getSteps():
+            before=self.server.stats.snapshot()
+            # Whole seconds, since that may be all the file system records:
+            self.stepStart=int(time.time())
+            result=runStep(self.python, args, self.workDir, self.env)
+            server=diffStats(before, self.server.stats.snapshot())
+            expected, missing=check()
+
+            result.update({"profile": profile, "step": name, "unit": unit, "expected": expected, "missing": missing,
+                           "perSecond": (expected-missing)/max(result["wall"], 1e-6), "server": server})
+            results.append(result)
+
+            total=server.get("total", {})
+            log("%-6s %-9s %8.2fs %9.1f %s/s  %5d request(s) %4d throttled %4d error(s)  %s%s\n" %
+                (profile, name, result["wall"], result["perSecond"], unit, total.get("requests", 0), total.get("throttled", 0),
+                 total.get("status", 0)+total.get("reset", 0)+total.get("truncate", 0),
+                 "complete" if missing==0 else "%d of %d %s missing" % (missing, expected, unit),
+                 "" if result["error"] is None else "  ERROR: %s" % result["error"]))
+        return results
+
+
+def compareReports(oldPath, newPath):
+    """Prints the change in wall time, throughput and completeness for every step in both reports."""
+    with open(oldPath, "r") as f:
+        old=json.load(f)
+    with open(newPath, "r") as f:
+        new=json.load(f)
+
+    oldResults=dict([((r["profile"], r["step"]), r) for r in old["results"]])
+    print("%-7s %-9s %10s %10s %7s %11s %11s %8s %8s" % ("profile", "step", "old wall", "new wall", "speedup",
+                                                         "old rate/s", "new rate/s", "old miss", "new miss"))
+    for r in new["results"]:
+        key=(r["profile"], r["step"])
+        if key not in oldResults:
+            continue
+        o=oldResults[key]
+        print("%-7s %-9s %9.2fs %9.2fs %6.2fx %11.1f %11.1f %8d %8d" %
+              (r["profile"], r["step"], o["wall"], r["wall"], o["wall"]/max(r["wall"], 1e-6), o["perSecond"],
+               r["perSecond"], o["missing"], r["missing"]))
+
+
+def getRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=open(os.devnull, "w")).strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    numIds=DEFAULT_IDS
+    sampleSizes=[DEFAULT_MATRICES, DEFAULT_SRALISTS, DEFAULT_DOWNLOADS]
+    numWorkers=DEFAULT_WORKERS
+    profiles=DEFAULT_PROFILES
+    sraSize=SRA_SIZE
+    seed=1
+    outPath="net_report.json"
+    python=sys.executable
+    workDir=None
+    useApiKey=False
+
+    newArgs=[]
+    for a in args:
+        aToks=a.split('=', 1)
+        if aToks[0]=="-n":
+            numIds=int(aToks[1])
+        elif aToks[0]=="-m":
+            sampleSizes[0]=int(aToks[1])
+        elif aToks[0]=="-sl":
+            sampleSizes[1]=int(aToks[1])
+        elif aToks[0]=="-dl":
+            sampleSizes[2]=int(aToks[1])
+        elif aToks[0]=="-j":
+            numWorkers=int(aToks[1])
+        elif aToks[0]=="-p":
+            profiles=aToks[1].split(',')
+        elif aToks[0]=="-sra":
+            sraSize=int(aToks[1])
+        elif aToks[0]=="-seed":
+            seed=int(aToks[1])
+        elif aToks[0]=="-o":
+            outPath=aToks[1]
+        elif aToks[0]=="-py":
+            python=aToks[1]
+        elif aToks[0]=="-d":
+            workDir=aToks[1]
+        elif a=="-apikey":
+            useApiKey=True
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if len(args)==4 and args[1]=="--compare":
+        compareReports(args[2], args[3])
+        return
+
+    if len(args)!=1 or len([p for p in profiles if p not in PROFILES])>0:
+        print("Usage: %s [-n=<ids>] [-m=<n>] [-sl=<n>] [-dl=<n>] [-j=<n>] [-p=<profiles>] [-sra=<bytes>]" % args[0])
+        print("       [-seed=<n>] [-o=<report>] [-py=<python>] [-d=<dir>] [-apikey]")
+        print("       %s --compare old_report new_report" % args[0])
+        print("Measures search, ingest and fetch throughput against a local mock of NCBI and writes a JSON report.")
+        print("-n=<ids>\tNumber of elements in the mock database (default %d)." % DEFAULT_IDS)
+        print("-m, -sl, -dl\tNumber of series to fetch matrices, SRA lists and run files for (default %d, %d and %d)." %
+              (DEFAULT_MATRICES, DEFAULT_SRALISTS, DEFAULT_DOWNLOADS))
+        print("-j=<n>\tWorkers passed to the tools (default %d)." % DEFAULT_WORKERS)
+        print("-p=<profiles>\tComma separated network profiles to run, out of %s (default all)." % ", ".join(DEFAULT_PROFILES))
+        print("-sra=<bytes>\tAverage size of an SRA run file (default %d)." % SRA_SIZE)
+        print("-d=<dir>\tRuns in dir and keeps what the tools wrote there.")
+        print("-apikey\tRuns the tools with an API key, raising the request rate limit.")
+        return
+
+    keep=workDir is not None
+    if workDir is None:
+        workDir=tempfile.mkdtemp(prefix="geonetbench")
+    elif not os.path.exists(workDir):
+        os.makedirs(workDir)
+
+    server=MockNcbi(RemoteCatalog(numIds, seed, sraSize=sraSize))
+    server.start()
+
+    env=dict(os.environ, EUTILS_BASE=server.getEutilsBase(), GEO_MIRROR=server.getMirror())
+    env.pop("NCBI_API_KEY", None)
+    if useApiKey:
+        env["NCBI_API_KEY"]="mock"
+
+    report={"revision": getRevision(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": python,
+            "platform": platform.platform(), "numIds": numIds, "seed": seed, "sraSize": sraSize, "workers": numWorkers,
+            "apiKey": useApiKey, "profiles": dict([(p, PROFILES[p]) for p in profiles]), "results": []}
+    try:
+        for p in profiles:
+            server.configure(**PROFILES[p])
+            profileDir=os.path.join(workDir, p)
+            if os.path.exists(profileDir):
+                shutil.rmtree(profileDir)
+            os.makedirs(profileDir)
+
+            bench=NetBench(server, python, profileDir, numWorkers, sampleSizes, env)
+            report["results"].extend(bench.run(p, sys.stdout.write))
+    finally:
+        server.stop()
+        if not keep:
+            shutil.rmtree(workDir, True)
+
+    with open(outPath, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Wrote %s" % outPath)
+
+
+if __name__=="__main__":
+    main(sys.argv)
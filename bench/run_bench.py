@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# run_bench.py -- Times the query commands of query_groseq_database.py against synthetic databases.
+#
+# For every scale, a database is generated by make_synthetic_db.py (or reused if it already exists), and
+# every command is run once with cold caches and then several times with warm ones. A cold run starts
+# without any of the indexes, tables and caches the tools keep in the database directory and, if asked
+# to with --drop-caches, without the kernel's page cache. Each run happens in its own process under measure.py.
+# Everything runs offline, and the results are written to a JSON report that --compare can set against
+# an earlier one.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+
+from make_synthetic_db import makeDatabase, MANIFEST_NAME
+
+
+BENCH_DIR=os.path.dirname(os.path.abspath(__file__))
+QUERY_TOOL=os.path.join(BENCH_DIR, "..", "query_groseq_database.py")
+MEASURE=os.path.join(BENCH_DIR, "measure.py")
+
+DEFAULT_SCALES=[1000, 10000, 100000]
+DEFAULT_REPEATS=3
+
+# Files kept in the database directory by the tools, and in each element's directory:
+DB_CACHES=[".geoindex.sqlite", ".displaytable.bin", ".lastquery"]
+ELEMENT_CACHES=["seriescache.bin"]
+
+# Number of IDs and accessions taken from the manifest for getsummary and getbyaccession:
+NUM_SUMMARIES=20
+NUM_ACCESSIONS=200
+
+
+def getCommands(manifest):
+    """Returns (name, arguments) for every benchmarked command."""
+    return [("listspecies", ["listspecies"]),
+            ("findspecies", ["findspecies", "Homo sapiens"]),
+            ("getsummary", ["getsummary"]+manifest["ids"][:NUM_SUMMARIES]),
+            ("protocoloverlap", ["protocoloverlap"]),
+            ("getbyaccession", ["getbyaccession"]+manifest["accessions"][:NUM_ACCESSIONS]),
+            ("getreadytodownload", ["getreadytodownload"])]
+
+
+def clearCaches(dbDir, dropPageCache):
+    """Removes every cache the tools keep, and drops the page cache if dropPageCache is set. Returns whether it was."""
+    for name in DB_CACHES:
+        if os.path.exists(os.path.join(dbDir, name)):
+            os.remove(os.path.join(dbDir, name))
+
+    for p in os.listdir(dbDir):
+        if p.startswith('.'):
+            continue
+        for i in os.listdir(os.path.join(dbDir, p)):
+            # Only elements with matrices have per-element caches:
+            if not os.path.exists(os.path.join(dbDir, p, i, "matrices")):
+                continue
+            for name in ELEMENT_CACHES:
+                if os.path.exists(os.path.join(dbDir, p, i, name)):
+                    os.remove(os.path.join(dbDir, p, i, name))
+
+    if not dropPageCache:
+        return False
+    try:
+        subprocess.call(["sync"])
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def runMeasured(python, dbDir, cmdArgs, workDir):
+    """Runs one command under measure.py and returns its measurements."""
+    outPath=os.path.join(workDir, "measure.json")
+    startTime=time.time()
+    # The query tool writes .lastquery to its working directory, so it's run from the database directory:
+    subprocess.call([python, MEASURE, outPath, QUERY_TOOL, dbDir]+cmdArgs, cwd=dbDir,
+                    env=dict(os.environ, EUTILS_BASE="http://127.0.0.1:9/"))
+    processWall=time.time()-startTime
+
+    with open(outPath, "r") as f:
+        result=json.load(f)
+    os.remove(outPath)
+    result["processWall"]=processWall
+    return result
+
+
+def summarize(runs):
+    """Returns the run with the median wall time, along with the fastest and slowest times."""
+    ordered=sorted(runs, key=lambda r: r["wall"])
+    result=dict(ordered[len(ordered)//2])
+    result["minWall"]=ordered[0]["wall"]
+    result["maxWall"]=ordered[-1]["wall"]
+    result["runs"]=len(runs)
+    return result
+
+
+def runScale(python, scale, workDir, repeats, dropPageCache, log):
+    dbDir=os.path.abspath(os.path.join(workDir, "db%d" % scale))
+    results=[]
+
+    if not os.path.exists(os.path.join(dbDir, MANIFEST_NAME)):
+        if os.path.exists(dbDir):
+            shutil.rmtree(dbDir)
+        log("Generating %d elements in %s...\n" % (scale, dbDir))
+        startTime=time.time()
+        makeDatabase(scale, dbDir)
+        log("Generated in %.1fs\n" % (time.time()-startTime))
+
+    with open(os.path.join(dbDir, MANIFEST_NAME), "r") as f:
+        manifest=json.load(f)
+
+    for name, cmdArgs in getCommands(manifest):
+        dropped=clearCaches(dbDir, dropPageCache)
+        cold=runMeasured(python, dbDir, cmdArgs, workDir)
+        cold.update({"scale": scale, "command": name, "cache": "cold", "pageCacheDropped": dropped})
+        results.append(cold)
+
+        warm=summarize([runMeasured(python, dbDir, cmdArgs, workDir) for i in range(repeats)])
+        warm.update({"scale": scale, "command": name, "cache": "warm"})
+        results.append(warm)
+
+        log("%7d %-20s cold %8.3fs  warm %8.3fs  %6d/%6d read syscalls  %7d KB peak%s\n" %
+            (scale, name, cold["wall"], warm["wall"], cold.get("readSyscalls", 0), warm.get("readSyscalls", 0),
+             max(cold["maxRssKb"], warm["maxRssKb"]), "" if cold["error"] is None else "  ERROR: %s" % cold["error"]))
+    return results
+
+
+def compareReports(oldPath, newPath):
+    """Prints the change in wall time, read system calls and peak memory for every run in both reports."""
+    with open(oldPath, "r") as f:
+        old=json.load(f)
+    with open(newPath, "r") as f:
+        new=json.load(f)
+
+    oldResults=dict([((r["scale"], r["command"], r["cache"]), r) for r in old["results"]])
+    print("%7s %-20s %-5s %10s %10s %7s %9s %9s %9s %9s" % ("scale", "command", "cache", "old wall", "new wall", "speedup",
+                                                          "old reads", "new reads", "old KB", "new KB"))
+    for r in new["results"]:
+        key=(r["scale"], r["command"], r["cache"])
+        if key not in oldResults:
+            continue
+        o=oldResults[key]
+        print("%7d %-20s %-5s %9.3fs %9.3fs %6.2fx %9d %9d %9d %9d" %
+              (r["scale"], r["command"], r["cache"], o["wall"], r["wall"], o["wall"]/max(r["wall"], 1e-6),
+               o.get("readSyscalls", 0), r.get("readSyscalls", 0), o["maxRssKb"], r["maxRssKb"]))
+
+
+def getRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=open(os.devnull, "w")).strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    scales=DEFAULT_SCALES
+    repeats=DEFAULT_REPEATS
+    workDir=None
+    outPath="bench_report.json"
+    python=sys.executable
+    keep=False
+    dropPageCache=False
+
+    newArgs=[]
+    for a in args:
+        aToks=a.split('=', 1)
+        if aToks[0]=="-s":
+            scales=[int(s) for s in aToks[1].split(',')]
+        elif aToks[0]=="-r":
+            repeats=int(aToks[1])
+        elif aToks[0]=="-d":
+            workDir=aToks[1]
+            keep=True
+        elif aToks[0]=="-o":
+            outPath=aToks[1]
+        elif aToks[0]=="-py":
+            python=aToks[1]
+        elif a=="--drop-caches":
+            dropPageCache=True
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if len(args)==4 and args[1]=="--compare":
+        compareReports(args[2], args[3])
+        return
+
+    if len(args)!=2 or args[1]!="run":
+        print("Usage: %s [-s=<scales>] [-r=<n>] [-d=<dir>] [-o=<report>] [-py=<python>] [--drop-caches] run" % args[0])
+        print("       %s --compare old_report new_report" % args[0])
+        print("Benchmarks the query commands against synthetic databases and writes a JSON report.")
+        print("-s=<scales>\tComma separated numbers of elements to test with (default %s)." % ",".join([str(s) for s in DEFAULT_SCALES]))
+        print("-r=<n>\tNumber of warm runs of each command (default %d)." % DEFAULT_REPEATS)
+        print("-d=<dir>\tKeeps the generated databases in dir, so that later runs can reuse them.")
+        print("-o=<report>\tWhere to write the report (default bench_report.json).")
+        print("-py=<python>\tThe interpreter used to run the tools (default this one).")
+        print("--drop-caches\tAlso drops the kernel's page cache before every cold run. This needs root and")
+        print("\t\taffects every process on the machine.")
+        return
+
+    if dropPageCache and not os.access("/proc/sys/vm/drop_caches", os.W_OK):
+        print("ERROR: --drop-caches needs write access to /proc/sys/vm/drop_caches, ie. running as root.")
+        return
+
+    if workDir is None:
+        workDir=tempfile.mkdtemp(prefix="geobench")
+    elif not os.path.exists(workDir):
+        os.makedirs(workDir)
+
+    report={"revision": getRevision(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": python,
+            "platform": platform.platform(), "repeats": repeats, "results": []}
+    try:
+        for scale in scales:
+            report["results"].extend(runScale(python, scale, workDir, repeats, dropPageCache, sys.stdout.write))
+    finally:
+        if not keep:
+            shutil.rmtree(workDir, True)
+
+    with open(outPath, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Wrote %s" % outPath)
+
+
+if __name__=="__main__":
+    main(sys.argv)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# display_table.py -- A precomputed table of everything printTitle shows for an element.
+#
+# Rendering a result means reading the element's title and working out its "Lastname2016" shorthand,
+# which can mean parsing its matrix files. The table holds both for every element in a single file,
+# dbdir/.displaytable.bin, which is memory mapped so that rendering a result is an in-memory lookup.
+# Only the rows are copied out of the mapping, into arrays that can be searched quickly.
+#
+# The file is laid out as follows, with every number stored little-endian:
+#   DISPLAY_MAGIC
+#   uint32 number of protocols, then for each: uint16 name length, name, float64 stamp,
+#          uint32 first row, uint32 number of rows
+#   rows: uint32 id, uint32 text offset, uint32 text length; sorted by id within each protocol
+#   text: the shorthand name and title of every row, separated by a NUL
+#
+# The stamps are compared with the store's when the table is opened. Commands that change what is
+# shown in other ways (adding summaries or fetching matrices) remove the table, and it is rebuilt the
+# next time it's needed.
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+from array import array
+from geo_store import encodeText
+from miniml import getSeriesInfo, getSeriesContribName
+from instrument import phase
+
+
+DISPLAY_TABLE_NAME=".displaytable.bin"
+DISPLAY_MAGIC="GEODISP\x01"
+
+ROW=struct.Struct("<III")
+
+
+def getDisplayName(store, path):
+    """Returns the shorthand name printed for an element, or "" if it has none. Names are only shown
+    for elements whose matrices have been fetched, and are cached in the store once computed."""
+    if not os.path.exists(os.path.join(path, "matrices")):
+        return ""
+
+    cachedName=store.getContribName(path)
+    if cachedName is not None:
+        return cachedName
+
+    pName=getSeriesContribName(getSeriesInfo(path))
+    if pName is None:
+        return ""
+    pName=encodeText(pName.strip())
+    store.setContribName(path, pName)
+    return pName
+
+
+def buildDisplayTable(store, basedir):
+    """Renders every element in the store and writes the results to the display table."""
+    header=[]
+    rows=[]
+    text=[]
+    textSize=0
+
+    protocols=store.listProtocols()
+    for p in protocols:
+        # Take the stamp first, so that changes made while the table is built aren't missed:
+        stamp=store.getStamp(p)
+        ids=store.getIndex().getIdSet(store, p)[0]
+        firstRow=len(rows)
+
+        for idNum in ids:
+            path=store.entryPath(p, str(idNum))
+            try:
+                title=store.getTitle(path)
+                name=getDisplayName(store, path)
+            except (IOError, IndexError):
+                # Elements whose metadata was never fetched are rendered the slow way, if at all.
+                continue
+
+            entry="%s\0%s" % (name, title)
+            rows.append(ROW.pack(idNum, textSize, len(entry)))
+            text.append(entry)
+            textSize+=len(entry)
+
+        header.append(struct.pack("<H", len(p))+p+struct.pack("<dII", stamp, firstRow, len(rows)-firstRow))
+
+    tmpPath=os.path.join(basedir, DISPLAY_TABLE_NAME+".tmp")
+    with open(tmpPath, "wb") as f:
+        f.write(DISPLAY_MAGIC)
+        f.write(struct.pack("<I", len(protocols)))
+        f.write("".join(header))
+        f.write("".join(rows))
+        f.write("".join(text))
+    os.rename(tmpPath, os.path.join(basedir, DISPLAY_TABLE_NAME))
+
+
+# Tables opened by this process, by database directory:
+openTables={}
+
+
+def closeDisplayTable(basedir):
+    """Closes the table opened for a database directory, if any, so that it's opened again when next needed."""
+    if basedir in openTables:
+        openTables.pop(basedir).close()
+
+
+def removeDisplayTable(basedir):
+    """Throws the table away, so that it's rebuilt with up to date contents the next time it's needed."""
+    closeDisplayTable(basedir)
+    try:
+        os.remove(os.path.join(basedir, DISPLAY_TABLE_NAME))
+    except OSError:
+        pass
+
+
+class DisplayTable(object):
+    """A read-only, memory mapped view of the display table."""
+
+    def __init__(self, path):
+        f=open(path, "rb")
+        try:
+            self.data=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.data[:len(DISPLAY_MAGIC)]!=DISPLAY_MAGIC:
+            raise ValueError("%s is not a display table" % path)
+
+        pos=len(DISPLAY_MAGIC)
+        numProtocols=struct.unpack_from("<I", self.data, pos)[0]
+        pos+=4
+
+        # Protocol name -> (stamp, first row, number of rows):
+        self.protocols={}
+        numRows=0
+        for i in range(numProtocols):
+            nameLen=struct.unpack_from("<H", self.data, pos)[0]
+            name=self.data[pos+2:pos+2+nameLen]
+            pos+=2+nameLen
+            self.protocols[name]=struct.unpack_from("<dII", self.data, pos)
+            numRows+=self.protocols[name][2]
+            pos+=16
+
+        self.textStart=pos+numRows*ROW.size
+        rows=array('I')
+        rows.fromstring(self.data[pos:self.textStart])
+        if sys.byteorder=="big":
+            rows.byteswap()
+        self.ids=rows[0::3]
+        self.offsets=rows[1::3]
+        self.lengths=rows[2::3]
+
+    def isCurrent(self, store):
+        """Checks that the table was built from the store as it is now."""
+        protocols=store.listProtocols()
+        if sorted(protocols)!=sorted(self.protocols.keys()):
+            return False
+        for p in protocols:
+            if self.protocols[p][0]!=store.getStamp(p):
+                return False
+        return True
+
+    def lookup(self, protocol, idNum):
+        """Returns (shorthand name, title) for an element, or None if the table doesn't hold it."""
+        if protocol not in self.protocols or not idNum.isdigit():
+            return None
+
+        idNum=int(idNum)
+        stamp, first, count=self.protocols[protocol]
+        i=bisect.bisect_left(self.ids, idNum, first, first+count)
+        if i==first+count or self.ids[i]!=idNum:
+            return None
+
+        start=self.textStart+self.offsets[i]
+        return tuple(self.data[start:start+self.lengths[i]].split("\0", 1))
+
+    def close(self):
+        self.data.close()
+
+
+def openDisplayTable(store, basedir):
+    """Returns the display table for a store, building it first if it's missing or out of date."""
+    path=os.path.join(basedir, DISPLAY_TABLE_NAME)
+    if os.path.exists(path):
+        try:
+            table=DisplayTable(path)
+            if table.isCurrent(store):
+                return table
+            table.close()
+        except (ValueError, struct.error, EnvironmentError):
+            # A damaged table is simply rebuilt.
+            pass
+
+    with phase("indexing"):
+        buildDisplayTable(store, basedir)
+    return DisplayTable(path)
+
+
+def getDisplayTable(store):
+    """Returns the display table for a store, opening it only once per process."""
+    if store.basedir not in openTables:
+        openTables[store.basedir]=openDisplayTable(store, store.basedir)
+    return openTables[store.basedir]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# eutils.py -- A small client for NCBI's Entrez utilities.
+#
+# Every script talks to NCBI through the one client returned by getClient(). NCBI allows 3 requests per
+# second per client, or 10 with an API key (taken from the NCBI_API_KEY environment variable), and the
+# client keeps to that limit across all threads. The server can be replaced by setting EUTILS_BASE,
+# which makes it possible to run everything against a mock.
+
+import os
+import re
+import time
+import random
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+from instrument import phase, count
+
+try:
+    import xml.etree.cElementTree as ETree
+except ImportError:
+    import xml.etree.ElementTree as ETree
+
+
+EUTILS_BASE=os.environ.get("EUTILS_BASE", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/")
+
+# Number of accessions OR'd together in a single esearch term, and of summaries fetched per esummary:
+SEARCH_BATCH=200
+SUMMARY_BATCH=500
+
+# Number of IDs requested per page of esearch results:
+SEARCH_PAGE=10000
+
+# Responses that mean the request may succeed if it's tried again later:
+RETRY_STATUS=(429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """Hands out tokens at a fixed rate, holding at most burst of them at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate=float(rate)
+        self.capacity=float(burst)
+        self.tokens=float(burst)
+        self.last=time.time()
+        self.lock=threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now=time.time()
+                self.tokens=min(self.capacity, self.tokens+(now-self.last)*self.rate)
+                self.last=now
+                if self.tokens>=1:
+                    self.tokens-=1
+                    return
+                delay=(1-self.tokens)/self.rate
+            time.sleep(delay)
+
+
+class Metrics(object):
+    """Counts requests, retries, failures, bytes and time spent, both overall and per utility."""
+
+    fields=["requests", "retries", "failures", "bytesSent", "bytesReceived", "seconds"]
+
+    def __init__(self):
+        self.byUtil={}
+        self.lock=threading.Lock()
+
+    def add(self, util, **counts):
+        with self.lock:
+            cur=self.byUtil.setdefault(util, dict([(f, 0) for f in self.fields]))
+            for k, v in counts.items():
+                cur[k]+=v
+
+    def getTotals(self):
+        with self.lock:
+            totals=dict([(f, 0) for f in self.fields])
+            for cur in self.byUtil.values():
+                for f in self.fields:
+                    totals[f]+=cur[f]
+            return totals
+
+    def summary(self):
+        lines=[]
+        with self.lock:
+            for util in sorted(self.byUtil.keys()):
+                cur=self.byUtil[util]
+                lines.append("%s: %d request(s), %d retries, %d failure(s), %.1f KB sent, %.1f KB received, %.2fs" %
+                             (util, cur["requests"], cur["retries"], cur["failures"], cur["bytesSent"]/1024.0,
+                              cur["bytesReceived"]/1024.0, cur["seconds"]))
+        return "\n".join(lines)
+
+
+class EUtils(object):
+    """A thread-safe E-utilities client. Connections are kept open and reused, requests are spread out
+    by a token bucket, and throttled or failed requests are retried with exponential backoff."""
+
+    def __init__(self, base=EUTILS_BASE, apiKey=None, maxConnections=4, maxRetries=5, backoff=0.5, timeout=120):
+        if not base.endswith('/'):
+            base+='/'
+        parsed=urlparse.urlparse(base)
+        self.base=base
+        self.secure=(parsed.scheme=="https")
+        self.host=parsed.hostname
+        self.port=parsed.port
+        self.path=parsed.path
+
+        self.apiKey=apiKey if apiKey is not None else os.environ.get("NCBI_API_KEY")
+        self.bucket=TokenBucket(10 if self.apiKey else 3)
+        self.maxConnections=maxConnections
+        self.maxRetries=maxRetries
+        self.backoff=backoff
+        self.timeout=timeout
+        self.metrics=Metrics()
+
+        self.idle=[]
+        self.slots=threading.BoundedSemaphore(maxConnections)
+        self.lock=threading.Lock()
+
+    def getConnection(self):
+        with self.lock:
+            if len(self.idle)>0:
+                return self.idle.pop()
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def putConnection(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def fetch(self, util, params):
+        """POSTs params (a dictionary or an encoded string) to one of the utilities, ie. "esearch",
+        and returns the body of the response."""
+        if isinstance(params, dict):
+            params=urllib.urlencode(params)
+        if self.apiKey:
+            params+="&"+urllib.urlencode({"api_key": self.apiKey})
+
+        path="%s%s.fcgi" % (self.path, util)
+        headers={"Content-type": "application/x-www-form-urlencoded", "Accept": "text/xml"}
+
+        attempt=0
+        while True:
+            with phase("rate limiting"):
+                self.bucket.acquire()
+            startTime=time.time()
+            retryAfter=None
+
+            self.slots.acquire()
+            conn=self.getConnection()
+            count("http requests")
+            try:
+                with phase("network"):
+                    conn.request("POST", path, params, headers)
+                    resp=conn.getresponse()
+                    data=resp.read()
+                count("network bytes", len(data))
+            except (socket.error, httplib.HTTPException) as e:
+                # The connection may have been dropped by the server, so it isn't reused:
+                conn.close()
+                error="%s" % e
+            else:
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self.putConnection(conn)
+
+                if resp.status==200:
+                    self.metrics.add(util, requests=1, bytesSent=len(params), bytesReceived=len(data),
+                                     seconds=time.time()-startTime)
+                    return data
+
+                error="HTTP %d" % resp.status
+                retryAfter=resp.getheader("Retry-After")
+                if resp.status not in RETRY_STATUS:
+                    attempt=self.maxRetries
+            finally:
+                self.slots.release()
+
+            self.metrics.add(util, requests=1, bytesSent=len(params), seconds=time.time()-startTime)
+            if attempt>=self.maxRetries:
+                self.metrics.add(util, failures=1)
+                raise IOError("%s request to %s failed: %s" % (util, self.base, error))
+
+            delay=self.backoff*(2**attempt)
+            if retryAfter is not None and retryAfter.isdigit():
+                delay=max(delay, int(retryAfter))
+            # A little jitter keeps concurrent threads from retrying in lockstep:
+            time.sleep(delay+random.uniform(0, delay/2))
+            self.metrics.add(util, retries=1)
+            attempt+=1
+
+    def request(self, util, params):
+        """Like fetch, but returns the parsed XML response."""
+        data=self.fetch(util, params)
+        with phase("parsing"):
+            return ETree.fromstring(data)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle=[]
+
+
+sharedClient=None
+sharedLock=threading.Lock()
+
+
+def getClient():
+    """Returns the client shared by everything in the process, so that the rate limit holds across all requests."""
+    global sharedClient
+    with sharedLock:
+        if sharedClient is None:
+            sharedClient=EUtils()
+        return sharedClient
+
+
+def iterSearchPages(client, params, pageSize=SEARCH_PAGE):
+    """Yields the IDs matched by an esearch a page at a time, requesting pageSize IDs per page so that
+    there is no limit on the number of results. Each page is stream-parsed rather than built into a tree."""
+    params=dict(params)
+    params["retmax"]=pageSize
+    retStart=0
+
+    while True:
+        params["retstart"]=retStart
+        total=0
+        ids=[]
+        contents=client.fetch("esearch", params)
+        with phase("parsing"):
+            for event, elem in ETree.iterparse(StringIO(contents)):
+                if elem.tag=="Id":
+                    ids.append(elem.text)
+                elif elem.tag=="Count" and total==0:
+                    # The first Count is the total; translated queries may list more inside TranslationStack.
+                    total=int(elem.text)
+                elif elem.tag=="ERROR":
+                    raise IOError("esearch returned an error: %s" % elem.text)
+                elem.clear()
+
+        if len(ids)>0:
+            yield ids
+
+        retStart+=len(ids)
+        if len(ids)==0 or retStart>=total:
+            break
+
+
+def iterSearchIds(client, params, pageSize=SEARCH_PAGE):
+    """Yields every ID matched by an esearch."""
+    for page in iterSearchPages(client, params, pageSize):
+        for i in page:
+            yield i
+
+
+def findSrx(url):
+    """Returns the SRA experiment accession named by a sample's "SRA Experiment" link."""
+    m=re.search(r'[SED]RX\d+', url)
+    if m is None:
+        return None
+    return m.group(0)
+
+
+def getRunUrl(srr):
+    return "ftp://ftp-trace.ncbi.nlm.nih.gov/sra/sra-instant/reads/ByRun/sra/SRR/%s/%s/%s.sra" % (srr[:6], srr, srr)
+
+
+def addRuns(runs, srx, srrs):
+    known=runs.setdefault(srx, [])
+    known.extend([r for r in srrs if r not in known])
+
+
+def parseSraSummaries(root):
+    """Returns a dictionary of experiment accession -> list of run accessions for an esummary response."""
+    runs={}
+    for docSum in root.findall("DocSum"):
+        srx=None
+        srrs=[]
+        for item in docSum.findall("Item"):
+            # Both fields hold escaped XML fragments, which are picked apart with a regex rather than parsed:
+            if item.attrib.get("Name")=="ExpXml" and item.text is not None:
+                m=re.search(r'<Experiment[^>]*\bacc="([^"]+)"', item.text)
+                if m is not None:
+                    srx=m.group(1)
+            elif item.attrib.get("Name")=="Runs" and item.text is not None:
+                srrs=re.findall(r'<Run[^>]*\bacc="([^"]+)"', item.text)
+
+        if srx is not None:
+            addRuns(runs, srx, srrs)
+    return runs
+
+
+def fetchSraRuns(client, srxList):
+    """Looks up the runs of many experiments, using one esearch for every SEARCH_BATCH accessions and one
+    esummary for every SUMMARY_BATCH results. Returns a dictionary of experiment -> list of runs."""
+    runs={}
+    for start in range(0, len(srxList), SEARCH_BATCH):
+        batch=srxList[start:start+SEARCH_BATCH]
+        term=" OR ".join(["%s[Accession]" % s for s in batch])
+
+        # Leave the results on the server so that their summaries can be requested by reference:
+        root=client.request("esearch", {"db": "sra", "term": term, "usehistory": "y", "retmax": 0})
+        nResults=int(root.findtext("Count", "0"))
+        webEnv=root.findtext("WebEnv")
+        queryKey=root.findtext("QueryKey")
+        if nResults==0 or webEnv is None:
+            continue
+
+        for retStart in range(0, nResults, SUMMARY_BATCH):
+            root=client.request("esummary", {"db": "sra", "WebEnv": webEnv, "query_key": queryKey,
+                                             "retstart": retStart, "retmax": SUMMARY_BATCH})
+            for srx, srrs in parseSraSummaries(root).items():
+                addRuns(runs, srx, srrs)
+    return runs
+
+
+def resolveSraRuns(client, index, srxList):
+    """Returns a dictionary of experiment -> list of runs, asking NCBI only about experiments that
+    aren't already in the index's run cache."""
+    runs=index.getSraRuns(srxList)
+    missing=[s for s in srxList if s not in runs]
+
+    if len(missing)>0:
+        fetched=fetchSraRuns(client, sorted(set(missing)))
+        for srx, srrs in fetched.items():
+            index.addSraRuns(srx, srrs)
+        index.commit()
+        runs.update(fetched)
+
+    return runs
@@ -3,41 +3,42 @@
 
 import os
 import sys
-import httplib
-import urllib
-import xml.etree.ElementTree as ETree
+from eutils import getClient, iterSearchPages
+import instrument
 
 def main(args):
     if len(args)!=2:
         print("Usage: %s outfile" % args[0])
         print("Fetch a list of GRO-Seq datasets present on GEO.")
+        print("If outfile is -, IDs are written to stdout as they arrive and messages go to stderr.")
+        print("If --profile is specified, a breakdown of where the time went is written to stderr at exit.")
+        print("--profile=<file> also writes a cProfile dump, and --trace=<file> a Chrome trace.")
         return
     
+    # Keep messages out of the ID list when it's written to stdout:
+    if args[1]=="-":
+        out=sys.stdout
+        log=sys.stderr
+    else:
+        out=open(args[1], "w")
+        log=sys.stdout
+    
     # TODO: add explicit term specification:
     # ie. for pro-seq, etc.
-    systemargs={"db": "gds", "term": "gro-seq", "retmax": 100000}
-    paramlist=urllib.urlencode(systemargs)
-    
-    print("Making search request...")
-    urlFile=urllib.urlopen("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi", paramlist)
+    systemargs={"db": "gds", "term": "gro-seq"}
     
-    print("Fetching data...")
-    searchTree=ETree.parse(urlFile)
-    urlFile.close()
+    log.write("Making search request...\n")
+    numFound=0
+    for page in iterSearchPages(getClient(), systemargs):
+        out.write("".join(["%s\n" % i for i in page]))
+        out.flush()
+        numFound+=len(page)
     
-    out=open(args[1], "w")
-    
-    root=searchTree.getroot()
-    for c in root:
-        if c.tag=="Count":
-            print("Number of elements found: %s" % c.text)
-            
-        elif c.tag=="IdList":
-            for idElem in c:
-                out.write("%s\n" % idElem.text)
+    log.write("Number of elements found: %d\n" % numFound)
     
-    out.close()
-    print("Done.")
+    if out is not sys.stdout:
+        out.close()
+    log.write("Done.\n")
             
 if __name__=="__main__":
-    main(sys.argv)
\ No newline at end of file
+    instrument.run(main, sys.argv)
\ No newline at end of file
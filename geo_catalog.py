@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# geo_catalog.py -- A lazily loaded view of the elements in a metadata database.
+#
+# Nothing is read from the database until a command asks for it. ID lists come out of the
+# persistent ID sets in geo_index.py, so neither listing a protocol nor filtering it down to
+# series entries requires reading anything per element.
+#
+# The catalog is also the library interface to a database. Its queries return the ResultSet and
+# Element objects of geo_results.py, and query_groseq_database.py only prints them:
+#   catalog=GeoCatalog("db", seriesOnly=True)
+#   for e in catalog.findSpecies("Homo sapiens").filter(lambda e: e.get("year")>=2015):
+#       print(e.idNum, e.get("title"))
+# Every query honors the protocols and series-only setting the catalog was made with.
+
+import os
+import bisect
+from array import array
+from geo_store import openStore, splitContribName
+from geo_index import isSeriesBit
+from geo_select import parseFilter, SelectPlan
+from geo_results import Element, ResultSet
+from geo_snapshot import SnapshotStore
+from display_table import getDisplayTable
+from id_sets import intersectSets, unionSets, diffSets, overlapMatrix, readIdFile
+from miniml import getSeriesInfo, getSeriesContribName
+from instrument import phase
+
+
+class GeoCatalog(object):
+    def __init__(self, basedir, protocolSet=None, seriesOnly=False, shared=None, snapshot=None):
+        self.basedir=basedir
+        self.seriesOnly=seriesOnly
+        self.protocolSet=protocolSet
+        # A catalog made from a shared one uses the store and whatever has been loaded by that catalog,
+        # which stays open after this one is closed. One read from a snapshot file uses neither:
+        self.shared=shared if snapshot is None else None
+        if snapshot is not None:
+            self.store=SnapshotStore(snapshot, basedir)
+            self.idSets={}
+            self.idsByProto={}
+        elif shared is None:
+            self.store=openStore(basedir)
+            self.idSets={}
+            self.idsByProto={}
+        else:
+            self.store=shared.store
+            self.idSets=shared.idSets
+            if protocolSet is None:
+                self.protocolSet=list(shared.getProtocols())
+            self.idsByProto=shared.idsByProto if seriesOnly==shared.seriesOnly else {}
+
+        # This is filled in when it's requested:
+        self.pathlist=None
+
+    def getProtocols(self):
+        if self.protocolSet is None:
+            with phase("catalog load"):
+                self.protocolSet=self.store.listProtocols()
+        return self.protocolSet
+
+    def getIdSet(self, protocol):
+        """Returns the sorted array of integer IDs for a protocol along with its series bitmap."""
+        if protocol not in self.idSets:
+            with phase("catalog load"):
+                self.idSets[protocol]=self.store.getIndex().getIdSet(self.store, protocol)
+        return self.idSets[protocol]
+
+    def getIdArray(self, protocol):
+        """Returns the sorted array('I') of a protocol's IDs, honoring the series-only setting."""
+        ids, seriesBits=self.getIdSet(protocol)
+        if not self.seriesOnly:
+            return ids
+        return array('I', [ids[i] for i in range(len(ids)) if (seriesBits[i>>3]>>(i&7))&1==1])
+
+    def getIds(self, protocol):
+        """Returns the IDs of a protocol as strings, honoring the series-only setting."""
+        if protocol not in self.idsByProto:
+            ids, seriesBits=self.getIdSet(protocol)
+            if self.seriesOnly:
+                self.idsByProto[protocol]=[str(ids[i]) for i in range(len(ids)) if (seriesBits[i>>3]>>(i&7))&1==1]
+            else:
+                self.idsByProto[protocol]=[str(i) for i in ids]
+        return self.idsByProto[protocol]
+
+    def getIdsByProto(self):
+        return dict([(p, self.getIds(p)) for p in self.getProtocols()])
+
+    def getPathList(self):
+        if self.pathlist is None:
+            with phase("catalog load"):
+                self.pathlist=[]
+                for p in self.getProtocols():
+                    self.pathlist.extend([os.path.join(self.basedir, p, i) for i in self.getIds(p)])
+        return self.pathlist
+
+    def isSeries(self, protocol, idNum):
+        ids, seriesBits=self.getIdSet(protocol)
+        return isSeriesBit(ids, seriesBits, int(idNum))
+
+    def getDisplayTable(self):
+        """Returns the table the names and titles of elements are shown from. A snapshot holds its own."""
+        if isinstance(self.store, SnapshotStore):
+            return self.store
+        return getDisplayTable(self.store)
+
+    def holds(self, protocol, idNum):
+        """Checks whether a protocol has an element with an ID, honoring the series-only setting."""
+        ids, seriesBits=self.getIdSet(protocol)
+        i=bisect.bisect_left(ids, int(idNum))
+        if i==len(ids) or ids[i]!=int(idNum):
+            return False
+        return not self.seriesOnly or (seriesBits[i>>3]>>(i&7))&1==1
+
+    def findProtocol(self, idNum, protocols=None):
+        """Returns the first protocol holding an ID, or None."""
+        for p in (protocols if protocols is not None else self.getProtocols()):
+            if self.holds(p, idNum):
+                return p
+        return None
+
+    def getKeys(self):
+        """Returns the (protocol, id) of every element, ordered by protocol and then ID."""
+        keys=[]
+        for p in self.getProtocols():
+            keys.extend([(p, i) for i in self.getIds(p)])
+        return keys
+
+    def getElements(self):
+        return ResultSet(self, self.getKeys)
+
+    def getElement(self, idNum):
+        """Returns the element with an ID, from the first protocol holding it, or None if there isn't one."""
+        p=self.store.findProto(str(idNum), self.getProtocols())
+        if p is None:
+            return None
+        return Element(self, p, str(idNum))
+
+    def findByShorthand(self, name):
+        """Returns the first element whose paper's shorthand name, ie. Lis2016, is name ignoring case."""
+        name=name.strip().upper()
+        for p, i in self.getKeys():
+            path=os.path.join(self.basedir, p, i)
+            contribName=self.store.getContribName(path)
+            if contribName is None and os.path.exists(os.path.join(path, "matrices")):
+                contribName=getSeriesContribName(getSeriesInfo(path))
+            if contribName is not None and contribName.strip().upper()==name:
+                return Element(self, p, i)
+        return None
+
+    def fromIds(self, ids):
+        """Returns the elements with the given IDs, in the same order. IDs not in the catalog are left out."""
+        def find():
+            found=[(self.findProtocol(idNum), idNum) for idNum in ids]
+            return [(p, idNum) for p, idNum in found if p is not None]
+        return ResultSet(self, find)
+
+    def loadQuery(self, path):
+        """Returns the elements in a query file, ie. .lastquery. Raises ValueError if a text query file
+        holds something other than IDs."""
+        return self.fromIds(readIdFile(path))
+
+    def getProtocol(self, protocol):
+        if protocol not in self.getProtocols():
+            raise KeyError(protocol)
+        return ResultSet(self, lambda: [(protocol, i) for i in self.getIds(protocol)])
+
+    def findSpecies(self, speciesName):
+        """Returns the elements naming a species, ignoring case."""
+        index=self.store.getIndex()
+        index.ensureTaxa(self.store)
+        return ResultSet(self, lambda: index.findTaxon(speciesName, self.getProtocols(), self.seriesOnly))
+
+    def countSpecies(self):
+        """Returns a dictionary of species name -> number of elements naming it."""
+        index=self.store.getIndex()
+        index.ensureTaxa(self.store)
+        return index.countTaxa(self.getProtocols(), self.seriesOnly)
+
+    def findAccessions(self, accessionList):
+        """Returns the elements with the given GEO accessions, in the order they're given."""
+        index=self.store.getIndex()
+        index.ensureAccessions(self.store)
+        def find():
+            found=index.findAccessions(accessionList, self.getProtocols())
+            keys=[]
+            for a in accessionList:
+                keys.extend([(p, i) for p, i in found.get(a, []) if not self.seriesOnly or self.isSeries(p, i)])
+            return keys
+        return ResultSet(self, find)
+
+    def planSelect(self, query):
+        """Parses a select filter, given as a string or a list of command line arguments, and plans it.
+        Raises ValueError if it can't be parsed."""
+        if isinstance(query, basestring):
+            query=[query]
+        return SelectPlan(parseFilter(query), self)
+
+    def select(self, query):
+        """Returns the elements matching a select filter, ie. 'species="Homo sapiens" and year>=2015', or
+        a plan from planSelect()."""
+        if not isinstance(query, SelectPlan):
+            query=self.planSelect(query)
+        return ResultSet(self, query.iterMatches)
+
+    def search(self, query):
+        """Returns the elements whose title or summary matches a full text search, best matches first.
+        Raises IOError if SQLite can't search text, or ValueError if the query is malformed."""
+        index=self.store.getIndex()
+        def find():
+            index.ensureFullText(self.store)
+            found=index.searchFullText(query, self.getProtocols())
+            return [(p, i) for p, i in found if not self.seriesOnly or self.isSeries(p, i)]
+        return ResultSet(self, find)
+
+    def matchShorthand(self, test):
+        """Returns the elements with a shorthand name for which test(contributor, year) is true."""
+        def find():
+            keys=[]
+            for p, i in self.getKeys():
+                # Only elements whose name has been cached are considered.
+                contribName=self.store.getContribName(os.path.join(self.basedir, p, i))
+                if contribName is not None and test(*splitContribName(contribName)):
+                    keys.append((p, i))
+            return keys
+        return ResultSet(self, find)
+
+    def getByYear(self, year):
+        """Returns the elements whose paper was published in year."""
+        return self.matchShorthand(lambda contrib, y: y==str(year))
+
+    def getByContributor(self, contribName):
+        """Returns the elements whose paper's first contributor is contribName, ignoring case."""
+        return self.matchShorthand(lambda contrib, y: contrib.upper()==contribName.upper())
+
+    def countShorthand(self, part):
+        """Returns a dictionary of contributor (part 0) or year (part 1) -> number of elements."""
+        counts={}
+        with phase("filtering"):
+            for p, i in self.getKeys():
+                contribName=self.store.getContribName(os.path.join(self.basedir, p, i))
+                if contribName is not None:
+                    val=splitContribName(contribName)[part]
+                    # Filled in with update() as it always has been, which decides the order ties are listed in:
+                    if val not in counts:
+                        counts.update({val: 1})
+                    else:
+                        counts[val]+=1
+        return counts
+
+    def countContributors(self):
+        return self.countShorthand(0)
+
+    def countYears(self):
+        return self.countShorthand(1)
+
+    def getWithMatrices(self):
+        """Returns the elements whose series matrices have been fetched."""
+        return ResultSet(self, lambda: [(p, i) for p, i in self.getKeys()
+                                         if os.path.exists(os.path.join(self.basedir, p, i, "matrices"))])
+
+    def getWithSraLists(self):
+        """Returns the elements whose run files have been found by getsralist, ready to be downloaded."""
+        return ResultSet(self, lambda: [(p, i) for p, i in self.getKeys()
+                                         if os.path.exists(os.path.join(self.basedir, p, i, "%s.sralist" % i))])
+
+    def getOverlapMatrix(self):
+        """Returns a matrix m where m[i][j] is the number of elements protocols i and j share."""
+        return overlapMatrix([self.getIdArray(p) for p in self.getProtocols()])
+
+    def combineProtocols(self, operation, protocols):
+        """Combines the elements of several protocols by ID. operation is one of intersect, union or diff,
+        which removes the later protocols from the first. Each element is given under the first of the
+        protocols holding it."""
+        for p in protocols:
+            if p not in self.getProtocols():
+                raise KeyError(p)
+        def combine():
+            sets=[self.getIdArray(p) for p in protocols]
+            if operation=="intersect":
+                found=intersectSets(sets)
+            elif operation=="union":
+                found=unionSets(sets)
+            elif operation=="diff" and len(sets)>0:
+                found=diffSets(sets[0], sets[1:])
+            else:
+                raise ValueError("Can't %s protocols" % operation)
+            return [(self.findProtocol(idNum, protocols), idNum) for idNum in found]
+        return ResultSet(self, combine)
+
+    def close(self):
+        if self.shared is None:
+            self.store.close()
+        else:
+            # Whatever was written goes out now, rather than holding the database locked:
+            self.store.commit()
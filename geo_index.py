@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# geo_index.py -- Persistent lookup indexes for the metadata database.
+#
+# The indexes live in SQLite tables. A GeoStore keeps them in its own file, while a directory tree
+# database keeps them in dbdir/.geoindex.sqlite. Every index is built once from the store the first
+# time it's needed and is then kept up to date by the store as make_groseq_database.py adds elements.
+
+import re
+import sqlite3
+import bisect
+from array import array
+from instrument import phase
+
+
+INDEX_NAME=".geoindex.sqlite"
+
+# Full text search ranks matches in titles this many times higher than matches in summaries:
+TITLE_WEIGHT=5.0
+
+
+def splitTaxon(taxon):
+    """Returns the individual species named in a taxon field. Some series list more than one."""
+    return [t.strip() for t in taxon.split(';') if len(t.strip())>0]
+
+
+class GeoIndex(object):
+    schema=[
+        """CREATE TABLE IF NOT EXISTS indexinfo (
+            name TEXT PRIMARY KEY,
+            built INTEGER NOT NULL)""",
+        # One row for every species named by every element:
+        """CREATE TABLE IF NOT EXISTS taxa (
+            taxon TEXT NOT NULL,
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            series INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS taxa_taxon ON taxa(taxon COLLATE NOCASE, protocol)",
+        "CREATE INDEX IF NOT EXISTS taxa_entry ON taxa(protocol, id)",
+        # The GEO accession (GSE/GDS) of every element. The same accession may appear under several protocols:
+        """CREATE TABLE IF NOT EXISTS accessions (
+            accession TEXT NOT NULL,
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            PRIMARY KEY (accession, protocol, id))""",
+        "CREATE INDEX IF NOT EXISTS accessions_entry ON accessions(protocol, id)",
+        # The full set of IDs for every protocol, kept as a sorted array('I') along with a bitmap
+        # holding one bit per ID that is set for series (GSE) entries. The stamp records the state
+        # of the protocol in the store when the set was last brought up to date.
+        """CREATE TABLE IF NOT EXISTS idsets (
+            protocol TEXT PRIMARY KEY,
+            stamp REAL,
+            ids BLOB NOT NULL,
+            series BLOB NOT NULL)""",
+        # The row holding each element in the full text table, so that it can be replaced without a scan:
+        """CREATE TABLE IF NOT EXISTS fulltextrows (
+            row INTEGER PRIMARY KEY,
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            UNIQUE (protocol, id))""",
+        # Runs found for SRA experiments, so that each experiment only has to be looked up once:
+        """CREATE TABLE IF NOT EXISTS sraruns (
+            srx TEXT NOT NULL,
+            srr TEXT NOT NULL,
+            PRIMARY KEY (srx, srr))""",
+        # The date (yyyy/mm/dd) on which each protocol was last brought fully up to date with GEO:
+        """CREATE TABLE IF NOT EXISTS refreshes (
+            protocol TEXT PRIMARY KEY,
+            date TEXT NOT NULL)"""
+    ]
+
+    def __init__(self, conn):
+        self.conn=conn
+        for s in self.schema:
+            self.conn.execute(s)
+
+        # ID set changes are gathered here and written out all at once by flushIdSets():
+        self.pendingIds={}
+
+    def isBuilt(self, name):
+        row=self.conn.execute("SELECT built FROM indexinfo WHERE name=?", (name,)).fetchone()
+        return row is not None and row[0]==1
+
+    def setBuilt(self, name, built=True):
+        self.conn.execute("INSERT OR REPLACE INTO indexinfo VALUES (?, ?)", (name, 1 if built else 0))
+
+    def buildTaxa(self, store):
+        """(Re)builds the taxon index from every element in the store."""
+        self.conn.execute("DELETE FROM taxa")
+        for p in store.listProtocols():
+            for i in store.listIds(p):
+                path=store.entryPath(p, i)
+                try:
+                    self.addTaxa(p, i, store.getTaxon(path), store.getType(path))
+                except IOError:
+                    # Elements whose metadata was never fetched have nothing to index.
+                    pass
+        self.setBuilt("taxa")
+        self.conn.commit()
+
+    def ensureTaxa(self, store):
+        if not self.isBuilt("taxa"):
+            with phase("indexing"):
+                self.buildTaxa(store)
+
+    def addTaxa(self, protocol, idNum, taxon, entryType):
+        self.conn.execute("DELETE FROM taxa WHERE protocol=? AND id=?", (protocol, idNum))
+        series=1 if entryType.strip()=="GSE" else 0
+        self.conn.executemany("INSERT INTO taxa VALUES (?, ?, ?, ?)",
+                              [(t, protocol, idNum, series) for t in splitTaxon(taxon)])
+
+    def findTaxon(self, speciesName, protocolSet, seriesOnly):
+        """Returns a list of (protocol, id) naming the given species, ordered by protocol then id."""
+        if len(protocolSet)==0:
+            return []
+        query="SELECT DISTINCT protocol, id FROM taxa WHERE taxon=? COLLATE NOCASE AND protocol IN (%s)" % ",".join(["?"]*len(protocolSet))
+        if seriesOnly:
+            query+=" AND series=1"
+        # IDs are stored as text, so they have to be compared as numbers to sort properly:
+        query+=" ORDER BY protocol, CAST(id AS INTEGER)"
+
+        with phase("filtering"):
+            return self.conn.execute(query, [speciesName.strip()]+list(protocolSet)).fetchall()
+
+    def countTaxa(self, protocolSet, seriesOnly):
+        """Returns a dictionary of species name -> number of elements naming that species."""
+        query="SELECT taxon, count(*) FROM taxa WHERE protocol=?"
+        if seriesOnly:
+            query+=" AND series=1"
+        query+=" GROUP BY taxon"
+
+        counts={}
+        with phase("filtering"):
+            for p in protocolSet:
+                for taxon, count in self.conn.execute(query, (p,)):
+                    counts[taxon]=counts.get(taxon, 0)+count
+        return counts
+
+    def buildAccessions(self, store):
+        """(Re)builds the accession index from every element in the store."""
+        self.conn.execute("DELETE FROM accessions")
+        for p in store.listProtocols():
+            for i in store.listIds(p):
+                try:
+                    self.addAccession(p, i, store.getAccession(store.entryPath(p, i)))
+                except IOError:
+                    pass
+        self.setBuilt("accessions")
+        self.conn.commit()
+
+    def ensureAccessions(self, store):
+        if not self.isBuilt("accessions"):
+            with phase("indexing"):
+                self.buildAccessions(store)
+
+    def addAccession(self, protocol, idNum, accession):
+        self.conn.execute("DELETE FROM accessions WHERE protocol=? AND id=?", (protocol, idNum))
+        if accession is not None and len(accession.strip())>0:
+            self.conn.execute("INSERT OR REPLACE INTO accessions VALUES (?, ?, ?)", (accession.strip(), protocol, idNum))
+
+    def findAccessions(self, accessionList, protocolSet):
+        """Returns a dictionary of accession -> list of (protocol, id) for every accession found in one
+        of the given protocols. Entries are listed in the order of protocolSet, then by id."""
+        order=dict([(protocolSet[i], i) for i in range(len(protocolSet))])
+        found={}
+        for a in accessionList:
+            if a in found:
+                continue
+            rows=self.conn.execute("SELECT protocol, id FROM accessions WHERE accession=?", (a.strip(),)).fetchall()
+            rows=[r for r in rows if r[0] in order]
+            if len(rows)>0:
+                found[a]=sorted(rows, key=lambda r: (order[r[0]], r[1]))
+        return found
+
+    def createFullText(self):
+        # The full text index needs SQLite's FTS5 extension, which isn't compiled into every build,
+        # so it is only created once something asks for it.
+        try:
+            self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(
+                title, summary, protocol UNINDEXED, id UNINDEXED)""")
+        except sqlite3.OperationalError as e:
+            raise IOError("Full text search needs SQLite with FTS5 support: %s" % e)
+
+    def buildFullText(self, store):
+        """(Re)builds the full text index of titles and summaries from every element in the store."""
+        self.createFullText()
+        self.conn.execute("DELETE FROM fulltext")
+        self.conn.execute("DELETE FROM fulltextrows")
+        for p in store.listProtocols():
+            for i in store.listIds(p):
+                try:
+                    title, summary=store.getSearchText(store.entryPath(p, i))
+                except IOError:
+                    continue
+                self.addFullText(p, i, title, summary)
+        self.setBuilt("fulltext")
+        self.conn.commit()
+
+    def ensureFullText(self, store):
+        if not self.isBuilt("fulltext"):
+            with phase("indexing"):
+                self.buildFullText(store)
+
+    def addFullText(self, protocol, idNum, title, summary):
+        # The protocol and id columns of the full text table can't be searched without a scan, so an
+        # element's old row is found through fulltextrows instead:
+        found=self.conn.execute("SELECT row FROM fulltextrows WHERE protocol=? AND id=?", (protocol, idNum)).fetchone()
+        if found is None:
+            row=self.conn.execute("INSERT INTO fulltextrows (protocol, id) VALUES (?, ?)", (protocol, idNum)).lastrowid
+        else:
+            row=found[0]
+            self.conn.execute("DELETE FROM fulltext WHERE rowid=?", (row,))
+        self.conn.execute("INSERT INTO fulltext (rowid, title, summary, protocol, id) VALUES (?, ?, ?, ?, ?)",
+                          (row, title, summary, protocol, idNum))
+
+    def searchFullText(self, query, protocolSet):
+        """Returns a list of (protocol, id) whose title or summary matches query, best matches first."""
+        wanted=set(protocolSet)
+        try:
+            rows=self.conn.execute("SELECT protocol, id FROM fulltext WHERE fulltext MATCH ? ORDER BY bm25(fulltext, ?, 1.0)",
+                                   (toFullTextQuery(query), TITLE_WEIGHT)).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError("Can't search for %s: %s" % (query, e))
+        return [r for r in rows if r[0] in wanted]
+
+    def loadIdSet(self, protocol):
+        """Returns (stamp, ids, seriesBits) for a protocol, or None if no set has been built."""
+        row=self.conn.execute("SELECT stamp, ids, series FROM idsets WHERE protocol=?", (protocol,)).fetchone()
+        if row is None:
+            return None
+
+        ids=array('I')
+        ids.fromstring(str(row[1]))
+        return (row[0], ids, bytearray(str(row[2])))
+
+    def saveIdSet(self, protocol, stamp, ids, seriesBits):
+        self.conn.execute("INSERT OR REPLACE INTO idsets VALUES (?, ?, ?, ?)",
+                          (protocol, stamp, buffer(ids.tostring()), buffer(str(seriesBits))))
+
+    def buildIdSet(self, store, protocol):
+        """Reads every ID of a protocol from the store. This is the only place types are read one by one."""
+        stamp=store.getStamp(protocol)
+        seriesIds=set(store.listIds(protocol, True))
+        ids=array('I', sorted([int(i) for i in store.listIds(protocol) if i.isdigit()]))
+        seriesBits=bytearray((len(ids)+7)/8)
+
+        for i in range(len(ids)):
+            if str(ids[i]) in seriesIds:
+                seriesBits[i>>3]|=1<<(i&7)
+
+        self.saveIdSet(protocol, stamp, ids, seriesBits)
+        self.conn.commit()
+        return (ids, seriesBits)
+
+    def getIdSet(self, store, protocol):
+        """Returns (ids, seriesBits) for a protocol, rebuilding the set only if the protocol changed."""
+        loaded=self.loadIdSet(protocol)
+        if loaded is None or loaded[0]!=store.getStamp(protocol):
+            with phase("indexing"):
+                return self.buildIdSet(store, protocol)
+        return (loaded[1], loaded[2])
+
+    def addToIdSet(self, protocol, idNum, entryType):
+        if idNum.isdigit():
+            self.pendingIds.setdefault(protocol, {})[int(idNum)]=(entryType.strip()=="GSE")
+
+    def flushIdSets(self, store):
+        """Merges pending additions into every ID set that has already been built."""
+        for protocol, added in self.pendingIds.items():
+            loaded=self.loadIdSet(protocol)
+            if loaded is None:
+                # The set will be built from scratch the first time it's needed.
+                continue
+
+            stamp, ids, seriesBits=loaded
+            series=dict([(ids[i], (seriesBits[i>>3]>>(i&7))&1==1) for i in range(len(ids))])
+            series.update(added)
+
+            ids=array('I', sorted(series.keys()))
+            seriesBits=bytearray((len(ids)+7)/8)
+            for i in range(len(ids)):
+                if series[ids[i]]:
+                    seriesBits[i>>3]|=1<<(i&7)
+
+            self.saveIdSet(protocol, store.getStamp(protocol), ids, seriesBits)
+        self.pendingIds={}
+
+    def getSraRuns(self, srxList):
+        """Returns a dictionary of experiment -> list of runs for every experiment already looked up."""
+        runs={}
+        for srx in srxList:
+            srrs=[r[0] for r in self.conn.execute("SELECT srr FROM sraruns WHERE srx=? ORDER BY srr", (srx,))]
+            if len(srrs)>0:
+                runs[srx]=srrs
+        return runs
+
+    def addSraRuns(self, srx, srrs):
+        self.conn.executemany("INSERT OR IGNORE INTO sraruns VALUES (?, ?)", [(srx, r) for r in srrs])
+
+    def getRefreshDate(self, protocol):
+        row=self.conn.execute("SELECT date FROM refreshes WHERE protocol=?", (protocol,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def setRefreshDate(self, protocol, date):
+        self.conn.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?)", (protocol, date))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def toFullTextQuery(query):
+    """Turns a search as typed by the user into an FTS5 query. Words and "quoted phrases" must all match,
+    unless they're joined with OR or excluded with NOT. A word ending in * matches any word it begins."""
+    terms=[]
+    for m in re.finditer(r'"([^"]*)"|(\S+)', query):
+        if m.group(1) is not None:
+            if len(m.group(1).strip())>0:
+                terms.append('"%s"' % m.group(1))
+        elif m.group(2) in ["AND", "OR", "NOT"]:
+            terms.append(m.group(2))
+        else:
+            word=m.group(2).replace('"', '')
+            if word.endswith('*') and len(word)>1:
+                terms.append('"%s"*' % word.rstrip('*'))
+            elif len(word.strip('*'))>0:
+                terms.append('"%s"' % word)
+    return " ".join(terms)
+
+
+def isSeriesBit(ids, seriesBits, idNum):
+    """Looks up the series bit of an ID in a set returned by GeoIndex.getIdSet()."""
+    i=bisect.bisect_left(ids, idNum)
+    if i==len(ids) or ids[i]!=idNum:
+        return False
+    return (seriesBits[i>>3]>>(i&7))&1==1
+
+
+def openIndex(path):
+    conn=sqlite3.connect(path)
+    conn.text_factory=str
+    return GeoIndex(conn)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# geo_results.py -- The elements and result sets returned by GeoCatalog's queries.
+#
+# A ResultSet holds the query that produces it and only runs it once its contents are first needed,
+# ie. by len() or by iterating over it. Its elements are Element objects, which are made one at a time
+# as they're reached and read each of their fields from the store the first time it's asked for, so
+# a result that is only counted or saved never reads anything per element.
+#
+# Fields are read with get() under the names used by select filters, and have the same types:
+#   protocol type species accession title summary contributor (str), id year (int)
+# species is a list, since some series name several. Fields that can't be read are None.
+
+import os
+from geo_select import Row, FLAGS
+from id_sets import writeIdFile
+from display_table import getDisplayName
+from miniml import getSeriesInfo
+from instrument import phase
+
+
+def readSraList(path):
+    """Returns (url, md5) for every line of a .sralist file. The MD5 sum is an optional second column."""
+    entries=[]
+    with open(path, "r") as f:
+        for l in f.read().splitlines():
+            lToks=l.split()
+            if len(lToks)>0:
+                entries.append((lToks[0], lToks[1] if len(lToks)>1 else None))
+    return entries
+
+
+class Element(Row):
+    """One element of a catalog."""
+
+    def __init__(self, catalog, protocol, idNum):
+        Row.__init__(self, catalog.store, protocol, idNum, catalog.isSeries(protocol, idNum))
+        self.catalog=catalog
+        # Paths are given relative to the catalog's directory, just as it was named:
+        self.path=os.path.join(catalog.basedir, protocol, idNum)
+
+    def __repr__(self):
+        return "<Element %s/%s>" % (self.protocol, self.idNum)
+
+    def has(self, flag):
+        """Checks one of the flags select filters test with has:<flag>, ie. matrices or sralist."""
+        return FLAGS[flag][0](self)
+
+    def getDisplay(self):
+        """Returns the (shorthand name, title) shown for the element, with "" for a missing name."""
+        # Everything shown is normally precomputed in the display table:
+        row=self.catalog.getDisplayTable().lookup(self.protocol, self.idNum)
+        if row is not None:
+            return row
+        return (getDisplayName(self.store, self.path), self.store.getTitle(self.path))
+
+    def getShorthand(self):
+        """Returns the cached shorthand name of the paper, ie. Lis2016, or None if there isn't one."""
+        return self.store.getContribName(self.path)
+
+    def getSummaryText(self):
+        """Returns the summary as stored by make_groseq_database.py, with every field on its own line."""
+        return self.store.getSummary(self.path)
+
+    def getMatrixUrl(self):
+        return self.store.getMatrixUrl(self.path)
+
+    def getSamples(self):
+        """Returns the samples listed in the element's series matrices, which must have been fetched."""
+        return getSeriesInfo(self.path)["samples"]
+
+    def getSraListPath(self):
+        return os.path.join(self.path, "%s.sralist" % self.idNum)
+
+    def getSraList(self):
+        """Returns (url, md5) for every run file found by getsralist, or [] if it hasn't been run."""
+        if not self.has("sralist"):
+            return []
+        return readSraList(self.getSraListPath())
+
+
+class ResultSet(object):
+    """An ordered set of elements from a catalog, made from a function returning their (protocol, id)."""
+
+    def __init__(self, catalog, source):
+        self.catalog=catalog
+        self.source=source
+        self.found=None
+
+    def getKeys(self):
+        """Runs the query if it hasn't been yet, and returns the (protocol, id) of every element."""
+        if self.found is None:
+            with phase("filtering"):
+                self.found=[(p, str(i)) for p, i in self.source()]
+            self.source=None
+        return self.found
+
+    def __len__(self):
+        return len(self.getKeys())
+
+    def __iter__(self):
+        for p, i in self.getKeys():
+            yield Element(self.catalog, p, i)
+
+    def __getitem__(self, i):
+        p, idNum=self.getKeys()[i]
+        return Element(self.catalog, p, idNum)
+
+    def getIds(self):
+        return [int(i) for p, i in self.getKeys()]
+
+    def getPaths(self):
+        return [os.path.join(self.catalog.basedir, p, i) for p, i in self.getKeys()]
+
+    def filter(self, predicate):
+        """Returns the elements for which predicate(element) is true, as a new result set."""
+        return ResultSet(self.catalog, lambda: [(e.protocol, e.idNum) for e in self if predicate(e)])
+
+    def union(self, other):
+        """Returns the elements of this set followed by those only found in other."""
+        def combine():
+            seen=set(self.getKeys())
+            return self.getKeys()+[k for k in other.getKeys() if k not in seen]
+        return ResultSet(self.catalog, combine)
+
+    def intersection(self, other):
+        def combine():
+            wanted=set(other.getKeys())
+            return [k for k in self.getKeys() if k in wanted]
+        return ResultSet(self.catalog, combine)
+
+    def difference(self, other):
+        def combine():
+            unwanted=set(other.getKeys())
+            return [k for k in self.getKeys() if k not in unwanted]
+        return ResultSet(self.catalog, combine)
+
+    def save(self, f):
+        """Writes the IDs to an open file as a query file, which -lq and the qf commands can read. The IDs
+        keep their order, so the file of a search lists the best matches first."""
+        with phase("writing results"):
+            writeIdFile(f, self.getIds(), True)
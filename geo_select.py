@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# geo_select.py -- The filter language used by the select command.
+#
+# A filter is a predicate over the fields of an element, ie.
+#   species="Homo sapiens" and year>=2015 and has:sralist and protocol in (gro-seq,pro-seq)
+# It is parsed into a tree of conditions and then planned: conditions on the protocol, ID, species or
+# entry type that every result must meet are answered from the indexes in geo_index.py, and the rest
+# are checked in one pass over the remaining candidates, cheapest first. However many conditions use
+# a field, it is read at most once per element.
+
+import os
+import re
+import bisect
+from geo_store import parseSummary, splitContribName, encodeText
+from geo_index import splitTaxon
+
+
+TOKEN_RE=re.compile(r'\s*(?:"([^"]*)"|\'([^\']*)\'|(>=|<=|!=|=|<|>|~|\(|\)|,)|([^\s()=<>!~,"\']+))')
+
+KEYWORDS=["and", "or", "not", "in"]
+
+
+def readNameCache(row):
+    name=row.store.getContribName(row.path)
+    if name is None:
+        return None
+    return splitContribName(name)
+
+
+def readYear(row):
+    name=row.get("namecache")
+    if name is None or not name[1].isdigit():
+        return None
+    return int(name[1])
+
+
+def readType(row):
+    # Series are marked in the ID set, so only other entries need their type read:
+    if row.series:
+        return "GSE"
+    return row.store.getType(row.path).strip()
+
+
+# Field name -> (function reading it from a row, relative cost of doing so, type of its values):
+FIELDS={
+    "protocol": (lambda row: row.protocol, 0, str),
+    "id": (lambda row: int(row.idNum), 0, int),
+    "type": (readType, 1, str),
+    "species": (lambda row: splitTaxon(row.store.getTaxon(row.path)), 2, str),
+    "accession": (lambda row: row.store.getAccession(row.path).strip(), 2, str),
+    "title": (lambda row: row.store.getTitle(row.path), 2, str),
+    "summary": (lambda row: parseSummary(row.store.getSummary(row.path))["summary"], 3, str),
+    "namecache": (readNameCache, 2, None),
+    "contributor": (lambda row: row.get("namecache")[0] if row.get("namecache") is not None else None, 2, str),
+    "year": (readYear, 2, int),
+}
+
+ALIASES={"taxon": "species", "contrib": "contributor"}
+
+# Flags tested with has:<flag>, along with their costs:
+FLAGS={
+    "matrices": (lambda row: os.path.exists(os.path.join(row.path, "matrices")), 1),
+    "sralist": (lambda row: os.path.exists(os.path.join(row.path, "%s.sralist" % row.idNum)), 1),
+    "data": (lambda row: os.path.exists(os.path.join(row.path, "data")), 1),
+    "matrixurl": (lambda row: row.store.getMatrixUrl(row.path) is not None, 2),
+    "contrib": (lambda row: row.get("namecache") is not None, 2),
+}
+
+
+class Row(object):
+    """A candidate element. Each field is read from the store the first time it's asked for."""
+
+    def __init__(self, store, protocol, idNum, series):
+        self.store=store
+        self.protocol=protocol
+        self.idNum=idNum
+        self.path=store.entryPath(protocol, idNum)
+        self.series=series
+        self.values={}
+
+    def get(self, field):
+        if field not in self.values:
+            try:
+                self.values[field]=FIELDS[field][0](self)
+            except IOError:
+                # Elements whose metadata was never fetched simply don't match.
+                self.values[field]=None
+        return self.values[field]
+
+
+def compareValue(value, op, target):
+    if isinstance(value, basestring):
+        value=encodeText(value).upper()
+    if op=="=":
+        return value==target
+    elif op=="<":
+        return value<target
+    elif op=="<=":
+        return value<=target
+    elif op==">":
+        return value>target
+    elif op==">=":
+        return value>=target
+    return target in value
+
+
+class Cond(object):
+    """Compares a field against one or more values. Text comparisons ignore case."""
+
+    def __init__(self, field, op, values):
+        self.field=field
+        self.op=op
+        self.values=values
+        self.cost=FIELDS[field][1]
+
+    def evaluate(self, row):
+        value=row.get(self.field)
+        if value is None:
+            return False
+        if self.op=="!=":
+            return not self.matches(value, "=")
+        return self.matches(value, "=" if self.op=="in" else self.op)
+
+    def matches(self, value, op):
+        # Species may hold several names, any one of which can match:
+        values=value if isinstance(value, list) else [value]
+        for v in values:
+            for t in self.values:
+                if compareValue(v, op, t):
+                    return True
+        return False
+
+    def describe(self):
+        if self.op=="in":
+            return "%s in (%s)" % (self.field, ",".join([str(v) for v in self.values]))
+        return "%s%s%s" % (self.field, self.op, self.values[0])
+
+
+class HasCond(object):
+    def __init__(self, flag):
+        self.flag=flag
+        self.cost=FLAGS[flag][1]
+
+    def evaluate(self, row):
+        key="has:"+self.flag
+        if key not in row.values:
+            row.values[key]=FLAGS[self.flag][0](row)
+        return row.values[key]
+
+    def describe(self):
+        return "has:%s" % self.flag
+
+
+class And(object):
+    def __init__(self, children):
+        # The cheapest conditions are checked first so that expensive ones are skipped when possible:
+        self.children=sorted(children, key=lambda c: c.cost)
+        self.cost=max([c.cost for c in children])
+
+    def evaluate(self, row):
+        for c in self.children:
+            if not c.evaluate(row):
+                return False
+        return True
+
+    def describe(self):
+        return "(%s)" % " and ".join([c.describe() for c in self.children])
+
+
+class Or(object):
+    def __init__(self, children):
+        self.children=sorted(children, key=lambda c: c.cost)
+        self.cost=max([c.cost for c in children])
+
+    def evaluate(self, row):
+        for c in self.children:
+            if c.evaluate(row):
+                return True
+        return False
+
+    def describe(self):
+        return "(%s)" % " or ".join([c.describe() for c in self.children])
+
+
+class Not(object):
+    def __init__(self, child):
+        self.child=child
+        self.cost=child.cost
+
+    def evaluate(self, row):
+        return not self.child.evaluate(row)
+
+    def describe(self):
+        return "not %s" % self.child.describe()
+
+
+def tokenize(text):
+    """Splits a filter into (kind, text) tokens, where kind is one of "value", "op" or "word"."""
+    tokens=[]
+    pos=0
+    text=text.strip()
+    while pos<len(text):
+        m=TOKEN_RE.match(text, pos)
+        if m is None or m.end()==pos:
+            raise ValueError("Can't make sense of the filter at: %s" % text[pos:])
+        if m.group(1) is not None or m.group(2) is not None:
+            tokens.append(("value", m.group(1) if m.group(1) is not None else m.group(2)))
+        elif m.group(3) is not None:
+            tokens.append(("op", m.group(3)))
+        else:
+            tokens.append(("word", m.group(4)))
+        pos=m.end()
+    return tokens
+
+
+class FilterParser(object):
+    """A recursive descent parser for the filter language. "not" binds tightest, then "and", then "or"."""
+
+    def __init__(self, tokens):
+        self.tokens=tokens
+        self.pos=0
+
+    def peek(self):
+        if self.pos<len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token=self.peek()
+        if token[0] is None:
+            raise ValueError("The filter ends too early.")
+        self.pos+=1
+        return token
+
+    def isKeyword(self, word):
+        kind, text=self.peek()
+        return kind=="word" and text.lower()==word
+
+    def parse(self):
+        tree=self.parseOr()
+        if self.pos<len(self.tokens):
+            raise ValueError("Unexpected %s in filter." % self.tokens[self.pos][1])
+        return tree
+
+    def parseOr(self):
+        children=[self.parseAnd()]
+        while self.isKeyword("or"):
+            self.pos+=1
+            children.append(self.parseAnd())
+        return children[0] if len(children)==1 else Or(children)
+
+    def parseAnd(self):
+        children=[self.parseNot()]
+        while self.isKeyword("and"):
+            self.pos+=1
+            children.append(self.parseNot())
+        return children[0] if len(children)==1 else And(children)
+
+    def parseNot(self):
+        if self.isKeyword("not"):
+            self.pos+=1
+            return Not(self.parseNot())
+        return self.parseAtom()
+
+    def parseAtom(self):
+        kind, text=self.next()
+        if kind=="op" and text=="(":
+            tree=self.parseOr()
+            if self.next()!=("op", ")"):
+                raise ValueError("Missing ) in filter.")
+            return tree
+
+        if kind!="word" or text.lower() in KEYWORDS:
+            raise ValueError("Expected a field name but found %s." % text)
+
+        if text.lower().startswith("has:"):
+            flag=text[4:].lower()
+            if flag not in FLAGS:
+                raise ValueError("Unknown flag has:%s. Flags are: %s" % (flag, ", ".join(sorted(FLAGS.keys()))))
+            return HasCond(flag)
+
+        field=ALIASES.get(text.lower(), text.lower())
+        if field not in FIELDS or FIELDS[field][2] is None:
+            raise ValueError("Unknown field %s. Fields are: %s" %
+                             (text, ", ".join(sorted([f for f in FIELDS if FIELDS[f][2] is not None]))))
+
+        if self.isKeyword("in"):
+            self.pos+=1
+            if self.next()!=("op", "("):
+                raise ValueError("Expected ( after %s in." % text)
+            values=[self.parseValue(field)]
+            while self.peek()==("op", ","):
+                self.pos+=1
+                values.append(self.parseValue(field))
+            if self.next()!=("op", ")"):
+                raise ValueError("Missing ) after the values for %s." % text)
+            return Cond(field, "in", values)
+
+        kind, op=self.next()
+        if kind!="op" or op in ["(", ")", ","]:
+            raise ValueError("Expected a comparison after %s but found %s." % (text, op))
+        if op=="~" and FIELDS[field][2] is int:
+            raise ValueError("%s can't be searched with ~." % text)
+        return Cond(field, op, [self.parseValue(field)])
+
+    def parseValue(self, field):
+        kind, text=self.next()
+        if kind=="op":
+            raise ValueError("Expected a value for %s but found %s." % (field, text))
+        if FIELDS[field][2] is int:
+            if not text.isdigit():
+                raise ValueError("%s must be compared with a number, not %s." % (field, text))
+            return int(text)
+        return text.upper()
+
+
+def parseFilter(args):
+    """Parses a filter given as one or more command line arguments. Bare ID numbers at the end, ie. as
+    added by -lq, limit the search to those elements."""
+    tokens=tokenize(" ".join(args))
+
+    # A number following an operator is a value rather than one of the trailing IDs:
+    ids=[]
+    while len(tokens)>0 and tokens[-1][0]=="word" and tokens[-1][1].isdigit():
+        if len(tokens)>1 and ((tokens[-2][0]=="op" and tokens[-2][1]!=")") or tokens[-2][1].lower() in KEYWORDS):
+            break
+        ids.insert(0, int(tokens.pop()[1]))
+
+    tree=None
+    if len(tokens)>0:
+        tree=FilterParser(tokens).parse()
+    if len(ids)>0:
+        idCond=Cond("id", "in", ids)
+        tree=idCond if tree is None else And([tree, idCond])
+    if tree is None:
+        raise ValueError("No filter given.")
+    return tree
+
+
+class SelectPlan(object):
+    """Splits a filter into index lookups made up front and the conditions checked for each candidate."""
+
+    def __init__(self, tree, catalog):
+        self.catalog=catalog
+        self.store=catalog.store
+        self.protocols=list(catalog.getProtocols())
+        self.ids=None
+        self.species=None
+        self.seriesOnly=catalog.seriesOnly
+        self.steps=[]
+
+        conds=[]
+        if tree is not None:
+            conds=tree.children if isinstance(tree, And) else [tree]
+
+        residual=[]
+        speciesConds=[]
+        for c in conds:
+            if isinstance(c, Cond) and c.op in ["=", "in"]:
+                if c.field=="protocol":
+                    self.protocols=[p for p in self.protocols if p.upper() in c.values]
+                    self.steps.append("Limit protocols to %s" % ",".join(self.protocols))
+                    continue
+                elif c.field=="id":
+                    found=set(c.values)
+                    self.ids=found if self.ids is None else self.ids&found
+                    self.steps.append("Limit IDs to %d listed" % len(found))
+                    continue
+                elif c.field=="type" and c.values==["GSE"]:
+                    self.seriesOnly=True
+                    self.steps.append("Keep series using the ID set bitmaps")
+                    continue
+                elif c.field=="species":
+                    speciesConds.append(c)
+                    continue
+            residual.append(c)
+
+        if len(speciesConds)>0:
+            index=self.store.getIndex()
+            index.ensureTaxa(self.store)
+            for c in speciesConds:
+                found=set()
+                for v in c.values:
+                    found.update([(p, int(i)) for p, i in index.findTaxon(v, self.protocols, False)])
+                self.species=found if self.species is None else self.species&found
+                self.steps.append("Look up %s in the species index" % c.describe())
+
+        self.residual=None
+        if len(residual)==1:
+            self.residual=residual[0]
+        elif len(residual)>1:
+            self.residual=And(residual)
+        if self.residual is not None:
+            self.steps.append("Check %s for each candidate" % self.residual.describe())
+
+    def describe(self):
+        return ["%d. %s" % (i+1, self.steps[i]) for i in range(len(self.steps))]
+
+    def iterCandidates(self, protocol):
+        """Yields (id, isSeries) for every element of a protocol that the index lookups allow."""
+        ids, seriesBits=self.catalog.getIdSet(protocol)
+
+        wanted=None
+        if self.species is not None:
+            wanted=set([i for p, i in self.species if p==protocol])
+        if self.ids is not None:
+            wanted=self.ids if wanted is None else wanted&self.ids
+
+        if wanted is None:
+            positions=range(len(ids))
+        else:
+            positions=[]
+            for idNum in sorted(wanted):
+                i=bisect.bisect_left(ids, idNum)
+                if i<len(ids) and ids[i]==idNum:
+                    positions.append(i)
+
+        for i in positions:
+            series=(seriesBits[i>>3]>>(i&7))&1==1
+            if series or not self.seriesOnly:
+                yield (ids[i], series)
+
+    def iterMatches(self):
+        """Yields the (protocol, id) of every matching element, ordered by protocol and then ID."""
+        for p in self.protocols:
+            for idNum, series in self.iterCandidates(p):
+                row=Row(self.store, p, str(idNum), series)
+                if self.residual is None or self.residual.evaluate(row):
+                    yield (p, row.idNum)
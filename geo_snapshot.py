@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# geo_snapshot.py -- A columnar snapshot of a whole catalog, written by the export command.
+#
+# Questions about the whole collection, ie. how many series of each species were posted each year
+# under each protocol, otherwise mean reading every element. A snapshot holds the metadata of every
+# element in a single file, one column per field, and is memory mapped when it's read. Passing
+# --snapshot=<file> to query_groseq_database.py answers commands from it through SnapshotStore, without
+# opening the database's store, indexes or display table. Files fetched for the elements (matrices,
+# SRA lists and data) are still read from the database directory.
+#
+# The file is laid out as follows, with every number stored little-endian:
+#   SNAPSHOT_MAGIC
+#   uint32 number of rows
+#   uint32 number of protocols, then for each: uint16 name length, name, uint32 first row, uint32 number of rows
+#   uint32 number of columns, then for each: uint16 name length, name, kind, uint64 offset in the file
+#   the columns, each stored according to its kind:
+#     I  a uint32 per row
+#     B  a uint8 per row
+#     S  uint32 offsets (rows+1) into the text that follows them
+#     L  uint32 offsets (rows+1) into the items, uint32 offsets (items+1) into the text that follows them
+# Rows are sorted by ID within each protocol. Missing text is stored as "".
+#
+# Each column is written to temporary files as the elements are read, and they're copied into place
+# once every element has been, so the catalog is never held in memory. A file named *.parquet is
+# written as Parquet instead, with the same columns and a protocol column, if pyarrow is installed.
+
+import os
+import sys
+import mmap
+import shutil
+import struct
+import bisect
+import tempfile
+from array import array
+from geo_store import encodeText, formatSummary, parseSummary, splitContribName, splitEntryPath
+from geo_index import splitTaxon
+from display_table import getDisplayTable, getDisplayName
+from miniml import getSeriesInfo
+from eutils import findSrx
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow=None
+
+
+SNAPSHOT_MAGIC="GEOSNAP\x01"
+
+# Every column, in the order they're stored. srx and srr pair each SRA experiment with one of its runs,
+# with a run of "" for experiments that getsralist hasn't looked up yet.
+COLUMNS=[("id", "I"), ("series", "B"), ("fetched", "B"), ("type", "S"), ("accession", "S"), ("taxon", "S"),
+         ("title", "S"), ("posted", "S"), ("matrixurl", "S"), ("summary", "S"), ("contributor", "S"),
+         ("year", "S"), ("displayname", "S"), ("matrices", "B"), ("sralist", "B"), ("data", "B"),
+         ("sampletitles", "L"), ("sampleaccessions", "L"), ("srx", "L"), ("srr", "L")]
+
+# Parquet files are written this many rows at a time:
+PARQUET_BATCH=10000
+
+
+def readElement(catalog, protocol, idNum, series):
+    """Returns a dictionary holding every column of one element."""
+    store=catalog.store
+    path=store.entryPath(protocol, idNum)
+    row={}
+    for name, kind in COLUMNS:
+        row[name]=[] if kind=="L" else ("" if kind=="S" else 0)
+    row["id"]=int(idNum)
+    row["series"]=int(series)
+
+    try:
+        entry=parseSummary(store.getSummary(path))
+        row["type"]=store.getType(path).strip()
+        row["accession"]=store.getAccession(path).strip()
+        row["taxon"]=store.getTaxon(path)
+        row["title"]=store.getTitle(path)
+        row["posted"]=entry["posted"]
+        row["matrixurl"]=store.getMatrixUrl(path) or ""
+        row["summary"]=entry["summary"]
+        for title, accession in store.getSamples(path):
+            row["sampletitles"].append(title)
+            row["sampleaccessions"].append(accession)
+        row["fetched"]=1
+    except IOError:
+        # Elements whose metadata was never fetched are kept, so that every ID set stays the same.
+        return row
+
+    contribName=store.getContribName(path)
+    if contribName is not None:
+        row["contributor"], row["year"]=splitContribName(contribName)
+
+    shown=getDisplayTable(store).lookup(protocol, idNum)
+    row["displayname"]=shown[0] if shown is not None else getDisplayName(store, path)
+
+    row["matrices"]=int(os.path.exists(os.path.join(path, "matrices")))
+    row["sralist"]=int(os.path.exists(os.path.join(path, "%s.sralist" % idNum)))
+    row["data"]=int(os.path.exists(os.path.join(path, "data")))
+
+    if row["matrices"]:
+        srxList=[]
+        try:
+            for sample in getSeriesInfo(path)["samples"]:
+                srxList.extend([s for s in [findSrx(u) for u in sample["sraUrls"]] if s is not None])
+        except (IOError, SyntaxError):
+            # Matrices that can't be read simply don't name any experiments.
+            pass
+        runs=store.getIndex().getSraRuns(srxList)
+        for srx in srxList:
+            for srr in runs.get(srx, [""]):
+                row["srx"].append(srx)
+                row["srr"].append(srr)
+
+    return row
+
+
+def iterElements(catalog, protocol):
+    """Yields the columns of every element of a protocol, ordered by ID and honoring the series-only setting."""
+    ids, seriesBits=catalog.getIdSet(protocol)
+    for i in range(len(ids)):
+        series=(seriesBits[i>>3]>>(i&7))&1==1
+        if series or not catalog.seriesOnly:
+            yield readElement(catalog, protocol, str(ids[i]), series)
+
+
+class ColumnWriter(object):
+    """Streams the values of one column into temporary files."""
+
+    def __init__(self, name, kind):
+        self.name=name
+        self.kind=kind
+        self.parts=[tempfile.TemporaryFile() for n in range({"I": 1, "B": 1, "S": 2, "L": 3}[kind])]
+        self.numItems=0
+        self.textSize=0
+        # Offsets start from 0:
+        for f in self.parts[:-1]:
+            f.write(struct.pack("<I", 0))
+
+    def addText(self, offsets, text, value):
+        value=encodeText(value)
+        text.write(value)
+        self.textSize+=len(value)
+        offsets.write(struct.pack("<I", self.textSize))
+
+    def add(self, value):
+        if self.kind=="I":
+            self.parts[0].write(struct.pack("<I", value))
+        elif self.kind=="B":
+            self.parts[0].write(struct.pack("<B", value))
+        elif self.kind=="S":
+            self.addText(self.parts[0], self.parts[1], value)
+        else:
+            for v in value:
+                self.addText(self.parts[1], self.parts[2], v)
+            self.numItems+=len(value)
+            self.parts[0].write(struct.pack("<I", self.numItems))
+
+    def getSize(self):
+        return sum([f.tell() for f in self.parts])
+
+    def copyTo(self, out):
+        for f in self.parts:
+            f.seek(0)
+            shutil.copyfileobj(f, out)
+            f.close()
+
+
+def writeSnapshot(catalog, path):
+    """Writes every element of a catalog to a snapshot file, and returns the number written."""
+    writers=[ColumnWriter(name, kind) for name, kind in COLUMNS]
+    protocols=[]
+    numRows=0
+    for p in catalog.getProtocols():
+        firstRow=numRows
+        for row in iterElements(catalog, p):
+            for w in writers:
+                w.add(row[w.name])
+            numRows+=1
+        protocols.append((p, firstRow, numRows-firstRow))
+
+    header=[SNAPSHOT_MAGIC, struct.pack("<II", numRows, len(protocols))]
+    for p, firstRow, count in protocols:
+        header.append(struct.pack("<H", len(p))+p+struct.pack("<II", firstRow, count))
+    header.append(struct.pack("<I", len(writers)))
+
+    # The columns follow the header, whose size depends only on the names of the columns:
+    offset=sum([len(h) for h in header])+sum([2+len(w.name)+1+8 for w in writers])
+    for w in writers:
+        header.append(struct.pack("<H", len(w.name))+w.name+w.kind+struct.pack("<Q", offset))
+        offset+=w.getSize()
+
+    tmpPath=path+".tmp"
+    with open(tmpPath, "wb") as f:
+        f.write("".join(header))
+        for w in writers:
+            w.copyTo(f)
+    os.rename(tmpPath, path)
+    return numRows
+
+
+def getParquetSchema():
+    types={"I": pyarrow.uint32(), "B": pyarrow.bool_(), "S": pyarrow.string(), "L": pyarrow.list_(pyarrow.string())}
+    return pyarrow.schema([pyarrow.field("protocol", pyarrow.string())]+[pyarrow.field(name, types[kind]) for name, kind in COLUMNS])
+
+
+def makeParquetTable(batch):
+    """Turns a list of (protocol, columns) into an Arrow table."""
+    # Arrow strings must be unicode, while every value read from the store is a utf8 string:
+    toText=lambda s: s.decode("utf8", "replace")
+    columns=[pyarrow.array([toText(p) for p, row in batch], type=pyarrow.string())]
+    for name, kind in COLUMNS:
+        if kind=="I":
+            values=[row[name] for p, row in batch]
+        elif kind=="B":
+            values=[row[name]==1 for p, row in batch]
+        elif kind=="S":
+            values=[toText(encodeText(row[name])) for p, row in batch]
+        else:
+            values=[[toText(encodeText(v)) for v in row[name]] for p, row in batch]
+        columns.append(values)
+
+    schema=getParquetSchema()
+    arrays=[columns[0]]+[pyarrow.array(columns[i], type=schema[i].type) for i in range(1, len(columns))]
+    return pyarrow.Table.from_arrays(arrays, names=[f.name for f in schema])
+
+
+def writeParquet(catalog, path):
+    """Writes every element of a catalog to a Parquet file, a batch of rows at a time, and returns the
+    number written. Raises IOError if pyarrow isn't installed."""
+    if pyarrow is None:
+        raise IOError("Writing Parquet files needs pyarrow, which isn't installed")
+
+    tmpPath=path+".tmp"
+    writer=pyarrow.parquet.ParquetWriter(tmpPath, getParquetSchema())
+    numRows=0
+    batch=[]
+    try:
+        for p in catalog.getProtocols():
+            for row in iterElements(catalog, p):
+                batch.append((p, row))
+                if len(batch)==PARQUET_BATCH:
+                    writer.write_table(makeParquetTable(batch))
+                    numRows+=len(batch)
+                    batch=[]
+        if len(batch)>0:
+            writer.write_table(makeParquetTable(batch))
+            numRows+=len(batch)
+    finally:
+        writer.close()
+    os.rename(tmpPath, path)
+    return numRows
+
+
+class SnapshotStore(object):
+    """Reads a snapshot through the same interface as the stores in geo_store.py. Snapshots can't be changed,
+    and only the methods used by commands that read the database are provided."""
+
+    def __init__(self, path, basedir):
+        self.basedir=basedir
+        f=open(path, "rb")
+        try:
+            self.data=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.data[:len(SNAPSHOT_MAGIC)]!=SNAPSHOT_MAGIC:
+            self.data.close()
+            raise ValueError("%s is not a snapshot" % path)
+
+        pos=len(SNAPSHOT_MAGIC)
+        self.numRows, numProtocols=struct.unpack_from("<II", self.data, pos)
+        pos+=8
+
+        # Protocol name -> (first row, number of rows):
+        self.protocols={}
+        for i in range(numProtocols):
+            nameLen=struct.unpack_from("<H", self.data, pos)[0]
+            name=self.data[pos+2:pos+2+nameLen]
+            pos+=2+nameLen
+            self.protocols[name]=struct.unpack_from("<II", self.data, pos)
+            pos+=8
+
+        # Column name -> (kind, offset):
+        self.columns={}
+        numColumns=struct.unpack_from("<I", self.data, pos)[0]
+        pos+=4
+        for i in range(numColumns):
+            nameLen=struct.unpack_from("<H", self.data, pos)[0]
+            name=self.data[pos+2:pos+2+nameLen]
+            pos+=2+nameLen
+            self.columns[name]=(self.data[pos], struct.unpack_from("<Q", self.data, pos+1)[0])
+            pos+=9
+
+        # Only the small fixed size columns are copied out of the mapping, into arrays that can be searched quickly:
+        self.ids=self.getColumn("id")
+        self.series=self.getColumn("series")
+        self.fetched=self.getColumn("fetched")
+        self.index=SnapshotIndex(self)
+
+    def getColumn(self, name):
+        """Returns every value of an I or B column as an array."""
+        kind, offset=self.columns[name]
+        values=array(kind)
+        values.fromstring(self.data[offset:offset+self.numRows*values.itemsize])
+        if sys.byteorder=="big":
+            values.byteswap()
+        return values
+
+    def getText(self, name, row):
+        kind, offset=self.columns[name]
+        start, end=struct.unpack_from("<II", self.data, offset+row*4)
+        textStart=offset+(self.numRows+1)*4
+        return self.data[textStart+start:textStart+end]
+
+    def getList(self, name, row):
+        kind, offset=self.columns[name]
+        first, last=struct.unpack_from("<II", self.data, offset+row*4)
+        numItems=struct.unpack_from("<I", self.data, offset+self.numRows*4)[0]
+        textOffsets=offset+(self.numRows+1)*4
+        textStart=textOffsets+(numItems+1)*4
+        values=[]
+        for i in range(first, last):
+            start, end=struct.unpack_from("<II", self.data, textOffsets+i*4)
+            values.append(self.data[textStart+start:textStart+end])
+        return values
+
+    def findRow(self, protocol, idNum):
+        """Returns the row holding an element, or None if the snapshot doesn't have it."""
+        if protocol not in self.protocols or not str(idNum).isdigit():
+            return None
+        first, count=self.protocols[protocol]
+        idNum=int(idNum)
+        i=bisect.bisect_left(self.ids, idNum, first, first+count)
+        if i==first+count or self.ids[i]!=idNum:
+            return None
+        return i
+
+    def getRow(self, path):
+        """Returns the row of an element whose metadata was fetched, raising IOError like the other stores otherwise."""
+        row=self.findRow(*splitEntryPath(path))
+        if row is None or not self.fetched[row]:
+            raise IOError("No such element in snapshot: %s" % path)
+        return row
+
+    def getRowRange(self, protocol):
+        first, count=self.protocols.get(protocol, (0, 0))
+        return range(first, first+count)
+
+    def getIndex(self):
+        return self.index
+
+    def entryPath(self, protocol, idNum):
+        return os.path.join(self.basedir, protocol, idNum)
+
+    def listProtocols(self):
+        return sorted(self.protocols.keys())
+
+    def listIds(self, protocol, seriesOnly=False):
+        # The other stores order IDs as text:
+        return sorted([str(self.ids[r]) for r in self.getRowRange(protocol) if not seriesOnly or self.series[r]])
+
+    def findProto(self, idNum, protocolSet):
+        for p in protocolSet:
+            if self.findRow(p, idNum) is not None:
+                return p
+        return None
+
+    def isSeries(self, path):
+        row=self.findRow(*splitEntryPath(path))
+        return row is not None and self.series[row]==1
+
+    def getType(self, path):
+        return self.getText("type", self.getRow(path))
+
+    def getTaxon(self, path):
+        return self.getText("taxon", self.getRow(path))
+
+    def getSummary(self, path):
+        row=self.getRow(path)
+        entry=dict([(k, self.getText(k, row)) for k in ["title", "posted", "accession", "taxon", "summary"]])
+        entry["entryType"]=self.getText("type", row)
+        entry["matrixUrl"]=self.getMatrixUrl(path)
+        return formatSummary(entry)
+
+    def getTitle(self, path):
+        return self.getText("title", self.getRow(path)).strip()
+
+    def getSearchText(self, path):
+        row=self.getRow(path)
+        return (self.getText("title", row), self.getText("summary", row))
+
+    def getAccession(self, path):
+        return self.getText("accession", self.getRow(path))
+
+    def getMatrixUrl(self, path):
+        url=self.getText("matrixurl", self.getRow(path))
+        if len(url)==0:
+            return None
+        return url
+
+    def getContribName(self, path):
+        row=self.findRow(*splitEntryPath(path))
+        if row is None:
+            return None
+        name=self.getText("contributor", row)+self.getText("year", row)
+        if len(name)==0:
+            return None
+        return name
+
+    def setContribName(self, path, name):
+        # Names worked out while reading a snapshot are simply worked out again the next time.
+        pass
+
+    def getSamples(self, path):
+        row=self.getRow(path)
+        return zip(self.getList("sampletitles", row), self.getList("sampleaccessions", row))
+
+    def lookup(self, protocol, idNum):
+        """Returns (shorthand name, title) for an element, just like DisplayTable.lookup()."""
+        row=self.findRow(protocol, idNum)
+        if row is None or not self.fetched[row]:
+            return None
+        return (self.getText("displayname", row), self.getText("title", row).strip())
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.data.close()
+
+
+class SnapshotIndex(object):
+    """Answers the lookups made of a GeoIndex from a snapshot's columns. The taxon and accession lookups
+    are built in memory the first time they're needed."""
+
+    def __init__(self, snapshot):
+        self.snapshot=snapshot
+        self.taxa=None
+        self.accessions=None
+
+    def isBuilt(self, name):
+        # Snapshots don't hold a full text index.
+        return name!="fulltext"
+
+    def ensureTaxa(self, store):
+        if self.taxa is None:
+            s=self.snapshot
+            # Upper case species name -> rows naming it, matched without case just like the taxon index:
+            self.taxa={}
+            for r in range(s.numRows):
+                if s.fetched[r]:
+                    for t in set([t.upper() for t in splitTaxon(s.getText("taxon", r))]):
+                        self.taxa.setdefault(t, []).append(r)
+
+    def getEntries(self, rows, protocolSet, seriesOnly):
+        """Returns (protocol, id) for the rows in each of the protocols, in the order of protocolSet and then of IDs as text."""
+        s=self.snapshot
+        found=[]
+        for p in protocolSet:
+            first, count=s.protocols.get(p, (0, 0))
+            found.extend(sorted([(p, str(s.ids[r])) for r in rows if r>=first and r<first+count and (not seriesOnly or s.series[r])]))
+        return found
+
+    def findTaxon(self, speciesName, protocolSet, seriesOnly):
+        self.ensureTaxa(None)
+        return self.getEntries(self.taxa.get(speciesName.strip().upper(), []), protocolSet, seriesOnly)
+
+    def countTaxa(self, protocolSet, seriesOnly):
+        s=self.snapshot
+        counts={}
+        for p in protocolSet:
+            for r in s.getRowRange(p):
+                if s.fetched[r] and (not seriesOnly or s.series[r]):
+                    for t in splitTaxon(s.getText("taxon", r)):
+                        counts[t]=counts.get(t, 0)+1
+        return counts
+
+    def ensureAccessions(self, store):
+        if self.accessions is None:
+            s=self.snapshot
+            # Accession -> rows:
+            self.accessions={}
+            for r in range(s.numRows):
+                if s.fetched[r]:
+                    accession=s.getText("accession", r).strip()
+                    if len(accession)>0:
+                        self.accessions.setdefault(accession, []).append(r)
+
+    def findAccessions(self, accessionList, protocolSet):
+        self.ensureAccessions(None)
+        found={}
+        for a in accessionList:
+            rows=self.getEntries(self.accessions.get(a.strip(), []), protocolSet, False)
+            if len(rows)>0:
+                found[a]=rows
+        return found
+
+    def ensureFullText(self, store):
+        raise IOError("Full text search can't be run from a snapshot")
+
+    def searchFullText(self, query, protocolSet):
+        raise IOError("Full text search can't be run from a snapshot")
+
+    def getIdSet(self, store, protocol):
+        s=self.snapshot
+        first, count=s.protocols.get(protocol, (0, 0))
+        seriesBits=bytearray((count+7)/8)
+        for i in range(count):
+            if s.series[first+i]:
+                seriesBits[i>>3]|=1<<(i&7)
+        return (s.ids[first:first+count], seriesBits)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# geo_store.py -- Metadata storage backends for the database built by make_groseq_database.py
+#
+# Two backends are provided with the same interface:
+#   DirStore -- The original layout: one directory per GDS ID holding six small text files.
+#   GeoStore -- A single SQLite file holding the same fields, indexed so that queries don't need
+#               to open thousands of files.
+#
+# Per-element artifacts (matrices, name caches, SRA lists and downloaded data) always live in
+# dbdir/<protocol>/<id>, regardless of the backend used for the metadata itself.
+
+import os
+import sqlite3
+from geo_index import GeoIndex, openIndex, INDEX_NAME
+
+
+# The SQLite store lives inside the database directory. Its name starts with a dot so that it
+# is never mistaken for a protocol directory.
+STORE_NAME=".geostore.sqlite"
+
+
+def splitEntryPath(path):
+    """Returns (protocol, id) for a path of the form dbdir/protocol/id."""
+    pathToks=path.split('/')
+    return (pathToks[-2], pathToks[-1])
+
+
+def encodeText(text):
+    """Returns text as a utf8 string, which is how every metadata file is stored on disk."""
+    if text is None:
+        return None
+    if isinstance(text, unicode):
+        return text.encode('utf8')
+    return text
+
+
+def formatSummary(entry):
+    """Renders an entry dictionary in the summary.txt format."""
+    rStr="Title: %s\n" % encodeText(entry["title"])
+    rStr+="Posted: %s\n" % encodeText(entry["posted"])
+    rStr+="Accession nr: %s\n" % encodeText(entry["accession"])
+    rStr+="Species: %s\n" % encodeText(entry["taxon"])
+    rStr+="Entry Type: %s\n" % encodeText(entry["entryType"])
+    rStr+="Matrix URL/FTP Link: %s\n" % encodeText(entry["matrixUrl"])
+    rStr+="Summary (begins on next line):\n"
+    rStr+=encodeText(entry["summary"])
+    return rStr
+
+
+def parseSummary(contents):
+    """Splits the contents of a summary.txt file back into an entry dictionary."""
+    keys={"Title": "title", "Posted": "posted", "Accession nr": "accession", "Species": "taxon",
+          "Entry Type": "entryType", "Matrix URL/FTP Link": "matrixUrl"}
+    entry={"title": "", "posted": "", "accession": "", "taxon": "", "entryType": "", "matrixUrl": None, "summary": ""}
+
+    lines=contents.split('\n')
+    for i in range(len(lines)):
+        if lines[i].startswith("Summary (begins on next line):"):
+            entry["summary"]="\n".join(lines[i+1:])
+            break
+
+        ltoks=lines[i].split(':', 1)
+        if len(ltoks)==2 and ltoks[0] in keys:
+            entry[keys[ltoks[0]]]=ltoks[1].strip()
+
+    if entry["matrixUrl"]=="None":
+        entry["matrixUrl"]=None
+
+    return entry
+
+
+def splitContribName(nameStr):
+    """Splits a "Lastname2016" style name cache string into (contributor, year)."""
+    contrib="".join([c for c in nameStr if c>'9'])
+    year="".join([c for c in nameStr if c>='0' and c<='9'])
+    return (contrib, year)
+
+
+class DirStore(object):
+    """Reads and writes metadata as a tree of small files: dbdir/<protocol>/<id>/*.txt"""
+
+    def __init__(self, basedir):
+        self.basedir=basedir
+        self.index=None
+
+    def entryPath(self, protocol, idNum):
+        return os.path.join(self.basedir, protocol, idNum)
+
+    def getIndex(self):
+        # The index is only opened when it's needed, so that listing-only commands don't touch it:
+        if self.index is None:
+            self.index=openIndex(os.path.join(self.basedir, INDEX_NAME))
+        return self.index
+
+    def readFile(self, path, name):
+        f=open(os.path.join(path, name), "r")
+        contents=f.read()
+        f.close()
+        return contents
+
+    def writeFile(self, path, name, contents):
+        # Write to a temporary file and rename it, so that readers only ever see complete files:
+        tmpPath=os.path.join(path, ".%s.tmp" % name)
+        f=open(tmpPath, "w")
+        f.write(contents)
+        f.close()
+        os.rename(tmpPath, os.path.join(path, name))
+
+    def listProtocols(self):
+        return sorted([p for p in os.listdir(self.basedir) if not p.startswith('.')])
+
+    def listIds(self, protocol, seriesOnly=False):
+        ids=sorted(os.listdir(os.path.join(self.basedir, protocol)))
+        if seriesOnly:
+            ids=[i for i in ids if self.isSeries(self.entryPath(protocol, i))]
+        return ids
+
+    def listFetchedIds(self, protocol):
+        """Returns the IDs of a protocol whose metadata has been fetched. type.txt is written last by putEntry."""
+        if not os.path.exists(os.path.join(self.basedir, protocol)):
+            return []
+        return [i for i in self.listIds(protocol) if os.path.exists(os.path.join(self.entryPath(protocol, i), "type.txt"))]
+
+    def getStamp(self, protocol):
+        # Adding or removing an element directory changes the protocol directory's mtime:
+        return os.stat(os.path.join(self.basedir, protocol)).st_mtime
+
+    def findProto(self, idNum, protocolSet):
+        for p in protocolSet:
+            if os.path.exists(os.path.join(self.basedir, p, idNum)):
+                return p
+        return None
+
+    def isSeries(self, path):
+        # Directories are created before their metadata is fetched, so type.txt may not exist yet:
+        try:
+            return self.readFile(path, "type.txt")=="GSE"
+        except IOError:
+            return False
+
+    def getType(self, path):
+        return self.readFile(path, "type.txt")
+
+    def getTaxon(self, path):
+        return self.readFile(path, "taxon.txt")
+
+    def getSummary(self, path):
+        return self.readFile(path, "summary.txt")
+
+    def getTitle(self, path):
+        f=open(os.path.join(path, "summary.txt"), "r")
+        title=f.readline()
+        f.close()
+        return title[(len(title.split()[0])+1):].strip()
+
+    def getSearchText(self, path):
+        """Returns the (title, summary) of an element for the full text index."""
+        entry=parseSummary(self.getSummary(path))
+        return (entry["title"], entry["summary"])
+
+    def getAccession(self, path):
+        # The accession number is cached separately so that summary.txt doesn't need to be reparsed:
+        cachePath=os.path.join(path, "accessioncache.txt")
+        if os.path.exists(cachePath):
+            return self.readFile(path, "accessioncache.txt")
+
+        accession=parseSummary(self.getSummary(path))["accession"]
+        self.writeFile(path, "accessioncache.txt", accession)
+        return accession
+
+    def getMatrixUrl(self, path):
+        if not os.path.exists(os.path.join(path, "matrixpath.txt")):
+            return None
+        return self.readFile(path, "matrixpath.txt").strip()
+
+    def getContribName(self, path):
+        if not os.path.exists(os.path.join(path, "namecache.txt")):
+            return None
+        return self.readFile(path, "namecache.txt").strip()
+
+    def setContribName(self, path, name):
+        self.writeFile(path, "namecache.txt", name)
+
+    def getSamples(self, path):
+        """Returns (title, accession) for every sample listed by the element."""
+        samples=[]
+        if os.path.exists(os.path.join(path, "datalist.txt")):
+            for l in self.readFile(path, "datalist.txt").splitlines():
+                ltoks=l.split(' ', 1)
+                if len(ltoks)==2:
+                    samples.append((ltoks[0], ltoks[1]))
+        return samples
+
+    def prepareEntries(self, protocol, idlist):
+        """Creates a directory for every ID in idlist."""
+        outDir=os.path.join(self.basedir, protocol)
+
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+
+        for i in idlist:
+            dpath=os.path.join(outDir, i)
+            try:
+                os.makedirs(dpath)
+            except:
+                pass
+
+    def putEntry(self, protocol, idNum, entry):
+        curPath=self.entryPath(protocol, idNum)
+        if not os.path.exists(curPath):
+            os.makedirs(curPath)
+
+        self.writeFile(curPath, "summary.txt", formatSummary(entry))
+        self.writeFile(curPath, "taxon.txt", encodeText(entry["taxon"]))
+        self.writeFile(curPath, "accessioncache.txt", encodeText(entry["accession"]))
+
+        # It appears that sample titles are all one "word"
+        self.writeFile(curPath, "datalist.txt", "".join(["%s %s\n" % (encodeText(d[0]), encodeText(d[1])) for d in entry["datalist"]]))
+        self.writeFile(curPath, "relations.txt", "".join(["%s %s\n" % (r[0], r[1]) for r in entry["relations"]]))
+
+        if entry["matrixUrl"] is not None:
+            self.writeFile(curPath, "matrixpath.txt", "%s\n" % entry["matrixUrl"])
+        elif os.path.exists(os.path.join(curPath, "matrixpath.txt")):
+            os.remove(os.path.join(curPath, "matrixpath.txt"))
+
+        # type.txt goes last: an element is only considered fetched once it exists.
+        self.writeFile(curPath, "type.txt", entry["entryType"].strip())
+
+        updateIndex(self.getIndex(), protocol, idNum, entry)
+
+    def readEntry(self, path):
+        """Reads every metadata file for an element back into an entry dictionary."""
+        entry=parseSummary(self.getSummary(path))
+        entry["taxon"]=self.getTaxon(path)
+        entry["entryType"]=self.getType(path)
+        entry["matrixUrl"]=self.getMatrixUrl(path)
+        entry["datalist"]=self.getSamples(path)
+        entry["relations"]=[]
+
+        if os.path.exists(os.path.join(path, "relations.txt")):
+            for l in self.readFile(path, "relations.txt").splitlines():
+                ltoks=l.split(' ', 1)
+                if len(ltoks)==2:
+                    entry["relations"].append((ltoks[0], ltoks[1]))
+
+        return entry
+
+    def commit(self):
+        if self.index is not None:
+            self.index.flushIdSets(self)
+            self.index.commit()
+
+    def close(self):
+        if self.index is not None:
+            self.commit()
+            self.index.close()
+
+
+class GeoStore(object):
+    """Keeps every metadata field in a single indexed SQLite file."""
+
+    schema=[
+        """CREATE TABLE IF NOT EXISTS entries (
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            accession TEXT,
+            type TEXT,
+            taxon TEXT,
+            title TEXT,
+            posted TEXT,
+            matrixurl TEXT,
+            summary TEXT,
+            contributor TEXT,
+            year TEXT,
+            PRIMARY KEY (protocol, id))""",
+        # The primary key already serves as the protocol index.
+        "CREATE INDEX IF NOT EXISTS entries_id ON entries(id)",
+        "CREATE INDEX IF NOT EXISTS entries_taxon ON entries(taxon)",
+        "CREATE INDEX IF NOT EXISTS entries_type ON entries(type)",
+        "CREATE INDEX IF NOT EXISTS entries_accession ON entries(accession)",
+        "CREATE INDEX IF NOT EXISTS entries_contributor ON entries(contributor)",
+        "CREATE INDEX IF NOT EXISTS entries_year ON entries(year)",
+        """CREATE TABLE IF NOT EXISTS samples (
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            title TEXT,
+            accession TEXT)""",
+        "CREATE INDEX IF NOT EXISTS samples_entry ON samples(protocol, id)",
+        """CREATE TABLE IF NOT EXISTS relations (
+            protocol TEXT NOT NULL,
+            id TEXT NOT NULL,
+            name TEXT,
+            url TEXT)""",
+        "CREATE INDEX IF NOT EXISTS relations_entry ON relations(protocol, id)"
+    ]
+
+    def __init__(self, basedir, storePath=None):
+        self.basedir=basedir
+        if storePath is None:
+            storePath=os.path.join(basedir, STORE_NAME)
+        self.storePath=storePath
+
+        self.conn=sqlite3.connect(storePath)
+        # Hand back utf8 strings, just as if the values had been read from the old text files:
+        self.conn.text_factory=str
+        for s in self.schema:
+            self.conn.execute(s)
+
+        # Indexes are kept in the same file so that they're updated in the same transaction:
+        self.index=GeoIndex(self.conn)
+
+    def getIndex(self):
+        return self.index
+
+    def entryPath(self, protocol, idNum):
+        return os.path.join(self.basedir, protocol, idNum)
+
+    def getField(self, path, field):
+        protocol, idNum=splitEntryPath(path)
+        row=self.conn.execute("SELECT %s FROM entries WHERE protocol=? AND id=?" % field, (protocol, idNum)).fetchone()
+        if row is None:
+            raise IOError("No such element in store: %s" % path)
+        return row[0]
+
+    def listProtocols(self):
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT protocol FROM entries ORDER BY protocol")]
+
+    def listIds(self, protocol, seriesOnly=False):
+        if seriesOnly:
+            cur=self.conn.execute("SELECT id FROM entries WHERE protocol=? AND type='GSE' ORDER BY id", (protocol,))
+        else:
+            cur=self.conn.execute("SELECT id FROM entries WHERE protocol=? ORDER BY id", (protocol,))
+        return [r[0] for r in cur]
+
+    def listFetchedIds(self, protocol):
+        # Elements are only added to the store once their metadata has been fetched.
+        return self.listIds(protocol)
+
+    def getStamp(self, protocol):
+        # Every change to the store goes through putEntry, which keeps the indexes up to date.
+        return 0
+
+    def findProto(self, idNum, protocolSet):
+        found=[r[0] for r in self.conn.execute("SELECT protocol FROM entries WHERE id=?", (idNum,))]
+        # Honor the order of the protocol set, just like the directory backend does:
+        for p in protocolSet:
+            if p in found:
+                return p
+        return None
+
+    def isSeries(self, path):
+        return self.getField(path, "type")=="GSE"
+
+    def getType(self, path):
+        return self.getField(path, "type")
+
+    def getTaxon(self, path):
+        return self.getField(path, "taxon")
+
+    def getSummary(self, path):
+        protocol, idNum=splitEntryPath(path)
+        row=self.conn.execute("SELECT title, posted, accession, taxon, type, matrixurl, summary FROM entries WHERE protocol=? AND id=?",
+                              (protocol, idNum)).fetchone()
+        if row is None:
+            raise IOError("No such element in store: %s" % path)
+
+        return formatSummary({"title": row[0], "posted": row[1], "accession": row[2], "taxon": row[3],
+                              "entryType": row[4], "matrixUrl": row[5], "summary": row[6]})
+
+    def getTitle(self, path):
+        return self.getField(path, "title").strip()
+
+    def getSearchText(self, path):
+        protocol, idNum=splitEntryPath(path)
+        row=self.conn.execute("SELECT title, summary FROM entries WHERE protocol=? AND id=?", (protocol, idNum)).fetchone()
+        if row is None:
+            raise IOError("No such element in store: %s" % path)
+        return (row[0], row[1])
+
+    def getAccession(self, path):
+        return self.getField(path, "accession")
+
+    def getMatrixUrl(self, path):
+        url=self.getField(path, "matrixurl")
+        if url is None:
+            return None
+        return url.strip()
+
+    def getContribName(self, path):
+        protocol, idNum=splitEntryPath(path)
+        row=self.conn.execute("SELECT contributor, year FROM entries WHERE protocol=? AND id=?", (protocol, idNum)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0]+row[1]
+
+    def setContribName(self, path, name):
+        protocol, idNum=splitEntryPath(path)
+        contrib, year=splitContribName(name)
+        self.conn.execute("UPDATE entries SET contributor=?, year=? WHERE protocol=? AND id=?", (contrib, year, protocol, idNum))
+        self.conn.commit()
+
+    def getSamples(self, path):
+        protocol, idNum=splitEntryPath(path)
+        return self.conn.execute("SELECT title, accession FROM samples WHERE protocol=? AND id=? ORDER BY rowid",
+                                 (protocol, idNum)).fetchall()
+
+    def prepareEntries(self, protocol, idlist):
+        # Nothing needs to exist on disk until an element's matrices are fetched.
+        pass
+
+    def putEntry(self, protocol, idNum, entry, contribName=None):
+        contrib=None
+        year=None
+        if contribName is not None:
+            contrib, year=splitContribName(contribName)
+        else:
+            # Don't throw away a previously computed name when an element is refreshed:
+            row=self.conn.execute("SELECT contributor, year FROM entries WHERE protocol=? AND id=?", (protocol, idNum)).fetchone()
+            if row is not None:
+                contrib, year=row
+
+        self.conn.execute("DELETE FROM samples WHERE protocol=? AND id=?", (protocol, idNum))
+        self.conn.execute("DELETE FROM relations WHERE protocol=? AND id=?", (protocol, idNum))
+        self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (protocol, idNum, encodeText(entry["accession"]), encodeText(entry["entryType"]).strip(),
+                           encodeText(entry["taxon"]), encodeText(entry["title"]), encodeText(entry["posted"]),
+                           encodeText(entry["matrixUrl"]), encodeText(entry["summary"]), contrib, year))
+        self.conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)",
+                              [(protocol, idNum, encodeText(d[0]), encodeText(d[1])) for d in entry["datalist"]])
+        self.conn.executemany("INSERT INTO relations VALUES (?, ?, ?, ?)",
+                              [(protocol, idNum, encodeText(r[0]), encodeText(r[1])) for r in entry["relations"]])
+
+        updateIndex(self.index, protocol, idNum, entry)
+
+    def commit(self):
+        self.index.flushIdSets(self)
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def updateIndex(index, protocol, idNum, entry):
+    """Adds a freshly written element to every index that has already been built."""
+    if index.isBuilt("taxa"):
+        index.addTaxa(protocol, idNum, encodeText(entry["taxon"]), encodeText(entry["entryType"]))
+    if index.isBuilt("accessions"):
+        index.addAccession(protocol, idNum, encodeText(entry["accession"]))
+    if index.isBuilt("fulltext"):
+        index.addFullText(protocol, idNum, encodeText(entry["title"]), encodeText(entry["summary"]))
+    index.addToIdSet(protocol, idNum, encodeText(entry["entryType"]))
+
+
+def openStore(basedir):
+    """Returns a GeoStore if one has been created in basedir, otherwise a DirStore."""
+    if os.path.exists(os.path.join(basedir, STORE_NAME)):
+        return GeoStore(basedir)
+    return DirStore(basedir)
+
+
+def migrateDirTree(basedir, log=None):
+    """Copies every element of a directory tree database into a GeoStore in the same directory."""
+    dirStore=DirStore(basedir)
+    protocols=dirStore.listProtocols()
+    geoStore=GeoStore(basedir)
+    numMigrated=0
+
+    for p in protocols:
+        for i in dirStore.listIds(p):
+            path=dirStore.entryPath(p, i)
+            try:
+                entry=dirStore.readEntry(path)
+            except:
+                if log is not None:
+                    log("Skipping incomplete element %s\n" % path)
+                continue
+
+            geoStore.putEntry(p, i, entry, dirStore.getContribName(path))
+            numMigrated+=1
+
+        geoStore.commit()
+        if log is not None:
+            log("Migrated protocol %s\n" % p)
+
+    geoStore.close()
+    return numMigrated
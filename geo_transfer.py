@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# geo_transfer.py -- Shared machinery for fetching files from GEO's HTTP and FTP servers.
+#
+# This provides a bounded pool of worker threads with a per-host concurrency limit, a journal of
+# finished jobs so that interrupted runs can pick up where they left off, progress reporting,
+# in-process archive extraction and resumable, verified file downloads.
+#
+# Files can be fetched from somewhere other than NCBI by setting GEO_MIRROR to a base URL, in which case
+# a file at scheme://host/path is fetched from GEO_MIRROR/host/path. Connection limits still apply to
+# the original hosts. Like EUTILS_BASE, this makes it possible to run everything against a mock.
+
+import os
+import re
+import sys
+import time
+import gzip
+import hashlib
+import ftplib
+import httplib
+import shutil
+import tarfile
+import urllib2
+import urlparse
+import threading
+import Queue
+from ftplib import FTP
+from instrument import phase, count
+
+
+# Size of the blocks copied from the network to disk:
+CHUNK_SIZE=64*1024
+
+# Number of times a download is attempted, each attempt picking up where the last one stopped:
+DOWNLOAD_ATTEMPTS=3
+
+GEO_MIRROR=os.environ.get("GEO_MIRROR")
+
+
+def getHost(url):
+    return urlparse.urlparse(url).netloc
+
+
+def mirrorUrl(url):
+    """Returns the URL that url is actually fetched from."""
+    if not GEO_MIRROR:
+        return url
+    parsed=urlparse.urlparse(url)
+    return "%s/%s%s" % (GEO_MIRROR.rstrip('/'), parsed.netloc, parsed.path)
+
+
+class JobState(object):
+    """An append-only journal recording the final status of every job."""
+
+    def __init__(self, path):
+        self.path=path
+        self.status={}
+        self.lock=threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for l in f.read().splitlines():
+                    # Keys may contain spaces, but statuses never do:
+                    ltoks=l.rsplit(' ', 1)
+                    if len(ltoks)==2:
+                        self.status[ltoks[0]]=ltoks[1]
+
+    def isDone(self, key):
+        return self.status.get(key)=="done"
+
+    def mark(self, key, status):
+        with self.lock:
+            self.status[key]=status
+            # Append and flush right away so that a crash loses at most the job being written:
+            with open(self.path, "a") as f:
+                f.write("%s %s\n" % (key, status))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class BandwidthLimit(object):
+    """Caps the combined rate of every transfer sharing it, allowing bursts of up to a second's worth of data."""
+
+    def __init__(self, bytesPerSec):
+        self.rate=float(bytesPerSec)
+        self.available=self.rate
+        self.last=time.time()
+        self.lock=threading.Lock()
+
+    def consume(self, numBytes):
+        """Accounts for numBytes having been transferred, sleeping for as long as the caller is over the limit."""
+        with self.lock:
+            now=time.time()
+            self.available=min(self.rate, self.available+(now-self.last)*self.rate)
+            self.last=now
+            self.available-=numBytes
+            delay=-self.available/self.rate
+        if delay>0:
+            time.sleep(delay)
+
+
+class Progress(object):
+    """Reports finished jobs along with overall throughput. Every transfer reports its data here,
+    so this is also where an optional BandwidthLimit is applied."""
+
+    def __init__(self, total, log=sys.stdout.write, limit=None):
+        self.total=total
+        self.log=log
+        self.limit=limit
+        self.finished=0
+        self.numBytes=0
+        self.startTime=time.time()
+        self.lock=threading.Lock()
+
+    def addBytes(self, numBytes):
+        with self.lock:
+            self.numBytes+=numBytes
+        if self.limit is not None:
+            self.limit.consume(numBytes)
+
+    def getRate(self):
+        elapsed=max(time.time()-self.startTime, 0.001)
+        return self.numBytes/elapsed
+
+    def finish(self, key, status):
+        with self.lock:
+            self.finished+=1
+            self.log("[%d/%d] %s: %s (%.1f MB total, %.2f MB/s)\n" % (self.finished, self.total, key, status,
+                                                                      self.numBytes/1048576.0, self.getRate()/1048576.0))
+
+    def summary(self):
+        elapsed=time.time()-self.startTime
+        self.log("Transferred %.1f MB in %.1fs (%.2f MB/s)\n" % (self.numBytes/1048576.0, elapsed, self.getRate()/1048576.0))
+
+
+class WorkerPool(object):
+    """Runs jobs on a fixed number of threads while limiting concurrent connections to each host."""
+
+    def __init__(self, numWorkers=4, perHost=2):
+        self.numWorkers=max(1, numWorkers)
+        self.perHost=max(1, perHost)
+        self.hostSlots={}
+        self.lock=threading.Lock()
+
+    def getHostSlot(self, url):
+        """Returns the semaphore that must be held while talking to the host serving url."""
+        host=getHost(url)
+        with self.lock:
+            if host not in self.hostSlots:
+                self.hostSlots[host]=threading.BoundedSemaphore(self.perHost)
+            return self.hostSlots[host]
+
+    def run(self, jobs, func):
+        """Calls func(job) for every job. Yields (job, result, error) as jobs finish."""
+        jobQueue=Queue.Queue()
+        resultQueue=Queue.Queue()
+        for j in jobs:
+            jobQueue.put(j)
+
+        def worker():
+            while True:
+                try:
+                    job=jobQueue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    resultQueue.put((job, func(job), None))
+                except Exception as e:
+                    resultQueue.put((job, None, e))
+
+        threads=[threading.Thread(target=worker) for i in range(min(self.numWorkers, len(jobs)))]
+        for t in threads:
+            # Don't keep the interpreter alive on ^C; the job journal makes it safe to stop at any point.
+            t.daemon=True
+            t.start()
+
+        for i in range(len(jobs)):
+            # A timeout keeps the main thread responsive to KeyboardInterrupt:
+            while True:
+                try:
+                    yield resultQueue.get(True, 0.5)
+                    break
+                except Queue.Empty:
+                    pass
+
+
+def openFtp(parsed):
+    """Returns a logged in FTP connection to the server named by a parsed ftp:// URL."""
+    count("ftp connections")
+    ftp=FTP()
+    ftp.connect(parsed.hostname, parsed.port or 21)
+    ftp.login(parsed.username or "anonymous", parsed.password or "")
+    return ftp
+
+
+def interleaveByHost(jobs, getUrl=lambda job: job[0]):
+    """Reorders jobs so that consecutive jobs go to different hosts where possible. Workers then rarely
+    sit waiting for a host's connection slot while jobs for other hosts are queued behind them."""
+    byHost={}
+    hosts=[]
+    for j in jobs:
+        host=getHost(getUrl(j))
+        if host not in byHost:
+            byHost[host]=[]
+            hosts.append(host)
+        byHost[host].append(j)
+
+    ordered=[]
+    for i in range(max([len(l) for l in byHost.values()] or [0])):
+        ordered.extend([byHost[h][i] for h in hosts if i<len(byHost[h])])
+    return ordered
+
+
+def getFreeSpace(path):
+    """Returns the number of bytes available to unprivileged users on the filesystem holding path."""
+    st=os.statvfs(path)
+    return st.f_bavail*st.f_frsize
+
+
+def listRemoteDir(url):
+    """Returns the names of the files in a remote FTP or HTTP directory listing."""
+    url=mirrorUrl(url)
+    parsed=urlparse.urlparse(url)
+
+    if parsed.scheme=="ftp":
+        ftp=openFtp(parsed)
+        names=ftp.nlst(parsed.path)
+        ftp.quit()
+
+        names=[n.split('/')[-1] for n in names]
+        return [n for n in names if n not in (".", "..", ".listing")]
+
+    count("http requests")
+    urlFile=urllib2.urlopen(url)
+    length=urlFile.info().getheader("Content-Length")
+    contents=urlFile.read()
+    urlFile.close()
+    # A connection dropped partway through looks like the end of the listing:
+    if length is not None and length.isdigit() and len(contents)!=int(length):
+        raise IOError("Listing of %s ended after %d of %s bytes" % (url, len(contents), length))
+
+    # Keep only plain links to files within the directory itself:
+    names=[]
+    for link in re.findall(r'href="([^"?#]+)"', contents):
+        if link.startswith('/') or link.startswith('.') or '://' in link or link.endswith('/'):
+            continue
+        if link not in names:
+            names.append(link)
+    return names
+
+
+def copyStream(inFile, out, progress=None):
+    numBytes=0
+    while True:
+        chunk=inFile.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        out.write(chunk)
+        numBytes+=len(chunk)
+        count("network bytes", len(chunk))
+        if progress is not None:
+            progress.addBytes(len(chunk))
+    return numBytes
+
+
+def extractArchive(path, destDir):
+    """Unpacks a tar or gzip archive into destDir and removes the archive."""
+    if tarfile.is_tarfile(path):
+        archive=tarfile.open(path, "r:*")
+        root=os.path.realpath(destDir)
+        for member in archive.getmembers():
+            # Refuse to write anywhere outside of destDir:
+            if member.name.startswith('/') or ".." in member.name.split('/'):
+                raise IOError("Unsafe path in archive %s: %s" % (path, member.name))
+
+            # Links must point somewhere inside destDir as well. Symlinks are relative to their own directory:
+            if member.issym() or member.islnk():
+                if member.issym():
+                    target=os.path.join(root, os.path.dirname(member.name), member.linkname)
+                else:
+                    target=os.path.join(root, member.linkname)
+                target=os.path.realpath(target)
+                if target!=root and not target.startswith(root+os.sep):
+                    raise IOError("Unsafe link in archive %s: %s -> %s" % (path, member.name, member.linkname))
+        archive.extractall(destDir)
+        archive.close()
+
+    elif path.endswith(".gz") or path.endswith(".tgz"):
+        # For some reason, some files have a tgz extension when they're really just gzip'd files.
+        outName=os.path.basename(path).rsplit('.', 1)[0]
+        inFile=gzip.open(path, "rb")
+        with open(os.path.join(destDir, outName), "wb") as outFile:
+            shutil.copyfileobj(inFile, outFile, CHUNK_SIZE)
+        inFile.close()
+
+    else:
+        return
+
+    os.remove(path)
+
+
+def fetchRemoteDir(url, destDir, pool, progress=None):
+    """Downloads and unpacks every file in a remote directory. Returns the number of bytes fetched."""
+    if not os.path.exists(destDir):
+        os.makedirs(destDir)
+
+    slot=pool.getHostSlot(url)
+    numBytes=0
+    fetched=[]
+
+    # Failed attempts are retried as in downloadFile. Files already fetched are kept and partial ones resumed:
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        with phase("connection wait"):
+            slot.acquire()
+        try:
+            with phase("network"):
+                for n in listRemoteDir(url):
+                    destPath=os.path.join(destDir, n)
+                    if destPath in fetched:
+                        continue
+                    numBytes+=resumeUrl(url+n, destPath, progress)
+                    fetched.append(destPath)
+            break
+        except ftplib.all_errors+(httplib.HTTPException,):
+            if attempt==DOWNLOAD_ATTEMPTS-1:
+                raise
+        finally:
+            slot.release()
+        time.sleep(2**attempt)
+
+    # Extraction doesn't need a connection, so the host slot is given up first:
+    with phase("extraction"):
+        for f in fetched:
+            extractArchive(f, destDir)
+
+    return numBytes
+
+
+def resumeHttp(url, partPath, offset, progress=None):
+    """Continues an HTTP download at offset with a Range request. Returns (bytes transferred, total size)."""
+    req=urllib2.Request(url)
+    if offset>0:
+        req.add_header("Range", "bytes=%d-" % offset)
+
+    count("http requests")
+    try:
+        urlFile=urllib2.urlopen(req)
+    except urllib2.HTTPError as e:
+        if e.code==416 and offset>0:
+            # Nothing is left past offset. The partial file is complete only if the server says the file is
+            # exactly that long; otherwise it's left over from some other version of the file:
+            contentRange=e.info().getheader("Content-Range", "")
+            if contentRange.split('/')[-1]==str(offset):
+                return (0, offset)
+            open(partPath, "wb").close()
+            return resumeHttp(url, partPath, 0, progress)
+        raise
+
+    total=None
+    if urlFile.getcode()==206:
+        contentRange=urlFile.info().getheader("Content-Range", "")
+        if contentRange.split('/')[-1].isdigit():
+            total=int(contentRange.split('/')[-1])
+        mode="ab"
+    else:
+        # The server ignored the range, so start over:
+        if urlFile.info().getheader("Content-Length") is not None:
+            total=int(urlFile.info().getheader("Content-Length"))
+        mode="wb"
+
+    try:
+        with open(partPath, mode) as out:
+            numBytes=copyStream(urlFile, out, progress)
+    finally:
+        urlFile.close()
+    return (numBytes, total)
+
+
+def resumeFtp(url, partPath, offset, progress=None):
+    """Continues an FTP download at offset with REST. Returns (bytes transferred, total size)."""
+    parsed=urlparse.urlparse(url)
+    ftp=openFtp(parsed)
+    numBytes=[0]
+
+    try:
+        ftp.voidcmd("TYPE I")
+        try:
+            total=ftp.size(parsed.path)
+        except ftplib.error_perm:
+            total=None
+
+        if total is not None and offset>total:
+            # Whatever is in the partial file can't belong to this file:
+            offset=0
+        if total is not None and offset==total:
+            return (0, total)
+
+        with open(partPath, "ab" if offset>0 else "wb") as out:
+            def write(chunk):
+                out.write(chunk)
+                numBytes[0]+=len(chunk)
+                count("network bytes", len(chunk))
+                if progress is not None:
+                    progress.addBytes(len(chunk))
+            ftp.retrbinary("RETR %s" % parsed.path, write, CHUNK_SIZE, offset if offset>0 else None)
+    finally:
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    return (numBytes[0], total)
+
+
+def getFileMd5(path):
+    md5=hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            chunk=f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def resumeUrl(url, destPath, progress=None, md5=None):
+    """Downloads url into destPath, continuing from whatever an earlier attempt left in destPath.part.
+    The size (if the server reports it) and the MD5 sum (if given) are checked before the file is
+    renamed into place. Returns the number of bytes transferred."""
+    url=mirrorUrl(url)
+    partPath=destPath+".part"
+    offset=0
+    if os.path.exists(partPath):
+        offset=os.path.getsize(partPath)
+
+    with phase("network"):
+        if urlparse.urlparse(url).scheme=="ftp":
+            numBytes, total=resumeFtp(url, partPath, offset, progress)
+        else:
+            numBytes, total=resumeHttp(url, partPath, offset, progress)
+
+    size=os.path.getsize(partPath)
+    if total is not None and size!=total:
+        raise IOError("%s is %d bytes, expected %d" % (partPath, size, total))
+    if md5 is not None and getFileMd5(partPath)!=md5.lower():
+        # A corrupt file can't be resumed, so start over next time:
+        os.remove(partPath)
+        raise IOError("Checksum mismatch for %s" % url)
+
+    os.rename(partPath, destPath)
+    return numBytes
+
+
+def downloadFile(job, pool, progress=None):
+    """Downloads a (url, destPath, md5) job while holding a connection slot for its host.
+    Failed attempts are retried, each one resuming the partial file."""
+    url, destPath, md5=job
+    slot=pool.getHostSlot(url)
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        with phase("connection wait"):
+            slot.acquire()
+        try:
+            return resumeUrl(url, destPath, progress, md5)
+        except ftplib.all_errors+(httplib.HTTPException,):
+            # Socket and HTTP errors are IOErrors, but a connection closed without a response isn't.
+            if attempt==DOWNLOAD_ATTEMPTS-1:
+                raise
+        finally:
+            slot.release()
+        time.sleep(2**attempt)
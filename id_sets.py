@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# id_sets.py -- Set operations over sorted arrays of integer element IDs.
+#
+# Every protocol's IDs are kept as a sorted array('I') by geo_index.py. The operations here take and
+# return arrays of that form. They work on hash sets internally, so each runs in time linear in the
+# sizes of its inputs, apart from sorting the result. Query results are saved in the same form.
+
+import sys
+from array import array
+
+
+def toArray(ids):
+    """Returns a sorted array('I') of the given integer IDs."""
+    return array('I', sorted(ids))
+
+
+def intersectSets(sets):
+    """Returns the IDs found in every one of the given sets."""
+    if len(sets)==0:
+        return array('I')
+
+    # Start from the smallest set so that the intermediate results stay small:
+    sets=sorted(sets, key=len)
+    common=set(sets[0])
+    for s in sets[1:]:
+        common.intersection_update(s)
+        if len(common)==0:
+            break
+    return toArray(common)
+
+
+def unionSets(sets):
+    """Returns the IDs found in any of the given sets."""
+    combined=set()
+    for s in sets:
+        combined.update(s)
+    return toArray(combined)
+
+
+def diffSets(base, others):
+    """Returns the IDs in base that aren't in any of the other sets."""
+    remaining=set(base)
+    for s in others:
+        remaining.difference_update(s)
+    return toArray(remaining)
+
+
+def getMembership(sets):
+    """Returns a dictionary of ID -> bitmask of the sets (by position) containing that ID."""
+    masks={}
+    for i in range(len(sets)):
+        bit=1<<i
+        for idNum in sets[i]:
+            masks[idNum]=masks.get(idNum, 0)|bit
+    return masks
+
+
+def overlapMatrix(sets):
+    """Returns a matrix m where m[i][j] is the number of IDs that sets i and j have in common.
+    The diagonal holds the size of each set. All IDs are visited only once."""
+    maskCounts={}
+    for mask in getMembership(sets).values():
+        maskCounts[mask]=maskCounts.get(mask, 0)+1
+
+    matrix=[[0]*len(sets) for i in range(len(sets))]
+    # There are far fewer distinct masks than IDs, so this part is cheap:
+    for mask, count in maskCounts.items():
+        members=[i for i in range(len(sets)) if (mask>>i)&1==1]
+        for i in members:
+            for j in members:
+                matrix[i][j]+=count
+    return matrix
+
+
+# Query files start with this header, followed by the IDs as an array of little-endian 32 bit integers. The
+# IDs are sorted unless the file holds the results of a query, which keep the order they were printed in:
+ID_FILE_MAGIC="GEOIDSET\x01\n"
+
+
+def writeIdFile(f, ids, ordered=False):
+    """Writes a set of integer IDs to an open file in the binary query file format. If ordered is True, the
+    IDs are kept in the order given, less any repeats, rather than sorted."""
+    if ordered:
+        seen=set()
+        unique=array('I')
+        for i in ids:
+            if i not in seen:
+                seen.add(i)
+                unique.append(i)
+        ids=unique
+    else:
+        ids=toArray(set(ids))
+    if sys.byteorder=="big":
+        ids.byteswap()
+    f.write(ID_FILE_MAGIC)
+    f.write(ids.tostring())
+
+
+def isIdFile(path):
+    """Returns True if path is a query file in the binary format."""
+    with open(path, "rb") as f:
+        return f.read(len(ID_FILE_MAGIC))==ID_FILE_MAGIC
+
+
+def readIdFile(path):
+    """Returns the IDs in a query file as an array('I'). Both the binary format and the older
+    text format, with one ID per line, are understood. Raises ValueError if a text file holds
+    anything other than IDs and the QUERY lines written by query_geo.py."""
+    with open(path, "rb") as f:
+        contents=f.read()
+
+    if contents.startswith(ID_FILE_MAGIC):
+        ids=array('I')
+        ids.fromstring(contents[len(ID_FILE_MAGIC):])
+        if sys.byteorder=="big":
+            ids.byteswap()
+        return ids
+
+    # Text files keep their order, since they may have been written by hand:
+    ids=array('I')
+    for l in contents.splitlines():
+        if l.startswith("QUERY "):
+            continue
+        for tok in l.split():
+            if not tok.isdigit():
+                raise ValueError("%s holds %s, which isn't an ID number" % (path, tok))
+            ids.append(int(tok))
+    return ids
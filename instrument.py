@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# instrument.py -- Optional profiling of the command line tools.
+#
+# Every tool accepts --profile and --trace, which are handled by run(). When either is given, the time
+# spent in each phase of the work (loading the catalog, filtering, rendering, network, extraction and
+# so on) is recorded, along with counts of file opens, stats, directory listings, bytes read and
+# network requests. A summary is written to stderr at exit. --profile=<file> also writes a cProfile
+# dump, and --trace=<file> writes every phase as a Chrome trace, which chrome://tracing or Perfetto
+# can display.
+#
+# The code being measured marks phases with "with phase(name):" and counts events with count(). Both
+# check a single global and return at once when nothing is being recorded. Without the switches,
+# the file system functions aren't touched at all.
+
+import os
+import sys
+import time
+import json
+import cProfile
+import thread
+import threading
+import __builtin__
+
+
+# The active Recorder, or None:
+recorder=None
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+NULL_PHASE=NullPhase()
+
+
+class Phase(object):
+    def __init__(self, rec, name):
+        self.rec=rec
+        self.name=name
+
+    def __enter__(self):
+        active=self.rec.getActive()
+        # A phase entered again from inside itself, ie. a network call made by another, is only timed once:
+        self.nested=self.name in active
+        active.append(self.name)
+        self.startTime=time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        endTime=time.time()
+        self.rec.getActive().pop()
+        if not self.nested:
+            self.rec.addPhase(self.name, self.startTime, endTime)
+        return False
+
+
+def readProcIo():
+    """Returns the counters in /proc/self/io, or an empty dictionary where it isn't available."""
+    counters={}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for l in f.read().splitlines():
+                ltoks=l.split(':')
+                if len(ltoks)==2:
+                    counters[ltoks[0].strip()]=int(ltoks[1])
+    except IOError:
+        pass
+    return counters
+
+
+class Recorder(object):
+    """Collects phase times and counters from every thread."""
+
+    def __init__(self, trace=False):
+        self.startTime=time.time()
+        self.startCpu=os.times()
+        self.startIo=readProcIo()
+        self.phases={}
+        self.order=[]
+        self.counters={}
+        self.events=[] if trace else None
+        self.local=threading.local()
+        self.lock=threading.Lock()
+
+    def getActive(self):
+        if not hasattr(self.local, "active"):
+            self.local.active=[]
+        return self.local.active
+
+    def addPhase(self, name, startTime, endTime):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name]=[0, 0.0]
+                self.order.append(name)
+            self.phases[name][0]+=1
+            self.phases[name][1]+=endTime-startTime
+            if self.events is not None:
+                self.events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": thread.get_ident(),
+                                    "ts": int((startTime-self.startTime)*1000000), "dur": int((endTime-startTime)*1000000)})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name]=self.counters.get(name, 0)+n
+
+    def finish(self):
+        """Takes the final readings. Returns (wall, user, system) times."""
+        self.wall=time.time()-self.startTime
+        cpu=os.times()
+        io=readProcIo()
+        # /proc/self/io counts sockets along with files:
+        if "rchar" in io:
+            self.counters["bytes read"]=io["rchar"]-self.startIo.get("rchar", 0)
+            self.counters["read calls"]=io["syscr"]-self.startIo.get("syscr", 0)
+        return (self.wall, cpu[0]-self.startCpu[0], cpu[1]-self.startCpu[1])
+
+    def report(self, name, times, log=None):
+        if log is None:
+            # Looked up here, since a daemon answering a client replaces stderr for each request:
+            log=sys.stderr.write
+        log("Profile of %s: %.3fs wall, %.3fs user, %.3fs system\n" % (name, times[0], times[1], times[2]))
+        if len(self.order)>0:
+            # Phases run on worker threads can add up to more than the wall time:
+            log("%-20s %8s %10s\n" % ("Phase", "Calls", "Seconds"))
+            for p in self.order:
+                log("%-20s %8d %10.3f\n" % (p, self.phases[p][0], self.phases[p][1]))
+        log("%s\n" % ", ".join(["%s: %d" % (c, self.counters[c]) for c in sorted(self.counters.keys())]))
+
+    def writeTrace(self, path):
+        events=list(self.events)
+        for c in sorted(self.counters.keys()):
+            events.append({"name": c, "ph": "C", "pid": os.getpid(), "tid": thread.get_ident(),
+                           "ts": int(self.wall*1000000), "args": {"count": self.counters[c]}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def phase(name):
+    """Returns a context manager timing the code inside it as part of the named phase."""
+    if recorder is None:
+        return NULL_PHASE
+    return Phase(recorder, name)
+
+
+def count(name, n=1):
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+# The file system functions replaced while recording, and what they're counted as:
+HOOKS=[(__builtin__, "open", "file opens"), (os, "open", "file opens"), (os, "stat", "stats"),
+       (os, "lstat", "stats"), (os, "listdir", "directory listings")]
+
+
+def makeHook(func, name):
+    def hook(*args, **kwargs):
+        count(name)
+        return func(*args, **kwargs)
+    return hook
+
+
+# The functions replaced by start(), in the order of HOOKS:
+originals=[]
+
+
+def start(trace=False):
+    global recorder
+    recorder=Recorder(trace)
+    for module, attr, name in HOOKS:
+        originals.append(getattr(module, attr))
+        setattr(module, attr, makeHook(getattr(module, attr), name))
+
+
+def stop():
+    """Stops recording and puts the file system functions back. Returns the recorder."""
+    global recorder
+    rec=recorder
+    recorder=None
+    for i in range(len(HOOKS)):
+        setattr(HOOKS[i][0], HOOKS[i][1], originals[i])
+    del originals[:]
+    return rec
+
+
+def run(main, args):
+    """Calls main(args) with --profile and --trace taken out of args, recording whatever they ask for."""
+    profilePath=None
+    tracePath=None
+    enabled=False
+
+    newArgs=[]
+    for a in args:
+        aToks=a.split('=', 1)
+        if aToks[0]=="--profile":
+            enabled=True
+            if len(aToks)>1:
+                profilePath=aToks[1]
+        elif aToks[0]=="--trace" and len(aToks)>1:
+            enabled=True
+            tracePath=aToks[1]
+        else:
+            newArgs.append(a)
+
+    if not enabled:
+        return main(newArgs)
+
+    start(tracePath is not None)
+    profiler=None
+    try:
+        if profilePath is not None:
+            profiler=cProfile.Profile()
+            return profiler.runcall(main, newArgs)
+        return main(newArgs)
+    finally:
+        rec=stop()
+        times=rec.finish()
+        if profiler is not None:
+            profiler.dump_stats(profilePath)
+        if tracePath is not None:
+            rec.writeTrace(tracePath)
+        rec.report(os.path.basename(args[0]), times)
@@ -5,47 +5,30 @@
 
 import os
 import sys
-import urllib
-import httplib
+import time
+from cStringIO import StringIO
 import xml.etree.ElementTree as ETree
+from geo_store import openStore, GeoStore, migrateDirTree, STORE_NAME
+from display_table import removeDisplayTable
+from eutils import getClient, iterSearchIds
+from geo_transfer import WorkerPool
+from instrument import phase
+import instrument
 
 
-def genDirs(idlist, dbdir, queryType):
-    outDir=os.path.join(dbdir, queryType)
-    
-    if not os.path.exists(outDir):
-        os.makedirs(outDir)
-        
-    for i in idlist:
-        dpath=os.path.join(outDir, i)
-        try:
-            os.makedirs(dpath)
-        except:
-            pass
-
+# Number of summaries requested at a time, and how often a chunk is attempted before giving up on it:
+CHUNK_SIZE=500
+CHUNK_ATTEMPTS=3
 
-def genQuery(idlist):
-    """This function generates a query string."""
-    rStr="db=gds&id=%s" % idlist[0]
-    
-    for i in idlist[1:]:
-        rStr+=",%s" % i
-        
-    return rStr
+# Number of IDs read from an ID file and posted at once:
+POST_BATCH=10000
 
 
-def ePost(query):
-    # Since urllib isn't working for a dataset this large, we may need to manually POST the data
-    # with httplib:
-    #conn=httplib.HTTPConnection("eutils.ncbi.nlm.nih.gov")
-    #header={"Content-type": "application/x-www-form-urlencoded", "Accept":"text/xml"}
-    #conn.request("POST", "/entrez/eutils/epost.fcgi", query, header)
-    urlFile=urllib.urlopen("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/epost.fcgi", query)
-    
-    # Now parse the XML tree:
-    contents=urlFile.read()
+def ePost(ids):
+    """Uploads a list of IDs to the History server, returning (webEnv, queryKey)."""
+    # The IDs are POSTed, so it doesn't matter how long the list is:
+    contents=getClient().fetch("epost", {"db": "gds", "id": ",".join(ids)})
     root=ETree.fromstring(contents)
-    urlFile.close()
     
     webEnv=None
     queryKey=None
@@ -63,12 +46,196 @@ def ePost(query):
     else:
         return (webEnv, queryKey)
 
+
+def iterDocSums(contents):
+    """Stream-parses an esummary response, yielding each <DocSum> element. Elements are cleared once
+    the caller moves on, so the tree for the whole response is never built."""
+    root=None
+    for event, elem in ETree.iterparse(StringIO(contents), events=("start", "end")):
+        if event=="start":
+            if root is None:
+                root=elem
+            continue
+        
+        if elem.tag=="DocSum":
+            yield elem
+            elem.clear()
+            root.clear()
+        elif elem.tag=="ERROR":
+            raise IOError("esummary returned an error: %s" % elem.text)
+
+
+def parseDocSum(doc):
+    """Returns (id, entry) for a <DocSum> element."""
+    # Terrible assumption: the first element in a child should always be its id:
+    curid=doc[0].text
+    accession=""
+    postedDate=""
+    title=u""
+    summary=u""
+    datalist=[]
+    relations=[]
+    taxon=u""
+    matrixURL=""
+    entryType=""
+    
+    for c in doc[1:]:
+        curname=c.attrib["Name"]
+        if curname=="title":
+            title=c.text
+        elif curname=="summary":
+            summary=c.text
+        elif curname=="taxon":
+            taxon=c.text
+        elif curname=="PDAT":
+            postedDate=c.text
+        elif curname=="Accession":
+            accession=c.text
+        elif curname=="entryType":
+            entryType=c.text
+        elif curname=="Samples":
+            for sample in c:
+                # This should be (Title, Accession#)
+                datalist.append((sample[1].text, sample[0].text))
+        elif curname=="FTPLink":
+            matrixURL=c.text
+        elif curname=="ExtRelations":
+            for r in c:
+                # This should be SRP#, URL to all the SRA reads.
+                relations.append((r[1].text, r[2].text))
+    
+    return (curid, {"title": title, "posted": postedDate, "accession": accession, "taxon": taxon,
+                    "entryType": entryType, "matrixUrl": matrixURL, "summary": summary,
+                    "datalist": datalist, "relations": relations})
+
+
+def fetchChunk(job):
+    """Fetches and parses one page of summaries from a posted ID list."""
+    webEnv, queryKey, retStart=job
+    params={"db": "gds", "WebEnv": webEnv, "query_key": queryKey, "retstart": retStart, "retmax": CHUNK_SIZE}
     
+    for attempt in range(CHUNK_ATTEMPTS):
+        try:
+            contents=getClient().fetch("esummary", params)
+            with phase("parsing"):
+                return [parseDocSum(doc) for doc in iterDocSums(contents)]
+        except (IOError, SyntaxError) as e:
+            # The client has already retried the request itself; this also covers truncated or bad responses.
+            if attempt==CHUNK_ATTEMPTS-1:
+                raise
+            print("Retrying chunk at %d (%s)" % (retStart, e))
+
+
+def fetchSummaries(store, sourceQuery, ids, numWorkers):
+    """Fetches the summaries of ids in chunks, several at a time, and adds them to the store.
+    Returns the number of IDs whose chunk could not be fetched."""
+    posted=ePost(ids)
+    if posted is None:
+        print("Error: ePost didn't return a valid query key or WebEnv parameter.")
+        return len(ids)
+    
+    webEnv, queryKey=posted
+    jobs=[(webEnv, queryKey, start) for start in range(0, len(ids), CHUNK_SIZE)]
+    print("Fetching data in %d chunk(s)..." % len(jobs))
+    
+    numFailed=0
+    pool=WorkerPool(numWorkers)
+    for job, entries, error in pool.run(jobs, fetchChunk):
+        if error is not None:
+            print("ERROR: Could not fetch summaries %d-%d: %s" % (job[2], job[2]+CHUNK_SIZE-1, error))
+            numFailed+=min(CHUNK_SIZE, len(ids)-job[2])
+            continue
+        
+        with phase("storing"):
+            for curid, entry in entries:
+                store.putEntry(sourceQuery, curid, entry)
+            store.commit()
+    
+    return numFailed
+
+
+def findChangedIds(sourceQuery, since):
+    """Returns the set of IDs matching sourceQuery whose entries were modified on or after since (yyyy/mm/dd)."""
+    # Look a day ahead so that time zone differences with NCBI can't hide today's changes:
+    until=time.strftime("%Y/%m/%d", time.localtime(time.time()+86400))
+    params={"db": "gds", "term": sourceQuery, "datetype": "mdat", "mindate": since, "maxdate": until}
+    return set(iterSearchIds(getClient(), params))
+
+
+def findUpdates(store, sourceQuery):
+    """Returns (fetched, changed): the IDs of a protocol that are already in the store, and the IDs
+    that have been modified since the last refresh."""
+    fetched=set(store.listFetchedIds(sourceQuery))
+    
+    lastRefresh=store.getIndex().getRefreshDate(sourceQuery)
+    if lastRefresh is None:
+        print("No earlier refresh of %s is recorded, so only new elements will be fetched." % sourceQuery)
+        return (fetched, set())
+    
+    return (fetched, findChangedIds(sourceQuery, lastRefresh))
+
+
+def readIdBatches(infile, batchSize):
+    """Yields lists of up to batchSize IDs from an ID file. Lines are read as they become available,
+    so IDs can be piped in from a search that is still running."""
+    batch=[]
+    while True:
+        l=infile.readline()
+        if not l:
+            break
+        
+        l=l.strip()
+        if len(l)>0:
+            batch.append(l)
+        if len(batch)>=batchSize:
+            yield batch
+            batch=[]
+    
+    if len(batch)>0:
+        yield batch
+
+
 def main(args):
+    useStore=False
+    migrate=False
+    update=False
+    numWorkers=4
+
+    # Strip out switches so that the positional arguments keep their meaning:
+    newArgs=[]
+    for a in args:
+        if a=="--store":
+            useStore=True
+        elif a=="--migrate":
+            migrate=True
+        elif a=="--update":
+            update=True
+        elif a.startswith("-j="):
+            numWorkers=int(a.split('=')[1])
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if migrate and len(args)==2:
+        dbDir=args[1]
+        print("Migrating %s into %s..." % (dbDir, os.path.join(dbDir, STORE_NAME)))
+        numMigrated=migrateDirTree(dbDir, sys.stdout.write)
+        removeDisplayTable(dbDir)
+        print("Migrated %d elements." % numMigrated)
+        return
+
     if len(args)<3:
-        print("Usage: %s idfile(s) dbdir" % args[0])
+        print("Usage: %s [--store] [--update] [-j=<n>] idfile(s) dbdir" % args[0])
+        print("       %s --migrate dbdir" % args[0])
         print("Fetches project summaries and adds appropriate metadata to a database of GEO GRO-Seq data.")
         print("WARNING: This script may generate several thousand directories under dbdir.")
+        print("If --store is specified, metadata is kept in a single indexed file in dbdir instead.")
+        print("If --migrate is specified, an existing dbdir tree is copied into such a file.")
+        print("If --update is specified, only elements that are new or have changed since the last run are fetched.")
+        print("-j=<n> sets the number of chunks of summaries fetched at once (4 by default).")
+        print("An idfile of - reads IDs from stdin, ie. piped from query_geo.py.")
+        print("If --profile is specified, a breakdown of where the time went is written to stderr at exit.")
+        print("--profile=<file> also writes a cProfile dump, and --trace=<file> a Chrome trace.")
         return
     
     # Attempt to create our database directory:
@@ -76,127 +243,72 @@ def main(args):
     if not os.path.exists(dbDir):
         os.mkdir(dbDir)
     
+    # Once a store has been created in dbDir, it is always used:
+    if useStore:
+        store=GeoStore(dbDir)
+    else:
+        store=openStore(dbDir)
+    
+    # The accession index is kept up to date as summaries are written, so make sure it exists first.
+    # Titles may change, so the display table used by the query tool is rebuilt the next time it's needed.
+    store.getIndex().ensureAccessions(store)
+    removeDisplayTable(dbDir)
+    
     # Trim the beginning and end off of the args list:
     args=args[1:]
     args=args[:-1]
     
     for a in args:
-        infile=open(a, "r")
-        ids=infile.read().splitlines()
+        if a=="-":
+            infile=sys.stdin
+        else:
+            infile=open(a, "r")
         sourceQuery="gro-seq"
         
-        headerToks=ids[0].split()
+        headerToks=infile.readline().split()
         if len(headerToks)>1:
             sourceQuery=headerToks[1]
         
-        ids=ids[1:]
-        genDirs(ids, dbDir, sourceQuery)
-        qstr=genQuery(ids)
-        
-        curPath=os.path.join(dbDir, sourceQuery)
+        # Changes made from here on will be picked up by the next update:
+        startDate=time.strftime("%Y/%m/%d")
+        if update:
+            fetched, changed=findUpdates(store, sourceQuery)
         
-        # Now let's query the database:
-        # Use ePost to cache the query:
-        #webEnv=None
-        #queryKey=None
+        numIds=0
+        numNew=0
+        numChanged=0
+        numFailed=0
         
-        # TODO: Consider just running the query and having the eSearch script store its results 
-        # in a WebEnv.
-        #try:
-        #    webEnv, queryKey=ePost(qstr)
-        #except:
-        #    print("Error: ePost didn't return a valid query key or WebEnv parameter.")
-        #    return
-        
-        #qstr="db=gds&query_key=%s&WebEnv=%s" % (queryKey, webEnv)
-        
-        urlFile=urllib.urlopen("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi", qstr)
-        projects=[]
+        # IDs are handled a batch at a time, so that ingestion starts before a piped search finishes:
+        for ids in readIdBatches(infile, POST_BATCH):
+            numIds+=len(ids)
+            if update:
+                newIds=[i for i in ids if i not in fetched]
+                changedIds=[i for i in ids if i in fetched and i in changed]
+                numNew+=len(newIds)
+                numChanged+=len(changedIds)
+                ids=newIds+changedIds
+            else:
+                store.prepareEntries(sourceQuery, ids)
+            
+            if len(ids)>0:
+                numFailed+=fetchSummaries(store, sourceQuery, ids, numWorkers)
         
-        print("Fetching data...")
-        searchTree=ETree.parse(urlFile)
-        root=searchTree.getroot()
+        if infile is not sys.stdin:
+            infile.close()
         
-        for doc in root:
-            # Terrible assumption: the first element in a child should always be its id:
-            curid=doc[0].text
-            summaryfile=open(os.path.join(curPath, curid, "summary.txt"), "w")
-            taxonfile=open(os.path.join(curPath, curid, "taxon.txt"), "w")
-            datalistfile=open(os.path.join(curPath, curid, "datalist.txt"), "w")
-            relationfile=open(os.path.join(curPath, curid, "relations.txt"), "w")
-            typefile=open(os.path.join(curPath, curid, "type.txt"), "w")
-            
-            accession=""
-            postedDate=""
-            title=u""
-            summary=u""
-            datalist=[]
-            relations=[]
-            taxon=u""
-            matrixURL=""
-            entryType=""
-            
-            for c in doc[1:]:
-                curname=c.attrib["Name"]
-                if curname=="title":
-                    title=c.text
-                elif curname=="summary":
-                    summary=c.text
-                elif curname=="taxon":
-                    taxon=c.text
-                elif curname=="PDAT":
-                    postedDate=c.text
-                elif curname=="Accession":
-                    accession=c.text
-                elif curname=="entryType":
-                    entryType=c.text
-                elif curname=="Samples":
-                    for sample in c:
-                        # This should be (Title, Accession#)
-                        datalist.append((sample[1].text, sample[0].text))
-                elif curname=="FTPLink":
-                    matrixURL=c.text
-                elif curname=="ExtRelations":
-                    for r in c:
-                        # This should be SRP#, URL to all the SRA reads.
-                        relations.append((r[1].text, r[2].text))
-            
-            summaryfile.write((u"Title: "+title+u"\n").encode('utf8'))
-            summaryfile.write(u"Posted: %s\n" % postedDate)
-            summaryfile.write(u"Accession nr: %s\n" % accession)
-            summaryfile.write(u"Species: %s\n" % taxon)
-            summaryfile.write(u"Entry Type: %s\n" % entryType)
-            summaryfile.write(u"Matrix URL/FTP Link: %s\n" % matrixURL)
-            summaryfile.write(u"Summary (begins on next line):\n")
-            summaryfile.write(summary.encode('utf8'))
-            summaryfile.close()
-            
-            taxonfile.write("%s" % taxon)
-            taxonfile.close()
-            
-            for d in datalist:
-                # It appears that sample titles are all one "word"
-                datalistfile.write((d[0]+u" "+d[1]).encode('utf8'))
-                datalistfile.write(u"\n")
-            
-            datalistfile.close()
-            
-            for r in relations:
-                relationfile.write("%s %s\n" % (r[0], r[1]))
-            
-            relationfile.close()
-            
-            typefile.write(entryType.strip())
-            typefile.close()
-            
-            if matrixURL is not None:
-                matrixfile=open(os.path.join(curPath, curid, "matrixpath.txt"), "w")
-                matrixfile.write(matrixURL)
-                matrixfile.write("\n")
-                matrixfile.close()
+        if update:
+            print("%s: %d new and %d changed element(s) out of %d." % (sourceQuery, numNew, numChanged, numIds))
         
-        urlFile.close()
+        if numFailed>0:
+            print("WARNING: %d summaries from %s could not be fetched. Run this again to retry them." % (numFailed, a))
+        else:
+            store.getIndex().setRefreshDate(sourceQuery, startDate)
+            store.commit()
+    
+    store.close()
+    print(getClient().metrics.summary())
 
 
 if __name__=="__main__":
-    main(sys.argv)
\ No newline at end of file
+    instrument.run(main, sys.argv)
\ No newline at end of file
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# miniml.py -- Streaming readers for the MINiML series matrix files fetched by fetchmatrices.
+#
+# Matrix files for large series can be hundreds of megabytes. Rather than building the whole tree
+# in memory, these readers walk the file with iterparse and throw every top-level element away once
+# it has been looked at, so memory use stays flat no matter how large the file is.
+
+import os
+import marshal
+from instrument import phase
+
+try:
+    import xml.etree.cElementTree as ETree
+except ImportError:
+    import xml.etree.ElementTree as ETree
+
+
+MINIML_NS="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}"
+
+
+def iterElements(path, tags):
+    """Yields every top-level element of a MINiML file whose tag (without namespace) is in tags.
+    Elements are cleared once the caller moves on, so they must not be kept around."""
+    wanted=set([MINIML_NS+t for t in tags])
+    f=open(path, "rb")
+    try:
+        depth=0
+        root=None
+        for event, elem in ETree.iterparse(f, events=("start", "end")):
+            if event=="start":
+                if root is None:
+                    root=elem
+                depth+=1
+                continue
+
+            depth-=1
+            if depth==1:
+                if elem.tag in wanted:
+                    yield elem
+                # Drop the element and the root's reference to it:
+                elem.clear()
+                root.clear()
+    finally:
+        f.close()
+
+
+def findChild(elem, tag):
+    return elem.find(MINIML_NS+tag)
+
+
+def findContribNameDate(matFile):
+    """Returns the first contributor's last name followed by the series release year, ie. Smith2016."""
+    firstContrib=None
+    pubYear=None
+
+    for elem in iterElements(matFile, ["Contributor", "Series"]):
+        if elem.tag==MINIML_NS+"Contributor":
+            if firstContrib is None and elem.attrib.get('iid')=="contrib1":
+                lastName=elem.find("%sPerson/%sLast" % (MINIML_NS, MINIML_NS))
+                if lastName is not None:
+                    firstContrib=lastName.text
+        else:
+            for date in elem.findall("%sStatus/%sRelease-Date" % (MINIML_NS, MINIML_NS)):
+                # Dates are formatted as yyyy-mm-dd
+                newPubYear=date.text.split('-')[0]
+                if pubYear is None or int(pubYear)<int(newPubYear):
+                    pubYear=newPubYear
+
+        # Stop reading as soon as both values have been found:
+        if firstContrib is not None and pubYear is not None:
+            break
+
+    if firstContrib is None or pubYear is None:
+        return None
+
+    return firstContrib+pubYear
+
+
+def readSample(elem):
+    """Pulls the fields used by the query tools out of a <Sample> element."""
+    sample={"iid": elem.attrib.get('iid'), "type": None, "strategy": "", "relation": "", "sraUrls": []}
+
+    for child in elem:
+        if child.tag==MINIML_NS+"Type":
+            sample["type"]=child.text
+        elif child.tag==MINIML_NS+"Library-Strategy":
+            sample["strategy"]=child.text
+        elif child.tag==MINIML_NS+"Relation":
+            if child.attrib.get('type')=="SRA":
+                sample["relation"]=child.attrib['target']
+        elif child.tag==MINIML_NS+"Supplementary-Data":
+            # Some samples have an empty entry in place of a link:
+            if child.attrib.get("type")=="SRA Experiment" and child.text:
+                sample["sraUrls"].append(child.text.strip())
+
+    return sample
+
+
+def iterSamples(matFile):
+    """Yields a dictionary for every sample defined in a MINiML file."""
+    for elem in iterElements(matFile, ["Sample"]):
+        yield readSample(elem)
+
+
+# Everything the query tools need from a series' matrix files is extracted in one pass and kept
+# in this file in the element's directory:
+SERIES_CACHE_NAME="seriescache.bin"
+
+
+def extractSeries(matFiles):
+    """Reads every MINiML file of a series once, returning its contributors, release dates and samples."""
+    info={"contributors": [], "releaseDates": [], "samples": []}
+
+    for matFile in matFiles:
+        for elem in iterElements(matFile, ["Contributor", "Sample", "Series"]):
+            if elem.tag==MINIML_NS+"Contributor":
+                lastName=elem.find("%sPerson/%sLast" % (MINIML_NS, MINIML_NS))
+                if lastName is not None:
+                    info["contributors"].append((elem.attrib.get('iid'), lastName.text))
+            elif elem.tag==MINIML_NS+"Sample":
+                info["samples"].append(readSample(elem))
+            else:
+                for date in elem.findall("%sStatus/%sRelease-Date" % (MINIML_NS, MINIML_NS)):
+                    info["releaseDates"].append(date.text)
+
+    return info
+
+
+def getSeriesContribName(info):
+    """Returns the same Lastname+year string as findContribNameDate, but from extracted series info."""
+    firstContrib=None
+    for iid, lastName in info["contributors"]:
+        if iid=="contrib1":
+            firstContrib=lastName
+            break
+
+    years=[int(d.split('-')[0]) for d in info["releaseDates"]]
+    if firstContrib is None or len(years)==0:
+        return None
+
+    return "%s%d" % (firstContrib, max(years))
+
+
+def getMatrixSignature(matFiles):
+    """Identifies a set of matrix files by name, modification time and size."""
+    signature=[]
+    for matFile in matFiles:
+        st=os.stat(matFile)
+        signature.append((os.path.basename(matFile), st.st_mtime, st.st_size))
+    return signature
+
+
+def listMatrixFiles(matDir):
+    """Returns the paths of all MINiML files in a matrix directory."""
+    return [os.path.join(matDir, f) for f in sorted(os.listdir(matDir)) if f.split(".")[-1]=="xml"]
+
+
+def getSeriesInfo(path):
+    """Returns the contributors, release dates and samples read from the matrix files of the element at path.
+    The matrix files are only parsed again if they've changed since they were last read."""
+    return loadSeriesInfo(path, listMatrixFiles(os.path.join(path, "matrices")))
+
+
+def loadSeriesInfo(path, matFiles):
+    """Returns the extracted series info for the element at path, re-reading the matrix files
+    only if they have changed since the cache was written."""
+    cachePath=os.path.join(path, SERIES_CACHE_NAME)
+    signature=getMatrixSignature(matFiles)
+
+    if os.path.exists(cachePath):
+        try:
+            with open(cachePath, "rb") as f:
+                cached=marshal.load(f)
+            if cached["signature"]==signature:
+                return cached["info"]
+        except (EOFError, ValueError, TypeError, KeyError):
+            # A damaged or outdated cache is simply rebuilt.
+            pass
+
+    with phase("parsing"):
+        info=extractSeries(matFiles)
+
+    # Write to a temporary file first so that a reader never sees a partial cache:
+    tmpPath=cachePath+".tmp"
+    with open(tmpPath, "wb") as f:
+        marshal.dump({"signature": signature, "info": info}, f)
+    os.rename(tmpPath, cachePath)
+
+    return info
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# query_client.py -- Runs query_groseq_database.py commands through a running query_daemon.py.
+#
+# The arguments are exactly those of query_groseq_database.py. If a daemon is serving the database
+# directory, the command line is sent to it over its Unix socket and whatever it writes is copied to
+# stdout and stderr, so the database isn't loaded again for every command. Commands that fetch or
+# change data, and every command when no daemon is running, are run by query_groseq_database.py itself.
+#
+# A request is one line of JSON: {"args": [...], "cwd": <directory>, "stdin": <contents or null>}.
+# The answer is a series of frames, each a kind byte, a big-endian uint32 length and the payload:
+#   O, E  output for stdout and stderr
+#   X     the exit status, which ends the answer
+#   R     the daemon won't run the command, which is then run locally instead
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+import subprocess
+
+
+QUERY_TOOL=os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_groseq_database.py")
+
+# Where the daemon listens unless -socket or GEO_QUERY_SOCKET say otherwise:
+DAEMON_SOCKET_NAME=".querydaemon.sock"
+
+FRAME=struct.Struct(">cI")
+
+# Commands that only read the database, and so can be answered by the daemon:
+DAEMON_COMMANDS=["listprotocols", "queryprotocol", "protocoloverlap", "listspecies", "findspecies", "getsummary",
+                 "getreadytosra", "getreadytodownload", "getbyyear", "getbycontributor", "listyears", "listcontribs",
+                 "getbyaccession", "select", "search", "qfunion", "qfintersect", "qfdiff", "listsras"]
+
+
+def splitCommand(args):
+    """Returns (dbdir, command) from a query_groseq_database.py command line, or None if it has neither."""
+    # Switches may appear anywhere, and always carry their values after an =:
+    positional=[a for a in args[1:] if a=="-" or not a.startswith('-')]
+    if len(positional)<2:
+        return None
+    return (positional[0], positional[1])
+
+
+def getSocketPath(dbdir):
+    if "GEO_QUERY_SOCKET" in os.environ:
+        return os.environ["GEO_QUERY_SOCKET"]
+    return os.path.join(dbdir, DAEMON_SOCKET_NAME)
+
+
+def sendFrame(sock, kind, payload):
+    sock.sendall(FRAME.pack(kind, len(payload))+payload)
+
+
+def readFrame(f):
+    header=f.read(FRAME.size)
+    if len(header)<FRAME.size:
+        raise IOError("The query daemon closed the connection")
+    kind, length=FRAME.unpack(header)
+    return (kind, f.read(length))
+
+
+def runRemote(socketPath, args, stdin):
+    """Has the daemon listening on socketPath run a command line, with stdin as its standard input.
+    Returns its exit status, or None if there's no daemon there or it won't run the command."""
+    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except socket.error as e:
+        # A socket left behind by a daemon that has since exited is the same as none at all:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK):
+            sock.close()
+            return None
+        raise
+
+    request={"args": args, "cwd": os.getcwd(), "stdin": stdin}
+    sock.sendall(json.dumps(request)+"\n")
+
+    f=sock.makefile("rb")
+    try:
+        while True:
+            kind, payload=readFrame(f)
+            if kind=="O":
+                sys.stdout.write(payload)
+            elif kind=="E":
+                sys.stderr.write(payload)
+            elif kind=="X":
+                sys.stdout.flush()
+                return int(payload)
+            elif kind=="R":
+                return None
+    finally:
+        f.close()
+        sock.close()
+
+
+def main(args):
+    command=splitCommand(args)
+    if command is None or command[1] not in DAEMON_COMMANDS:
+        os.execv(sys.executable, [sys.executable, QUERY_TOOL]+args[1:])
+
+    # Only commands that read accessions from stdin need it, and it can only be read once:
+    stdin=sys.stdin.read() if "-" in args[1:] else None
+    status=runRemote(getSocketPath(command[0]), args, stdin)
+    if status is not None:
+        return status
+
+    # Run it here instead, exactly as it was given:
+    if stdin is None:
+        os.execv(sys.executable, [sys.executable, QUERY_TOOL]+args[1:])
+    proc=subprocess.Popen([sys.executable, QUERY_TOOL]+args[1:], stdin=subprocess.PIPE)
+    proc.communicate(stdin)
+    return proc.returncode
+
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv))
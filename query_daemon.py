@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# query_daemon.py -- Answers query_groseq_database.py commands from a process that keeps running.
+#
+# Every run of query_groseq_database.py opens the database and loads its ID sets, indexes and display
+# table before it can answer anything. The daemon loads them once and keeps them, answering the command
+# lines query_client.py sends it over a Unix socket (dbdir/.querydaemon.sock by default). Each command
+# is run by query_groseq_database.py's own code, in the client's working directory and with its stdin,
+# so its output and .lastquery file are exactly what running the tool would give. Commands are answered
+# one at a time.
+#
+# The database directory is checked for changes before every command and every few seconds in between,
+# by comparing the mtimes of the protocol directories, the store, the index and the display table.
+# Whenever make_groseq_database.py or a fetch changes any of them, everything is loaded again.
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import traceback
+import SocketServer
+from cStringIO import StringIO
+from geo_catalog import GeoCatalog
+from geo_store import STORE_NAME
+from geo_index import INDEX_NAME
+from display_table import DISPLAY_TABLE_NAME, getDisplayTable, closeDisplayTable
+from query_client import DAEMON_COMMANDS, splitCommand, getSocketPath, sendFrame
+import query_groseq_database
+import instrument
+
+
+# Seconds between checks for changes while no commands arrive:
+POLL_INTERVAL=5.0
+
+# Files in the database directory that are watched. Other dot files, ie. .lastquery, are ignored.
+WATCHED_FILES=[STORE_NAME, INDEX_NAME, DISPLAY_TABLE_NAME]
+
+# Output is sent to the client in pieces of up to this size:
+FRAME_SIZE=65536
+
+
+def getSignature(basedir):
+    """Returns a value that changes whenever the database in basedir does."""
+    signature=[]
+    for name in sorted(os.listdir(basedir)):
+        if name.startswith('.') and name not in WATCHED_FILES:
+            continue
+        try:
+            st=os.stat(os.path.join(basedir, name))
+        except OSError:
+            # It was removed after it was listed.
+            continue
+        signature.append((name, st.st_ino, st.st_mtime, st.st_size))
+    return signature
+
+
+class FrameWriter(object):
+    """A file-like object sending what's written to it to the client as frames of one kind."""
+
+    def __init__(self, sock, kind):
+        self.sock=sock
+        self.kind=kind
+        self.pending=[]
+        self.size=0
+        # Needed by the print statement:
+        self.softspace=0
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s=s.encode("utf-8")
+        self.pending.append(s)
+        self.size+=len(s)
+        if self.size>=FRAME_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for l in lines:
+            self.write(l)
+
+    def flush(self):
+        if self.size>0:
+            sendFrame(self.sock, self.kind, "".join(self.pending))
+            self.pending=[]
+            self.size=0
+
+    def isatty(self):
+        return False
+
+
+class QueryDaemon(object):
+    def __init__(self, basedir, verbose=False):
+        self.basedir=os.path.abspath(basedir)
+        self.verbose=verbose
+        self.catalog=None
+        self.signature=None
+        # Commands are run with sys.stdout sending their output to the client, so the daemon's own is kept:
+        self.log=sys.stdout
+
+    def load(self):
+        """Opens the database and loads everything commands need, building any missing indexes."""
+        startTime=time.time()
+        self.catalog=GeoCatalog(self.basedir)
+        store=self.catalog.store
+        for p in self.catalog.getProtocols():
+            self.catalog.getIdSet(p)
+
+        index=store.getIndex()
+        index.ensureTaxa(store)
+        index.ensureAccessions(store)
+        index.ensureFullText(store)
+        getDisplayTable(store)
+
+        # Taken last, since loading may itself have built indexes or the display table:
+        self.signature=getSignature(self.basedir)
+        self.log.write("Loaded %d protocol(s) from %s in %.2fs\n" % (len(self.catalog.getProtocols()), self.basedir,
+                                                                      time.time()-startTime))
+        self.log.flush()
+
+    def unload(self):
+        closeDisplayTable(self.basedir)
+        self.catalog.close()
+        self.catalog=None
+
+    def refresh(self):
+        """Loads everything again if the database has changed since it was loaded."""
+        if getSignature(self.basedir)!=self.signature:
+            self.log.write("%s has changed, reloading\n" % self.basedir)
+            self.unload()
+            self.load()
+
+    def serves(self, cwd, args):
+        """Checks whether a command line is one the daemon can answer."""
+        command=splitCommand(args)
+        if command is None or command[1] not in DAEMON_COMMANDS:
+            return False
+        return os.path.realpath(os.path.join(cwd, command[0]))==os.path.realpath(self.basedir)
+
+    def answer(self, sock, request):
+        """Runs one command line for a client, sending its output and exit status back over sock."""
+        args=[a.encode("utf-8") for a in request["args"]]
+        cwd=request["cwd"].encode("utf-8")
+        if not self.serves(cwd, args):
+            sendFrame(sock, "R", "")
+            return
+
+        startTime=time.time()
+        self.refresh()
+        out=FrameWriter(sock, "O")
+        err=FrameWriter(sock, "E")
+        saved=(sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+        status=0
+        try:
+            os.chdir(cwd)
+            sys.stdin=StringIO((request["stdin"] or u"").encode("utf-8"))
+            sys.stdout=out
+            sys.stderr=err
+            instrument.run(lambda a: query_groseq_database.main(a, self.catalog), args)
+        except SystemExit as e:
+            status=e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            status=1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr=saved[:3]
+            os.chdir(saved[3])
+
+        out.flush()
+        err.flush()
+        sendFrame(sock, "X", str(status))
+
+        # Commands may fill in caches of their own, such as shorthand names, which needn't be reloaded:
+        self.signature=getSignature(self.basedir)
+        if self.verbose:
+            self.log.write("%s: %.1fms\n" % (" ".join(args[1:]), (time.time()-startTime)*1000))
+            self.log.flush()
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.server.queryDaemon.answer(self.connection, json.loads(self.rfile.readline()))
+        except socket.error as e:
+            # The client went away before the answer was sent, ie. its output was piped into head.
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+
+
+class QueryServer(SocketServer.UnixStreamServer):
+    def __init__(self, socketPath, queryDaemon, pollInterval):
+        self.queryDaemon=queryDaemon
+        self.timeout=pollInterval
+        SocketServer.UnixStreamServer.__init__(self, socketPath, QueryHandler)
+        # The daemon writes files on behalf of its clients, so only its own user may use it:
+        os.chmod(socketPath, 0o600)
+
+    def handle_timeout(self):
+        self.queryDaemon.refresh()
+
+    def handle_error(self, request, clientAddress):
+        # Errors in a command are sent to its client, so this is only reached by ^C or a broken daemon:
+        if sys.exc_info()[0] is KeyboardInterrupt:
+            raise
+        SocketServer.UnixStreamServer.handle_error(self, request, clientAddress)
+
+
+def isListening(socketPath):
+    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+# Set once the daemon has been asked to stop:
+stopRequested=False
+
+
+def stopServer(signum, frame):
+    global stopRequested
+    stopRequested=True
+    # Handled like ^C. Some commands catch everything, in which case the daemon stops once they're done.
+    raise KeyboardInterrupt()
+
+
+def main(args):
+    socketPath=None
+    pollInterval=POLL_INTERVAL
+    verbose=False
+
+    newArgs=[]
+    for a in args:
+        aToks=a.split('=', 1)
+        if aToks[0]=="-socket":
+            socketPath=aToks[1]
+        elif aToks[0]=="-poll":
+            pollInterval=float(aToks[1])
+        elif a=="-v":
+            verbose=True
+        else:
+            newArgs.append(a)
+    args=newArgs
+
+    if len(args)!=2:
+        print("Usage: %s [-socket=<path>] [-poll=<seconds>] [-v] dbdir" % args[0])
+        print("Keeps a metadata database loaded and answers the query commands query_client.py sends it.")
+        print("query_client.py takes the same arguments as query_groseq_database.py, and runs commands")
+        print("     itself whenever no daemon is serving the database or they fetch or change data.")
+        print("-socket=<path>\tListens on path instead of dbdir/.querydaemon.sock. Clients find it through")
+        print("     the GEO_QUERY_SOCKET environment variable.")
+        print("-poll=<seconds>\tHow often to check the database for changes while idle (default %.0f)." % POLL_INTERVAL)
+        print("-v\tLogs every command and how long it took.")
+        print("Stop the daemon with ^C or SIGTERM.")
+        return
+
+    basedir=args[1]
+    if socketPath is None:
+        socketPath=getSocketPath(basedir)
+    socketPath=os.path.abspath(socketPath)
+    if os.path.exists(socketPath):
+        if isListening(socketPath):
+            print("Error: a daemon is already listening on %s." % socketPath)
+            return
+        os.remove(socketPath)
+
+    queryDaemon=QueryDaemon(basedir, verbose)
+    queryDaemon.load()
+
+    server=QueryServer(socketPath, queryDaemon, pollInterval)
+    signal.signal(signal.SIGTERM, stopServer)
+    print("Listening on %s" % socketPath)
+    sys.stdout.flush()
+    try:
+        while not stopRequested:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketPath)
+        queryDaemon.unload()
+
+
+if __name__=="__main__":
+    main(sys.argv)
@@ -8,16 +8,13 @@
 
 import os
 import sys
-import urllib
-import xml.etree.ElementTree as ETree
-
-
-# Define the esearch URL here in case it is changed in the future:
-esearch="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+from eutils import getClient, iterSearchPages
+from geo_transfer import WorkerPool
+import instrument
 
 
 def printHelp(progName):
-    print("Usage: %s <args> query" % progName)
+    print("Usage: %s <args> query [query...]" % progName)
     print("Query the GEO database for numbers usable by fetch_groseq.py")
     print("If the -o switch is not specified, it is recommended that this program's output")
     print("be piped into either another command or a file.")
@@ -26,15 +23,73 @@ def printHelp(progName):
     print("-h, --help\tPrints this message.")
     print("-o=<filename>\tWrites to an output file instead of stdout.")
     print("-v\tVerbose output. All logging messages are written to stderr.")
+    print("-f=<filename>\tReads additional queries from a file, one per line.")
+    print("-d=<dir>\tWrites one ID file per query into dir. This is the default when more than one query is given.")
+    print("--profile[=<file>]\tPrints where the time went to stderr, and writes a cProfile dump to file if given.")
+    print("--trace=<file>\tWrites the time spent in each phase to file as a Chrome trace.")
+    print("")
+    print("Requests go to the server in the EUTILS_BASE environment variable if it is set.")
+    print("Set NCBI_API_KEY to an NCBI API key to raise the request rate limit.")
     print("")
     print("Examples:")
     print("%s gro-seq >out.txt" % progName)
     print("%s -o=out.txt pro-seq" % progName)
+    print("%s -d=idfiles gro-seq pro-seq gro-cap" % progName)
+
+
+def getQueryFileName(query):
+    """Returns the name of the ID file written for a query in batch mode, ie. 5'gro -> 5_gro.txt"""
+    return "".join([c if c.isalnum() or c in "-_." else "_" for c in query])+".txt"
+
+
+def writeQuery(query, out):
+    """Writes the QUERY header followed by every ID matching query. Returns the number of IDs written."""
+    out.write("QUERY %s\n" % query)
+    count=0
+    # Results are paged, so there's no limit on how many IDs a query can return. Every page is
+    # flushed right away so that another program can read the IDs while the search is running.
+    for page in iterSearchPages(getClient(), {"db": "gds", "term": query}):
+        out.write("".join(["%s\n" % i for i in page]))
+        out.flush()
+        count+=len(page)
+    return count
+
+
+def writeQueryFile(job):
+    query, path=job
+    # Only put the file in place once it's complete:
+    out=open(path+".part", "w")
+    try:
+        count=writeQuery(query, out)
+    finally:
+        out.close()
+    os.rename(path+".part", path)
+    return count
+
+
+def runBatch(queries, outDir, log, verbose):
+    """Runs every query at once, writing each one's IDs to its own file in outDir."""
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    
+    jobs=[(q, os.path.join(outDir, getQueryFileName(q))) for q in queries]
+    pool=WorkerPool(len(jobs))
+    numFailed=0
+    
+    for job, count, error in pool.run(jobs, writeQueryFile):
+        if error is not None:
+            log("[Error] Query %s failed: %s\n" % (job[0], error))
+            numFailed+=1
+        elif verbose:
+            log("[Message] Wrote %d IDs for %s to %s\n" % (count, job[0], job[1]))
+    
+    return numFailed
 
 
 def main(args):
-    query="gro-seq"
+    queries=[]
     out=sys.stdout
+    outDir=None
     verbose=False
     log=sys.stderr.write
     
@@ -44,7 +99,7 @@ def main(args):
     
     else:
         for a in args[1:]:
-            atoks=a.split('=')
+            atoks=a.split('=', 1)
             if a=="-h" or a=="--help":
                 printHelp(args[0])
                 # Ensure that nothing interesting happens after printing the help message:
@@ -55,35 +110,51 @@ def main(args):
                 except:
                     log("Unable to open %s for writing. Exiting...\n")
                     return
+            elif atoks[0]=="-f":
+                try:
+                    with open(atoks[1], "r") as f:
+                        queries.extend([l.strip() for l in f.read().splitlines() if len(l.strip())>0])
+                except IOError:
+                    log("Unable to read queries from %s. Exiting...\n" % atoks[1])
+                    return
+            elif atoks[0]=="-d":
+                outDir=atoks[1]
             elif a=="-v":
                 verbose=True
             else:
-                query=a
+                queries.append(a)
+    
+    if len(queries)==0:
+        queries=["gro-seq"]
+    
+    if len(queries)>1 or outDir is not None:
+        if out is not sys.stdout:
+            log("The -o switch can't be used with more than one query. Use -d instead.\n")
+            return
     
-    # Generate a query string:
-    argSet={"db": "gds", "term": query, "retmax": 100000}
-    params=urllib.urlencode(argSet)
+        if(verbose):
+            log("[Message] Running %d queries...\n" % len(queries))
+    
+        numFailed=runBatch(queries, outDir if outDir is not None else ".", log, verbose)
+        if numFailed>0:
+            sys.exit(1)
+    
+        if(verbose):
+            log("[Message] %s\n" % getClient().metrics.summary())
+            log("[Message] Done.\n")
+        return
+    
+    query=queries[0]
     
     if(verbose):
         log("[Message] About to make query...\n")
     
-    urlFile=urllib.urlopen(esearch, params)
-    searchTree=ETree.parse(urlFile)
-    urlFile.close()
+    count=writeQuery(query, out)
     
     if(verbose):
         log("[Message] Query successful!\n")
-    
-    # Our first order of business after parsing the response should be writing a header to the output file:
-    out.write("QUERY %s\n" % query)
-    root=searchTree.getroot()
-    
-    for child in root:
-        if child.tag=="Count" and verbose:
-            log("[Message] Found %s elements.\n" % child.text)
-        elif child.tag=="IdList":
-            for idEntry in child:
-                out.write("%s\n" % idEntry.text)
+        log("[Message] %s\n" % getClient().metrics.summary())
+        log("[Message] Found %d elements.\n" % count)
     
     out.close()
     
@@ -93,4 +164,4 @@ def main(args):
 
 
 if __name__=="__main__":
-    main(sys.argv)
\ No newline at end of file
+    instrument.run(main, sys.argv)
\ No newline at end of file
@@ -4,49 +4,37 @@
 
 import os
 import sys
-import urllib
-from ftplib import FTP
-import xml.etree.ElementTree as ETree
-from multiprocessing import Pool
-
-
-def isPresent(reflist, item):
-    for i in range(len(reflist)):
-        r=reflist[i]
-        if r==item:
-            return (True, i)
-    return (False, 0)
-
-
-def isSeries(pathToElem):
-    typefile=open(os.path.join(pathToElem, "type.txt"))
-    contents=typefile.read()
-    typefile.close()
-    
-    return contents=="GSE"
-
-
-def genSpeciesList(pathlist, seriesOnly):
-    # This should be O(n^2). Ewwww...
-    curSpeciesList=[]
-    curSpeciesCount=[]
-    for p in pathlist:
-        if isSeries(p) or not seriesOnly:
-            taxon=open(os.path.join(p, "taxon.txt"), "r")
-            contents=taxon.read().split(';')
-            
-            for c in contents:
-                c=c.strip()
-                (truth, idx)=isPresent(curSpeciesList, c)
-                if not truth:
-                    curSpeciesList.append(c)
-                    curSpeciesCount.append(1)
-                else:
-                    curSpeciesCount[idx]+=1
-            taxon.close()
+import shutil
+import tempfile
+from geo_catalog import GeoCatalog
+from geo_store import encodeText
+from id_sets import intersectSets, unionSets, diffSets, writeIdFile, readIdFile, isIdFile
+from geo_transfer import WorkerPool, JobState, Progress, BandwidthLimit, fetchRemoteDir, downloadFile, interleaveByHost, getFreeSpace
+from miniml import getSeriesInfo, getSeriesContribName
+from display_table import getDisplayTable, removeDisplayTable
+from eutils import getClient, findSrx, getRunUrl, resolveSraRuns
+from geo_results import readSraList
+from geo_snapshot import writeSnapshot, writeParquet
+from query_client import DAEMON_COMMANDS
+from instrument import phase
+import instrument
+
+
+# Journal of matrix fetches, kept in the database directory:
+MATRIX_STATE_NAME=".matrixfetch.state"
+# Journal of downloaded files, kept in the download command's output directory:
+DOWNLOAD_STATE_NAME=".download.state"
+
+# The process' umask, which can only be read by setting it. This is done once, before any threads start:
+UMASK=os.umask(0)
+os.umask(UMASK)
+
+def genSpeciesList(catalog):
+    # Species counts come straight out of the taxon index:
+    speciesCounts=catalog.countSpecies()
     
     # Generate and sort a list of species:
-    newSpeciesList=[(curSpeciesCount[i], val) for i, val in enumerate(curSpeciesList)]
+    newSpeciesList=[(count, name) for name, count in speciesCounts.items()]
     newSpeciesList.sort()
     newSpeciesList.reverse()
     
@@ -54,100 +42,20 @@ def genSpeciesList(pathlist, seriesOnly):
     for elem in newSpeciesList:
         print("%d %s" % (elem[0], elem[1]))
     
-    print("\nTotal number of elements: %d" % sum(curSpeciesCount))
-
-
-def findContribNameDate(matFile):
-    firstContrib=None
-    pubYear=None
-    
-    f=open(matFile, "r")
-    eTree=curTree=ETree.parse(f)
-    f.close()
-    
-    root=eTree.getroot()
-    
-    for elem in root:
-        # Tag, text, attrib.
-        if elem.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Contributor" and firstContrib is None:
-            if elem.attrib['iid']=="contrib1":
-                # This is exactly as painful as it looks:
-                for child in elem:
-                    if child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Person":
-                        for nameChunk in child:
-                            if nameChunk.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Last":
-                                firstContrib=nameChunk.text
-        elif elem.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Series": # and pubYear is None:
-            for child in elem:
-                if child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Status":
-                    for date in child:
-                        if date.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Release-Date":
-                            # Dates are formatted as yyyy-mm-dd
-                            newPubYear=date.text.split('-')[0]
-                            
-                            if pubYear is None:
-                                pubYear=newPubYear
-                            elif int(pubYear)<int(newPubYear):
-                                pubYear=newPubYear
-        
-        # Terminate the loop early if we've found both elements:
-        if firstContrib is not None and pubYear is not None:
-            break
-    
-    if firstContrib is None or pubYear is None:
-        return None
-    
-    else:
-        return firstContrib+pubYear
-
-
-def findContribByPaper(pathList, paperName):
-    adjustedPaperName=paperName.strip().upper()
-    for p in pathList:
-        matDir=os.path.join(p, "matrices")
-        ncName=os.path.join(p, "namecache.txt")
-        if os.path.exists(ncName):
-            with open(ncName, "r") as ncFile:
-                # Be as forgiving as possible:
-                if ncFile.read().strip().upper()==adjustedPaperName:
-                    return p.split('/')[-1]
-        elif os.path.exists(matDir):
-            for matFile in os.path.listdir(matDir):
-                computedName=findContribNameDate(os.path.join(matDir, matFile))
-                if computedName is not None:
-                    if computedName.strip().upper()==adjustedPaperName:
-                        return p.split('/')[-1]
-    return None
-    
-
-def printTitle(path):
-    pathToks=path.split('/')
-    idnum=pathToks[-1]
-    protocol=pathToks[-2]
-    #idnum=path.split('/')[-1]
-    
-    matDir=os.path.join(path, "matrices")
-    contribName=""
-    if os.path.exists(matDir):
-        if os.path.exists(os.path.join(path, "namecache.txt")):
-            with open(os.path.join(path, "namecache.txt"), "r") as nameFile:
-                contribName='"%s" ' % nameFile.read()
-        else:
-            for mat in os.listdir(matDir):
-                pName=findContribNameDate(os.path.join(matDir, mat))
-                if pName is not None:
-                    pName=pName.strip()
-                    with open(os.path.join(path, "namecache.txt"), "w") as nameFile:
-                        nameFile.write(pName)
-                    
-                    contribName='"%s" ' % pName
-                    break
-                
-    f=open(os.path.join(path, "summary.txt"), "r")
-    title=f.readline()
-    title=title[(len(title.split()[0])+1):]
-    f.close()
-    print("[%s] %s%s: %s\n" % (protocol, contribName, idnum, title.strip()))
+    print("\nTotal number of elements: %d" % sum(speciesCounts.values()))
+
+
+def printTitle(element):
+    with phase("rendering"):
+        contribName, title=element.getDisplay()
+        if len(contribName)>0:
+            contribName='"%s" ' % contribName
+        print("[%s] %s%s: %s\n" % (element.protocol, contribName, element.idNum, title))
+
+
+def printResults(found):
+    for element in found:
+        printTitle(element)
 
 
 def genProtoSetStr(protocolSet):
@@ -157,429 +65,355 @@ def genProtoSetStr(protocolSet):
     return retStr
 
 
-def dumpLQF(foundList, lqf, paths=True):
-    for f in foundList:
-        # Give an ID instead of a full path:
-        if paths:
-            lqf.write("%s\n" % f.split('/')[-1])
-        else:
-            lqf.write("%s\n" % f)
+def dumpLQF(foundList, lqf):
+    # Results are kept as a binary ID set so that they can be combined later without another scan:
+    with phase("writing results"):
+        writeIdFile(lqf, foundList)
 
 
-def findSpecies(pathlist, speciesName, seriesOnly, protocolSet, lqf):
-    curFoundList=[]
-    # Making this case-sensitive would just be cruel.
-    upperName=speciesName.upper()
+def findSpecies(catalog, speciesName, lqf):
+    # Making this case-sensitive would just be cruel, so the index lookup ignores case.
+    curFoundList=catalog.findSpecies(speciesName)
     
-    for p in pathlist:
-        if isSeries(p) or not seriesOnly:
-            taxon=open(os.path.join(p, "taxon.txt"), "r")
-            contents=taxon.read().split(';')
-            
-            for c in contents:
-                c=c.strip()
-                if c.upper()==upperName:
-                    #curFoundList.append(p.split('/')[-1])
-                    curFoundList.append(p)
-            taxon.close()
-    
-    print("Found %d elements that match \"%s\" given protocol(s) %s" % (len(curFoundList), speciesName, genProtoSetStr(protocolSet)))
+    print("Found %d elements that match \"%s\" given protocol(s) %s" % (len(curFoundList), speciesName, genProtoSetStr(catalog.getProtocols())))
     print("List of paths:\n")
     
-    for c in curFoundList:
-        printTitle(c)
+    printResults(curFoundList)
     
     # Now dump the set to the last query file:
-    dumpLQF(curFoundList, lqf)
+    curFoundList.save(lqf)
 
 
-def findProto(basedir, idNum, protocolSet):
-    for p in protocolSet:
-        if os.path.exists(os.path.join(basedir, p, idNum)):
-            return p
-    return None
+def printSRAList(element):
+    # Let's attempt to find all SRAs defined for this matrix:
+    for sample in element.getSamples():
+        print("%s %s %s" % (sample["iid"], sample["strategy"], sample["relation"]))
 
 
-def printSRAList(matrixdir):
-    # Let's attempt to find all SRAs defined for this matrix:
-    for filename in os.listdir(matrixdir):
-        f=open(os.path.join(matrixdir, filename), "r")
-        eTree=ETree.parse(f)
-        f.close()
-        
-        # Attempt to find series IDs:
-        root=eTree.getroot()
-        
-        elemCount=0
-        for elem in root:
-            if elem.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Sample":
-                elemCount+=1
-                # Let's get some additional metadata for the sample:
-                sampleGeo=elem.attrib['iid']
-                sampleStrategy=""
-                sampleRelation=""
-                for child in elem:
-                    if child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Library-Strategy":
-                        sampleStrategy=child.text
-                    elif child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Relation":
-                        if child.attrib['type']=="SRA":
-                            sampleRelation=child.attrib['target']
-                print("%s %s %s" % (sampleGeo, sampleStrategy, sampleRelation))
-
-def getSummary(basedir, idlist, pathList, protocolSet):
+def getSummary(catalog, idlist):
     for i in idlist:
         try:
-            # Fortunately, while this is linear, it's linear relative to the (very small) set of protocols.
-            p=findProto(basedir, i, protocolSet)
-            
             # Ie. if the value given is a paper name:
             if not (i[0]>='0' and i[0]<='9'):
                 paperName=i
-                i=findContribByPaper(pathList, paperName)
-                if i is None:
+                element=catalog.findByShorthand(paperName)
+                if element is None:
                     print("ERROR: couldn't find element matching title: %s" % paperName)
                     continue
+                i=element.idNum
             
-            curdir=os.path.join(basedir, p, i)
-            f=open(os.path.join(curdir, "summary.txt"), "r")
-            contents=f.read()
-            f.close()
+            # Fortunately, while this is linear, it's linear relative to the (very small) set of protocols.
+            element=catalog.getElement(i)
+            contents=element.getSummaryText()
             
             print("----Summary for %s----" % i)
-            if os.path.exists(os.path.join(curdir, "namecache.txt")):
-                with open(os.path.join(curdir, "namecache.txt")) as nc:
-                    ncc=nc.read()
-                    print("Shorthand Title: %s" % ncc.strip())
+            contribName=element.getShorthand()
+            if contribName is not None:
+                print("Shorthand Title: %s" % contribName)
             print(contents)
             
             print("")
             
-            if os.path.exists(os.path.join(curdir, "matrixpath.txt")):
+            if element.getMatrixUrl() is not None:
                 print("Data matrix URL defined? YES")
             else:
                 print("Data matrix URL defined? NO. This software cannot fetch data for this element.")
             
-            if os.path.exists(os.path.join(curdir, "matrices")):
+            if element.has("matrices"):
                 print("Ready to fetch data? YES")
                 # TODO: Add additional information as appropriate based on the matrix files.
                 
                 print("The following data elements were found in series matrices:")
-                printSRAList(os.path.join(curdir, "matrices"))
+                printSRAList(element)
             else:
                 print("Ready to fetch data? NO (run fetchmatrices %s)" % i)
             
-            datapath=os.path.join(curdir, "data")
-            if os.path.exists(datapath):
+            datapath=os.path.join(element.path, "data")
+            if element.has("data"):
                 print("Data fetched? YES in %s" % datapath)
             else:
                 print("Data fetched? NO")
-                
-            print("Protocol: %s" % p)
+            
+            print("Protocol: %s" % element.protocol)
             print("")
         except:
             print("ERROR: Could not look up %s\n" % i)
 
 
-def fetchMatrices(basedir, idlist, protocolSet):
-    for i in idlist:
-        try:
-            p=findProto(basedir, i, protocolSet)
-            matUrlFile=open(os.path.join(basedir, p, i, "matrixpath.txt"), "r")
-            matUrl=matUrlFile.read()
-            matUrlFile.close()
-            matDir=os.path.join(basedir, p, i, "matrices")
-            
-            if not os.path.exists(matDir):
-                try:
-                    os.makedirs(matDir)
-                except:
-                    print("ERROR: Could not create matrix storage directory for %s! This is very bad." % i)
-                    return
-            
-            print("Fetching matrix file(s)...")
-            os.system("wget -r -nH -nd -np -R .listing -P %s %sminiml/" % (matDir, matUrl.strip()))
-            
-            print("Unpacking matrix file(s)...")
-            for f in os.listdir(matDir):
-                baseName=f[:-4]
-                # For some reason, all of the files have a tgz extension when they're really just gzip'd archives.
-                #realName=baseName+".gz"
-                #os.system("mv %s %s" % (os.path.join(matDir, f), os.path.join(matDir, realName)))
-                os.system("tar -xzf %s -C %s" % (os.path.join(matDir, f), matDir))
-            os.system("rm %s" % os.path.join(matDir, "*.tgz"))
-                
-            print("Done with %s." % i)
-            
-            # Cache the paper's "name":
-            f=open(os.path.join(basedir, p, i, "namecache.txt"), "w")
-            f.write(findContribNameDate(os.path.join(matDir, os.listdir(matDir)[0])).strip())
-            f.close()
-            
-        except:
-            print("ERROR: Could not fetch data matrices for %s\n" % i)
-            print("It may be possible that the requested data element doesn't have a matrix link.")
-
-
-def sraHelper(url):
-    print(url.strip())
-    f=urllib.urlopen(url.strip())
-    content=f.read()
-    f.close()
-    return content
-
-
-def getSRALinkFromSRX(srxId):
-    #https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=sra&id=420969
-    #ftp://ftp-trace.ncbi.nlm.nih.gov/sra/sra-instant/reads/
-    #https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=sra&term=SRX298678
-    # Start by using the eutils to find out what the SRX's id is:
-    eSearch="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    eSummary="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
-    
-    argSet={"db": "sra", "term": srxId}
-    urlFile=urllib.urlopen(eSearch, urllib.urlencode(argSet))
-    
-    elemTree=ETree.parse(urlFile)
-    urlFile.close()
-    sraId=None
-    
-    root=elemTree.getroot()
-    for child in root:
-        if child.tag=="IdList":
-            for i in child:
-                if i.tag=="Id":
-                    sraId=i.text
-                    break
-    
-    if sraId is None:
-        print("Can't find SRA id.")
-        return None
-    
-    # Now get more information about the SRX:
-    argSet={"db": "sra", "id": sraId}
-    urlFile=urllib.urlopen(eSummary, urllib.urlencode(argSet))
-    
-    elemTree=ETree.parse(urlFile)
-    urlFile.close()
-    srr=None
-    
-    print(sraId)
-    
-    root=elemTree.getroot()
-    docSum=root[0]
-    for child in docSum:
-        if child.tag=="Item":
-            print("Found item tag. Attrib table:")
-            print(child.attrib)
-            if child.attrib["Name"]=="Runs":
-                print(child.text)
-                # The child's contents will have to be manually picked apart, since 
-                # they're marked as a string.
-                toks=child.text.split('"')
-                # This is horribly hackish:
-                srr=toks[1]
-                break
-    
-    if srr is None:
-        print("Can't find srr.")
-        return None
-    
-    print(srr)
-    
-    # Now that we have an SRR string, we can generate an appropriate URL (is this feeling convoluted yet?)
-    url="ftp://ftp-trace.ncbi.nlm.nih.gov/sra/sra-instant/reads/ByRun/sra/SRR/%s/%s/%s.sra" % (srr[:6], srr, srr)
-    return (srr, url)
-
-
-def sraURLHelper(inurl):
-    srx=inurl.split("/")[-1]
-    srr, url=getSRALinkFromSRX(srx)
-    return url
-
-
-def getSraList(basedir, idlist, pathList, protocolSet):
+def fetchMatrixJob(job, pool, progress):
+    idNum, path, matUrl=job
+    # Start from an empty directory so that a previously interrupted attempt can't leave junk behind:
+    matDir=os.path.join(path, "matrices")
+    if os.path.exists(matDir):
+        shutil.rmtree(matDir)
+    
+    try:
+        fetchRemoteDir("%sminiml/" % matUrl, matDir, pool, progress)
+    except:
+        # Other commands take the existence of the directory to mean that matrices are available:
+        shutil.rmtree(matDir, True)
+        raise
+    return matDir
+
+
+def fetchMatrices(store, basedir, idlist, protocolSet, numWorkers=4, perHost=2, quiet=False):
+    # Finished IDs are recorded here so that an interrupted run doesn't fetch them again:
+    state=JobState(os.path.join(basedir, MATRIX_STATE_NAME))
+    jobs=[]
+    queued=set()
+    
     for i in idlist:
-        p=findProto(basedir, i, protocolSet)
+        if i in queued:
+            continue
+        queued.add(i)
+        
+        p=store.findProto(i, protocolSet)
+        if p is None:
+            print("ERROR: Could not find %s in protocol(s) %s" % (i, genProtoSetStr(protocolSet)))
+            continue
+        
+        path=os.path.join(basedir, p, i)
+        matUrl=store.getMatrixUrl(path)
+        if matUrl is None:
+            if not quiet:
+                print("ERROR: Could not fetch data matrices for %s\n" % i)
+                print("It may be possible that the requested data element doesn't have a matrix link.")
+            continue
+        
+        if state.isDone(i) and os.path.exists(os.path.join(path, "matrices")):
+            if not quiet:
+                print("Matrices for %s were already fetched." % i)
+            continue
+        
+        jobs.append((i, path, matUrl))
+    
+    print("Fetching matrix file(s) for %d element(s)..." % len(jobs))
+    pool=WorkerPool(numWorkers, perHost)
+    progress=Progress(len(jobs))
+    
+    for job, matDir, error in pool.run(jobs, lambda job: fetchMatrixJob(job, pool, progress)):
+        i, path=job[0], job[1]
+        if error is not None:
+            state.mark(i, "failed")
+            progress.finish(i, "FAILED (%s)" % error)
+            continue
+        
+        # Read everything needed from the new matrices in one pass, and cache the paper's "name":
+        contribName=getSeriesContribName(getSeriesInfo(path))
+        if contribName is not None:
+            store.setContribName(path, encodeText(contribName.strip()))
         
+        state.mark(i, "done")
+        progress.finish(i, "done")
+    
+    # Names shown for the elements may have changed:
+    if len(jobs)>0:
+        removeDisplayTable(basedir)
+    progress.summary()
+
+
+def getSraList(catalog, idlist):
+    for i in idlist:
         # Ie. if the value given is a paper name:
         if not (i[0]>='0' and i[0]<='9'):
             paperName=i
-            i=findContribByPaper(pathList, paperName)
-            if i is None:
+            element=catalog.findByShorthand(paperName)
+            if element is None:
                 print("ERROR: couldn't find element matching title: %s" % paperName)
                 continue
+            i=element.idNum
+        
+        element=catalog.getElement(i)
+        if element is None:
+            print("ERROR: Could not find %s in protocol(s) %s" % (i, genProtoSetStr(catalog.getProtocols())))
+            continue
         
         print("Finding SRAs for %s..." % i)
-        matDir=os.path.join(basedir, p, i, "matrices")
         # if the matrix directory exists, then this element probably has the right data:
         # TODO: Consider running all of this in parallel
-        if os.path.exists(matDir):
-            sralist=[]
+        if element.has("matrices"):
             sraURLlist=[]
-            # Read all files in the directory:
-            dircontents=os.listdir(matDir)
-            # filter out all non-xml files:
-            flist=[]
-            for d in dircontents:
-                if d.split(".")[-1]=="xml":
-                    flist.append(d)
             
-            for fname in flist:
-                treeFile=open(os.path.join(matDir, fname), "r")
-                curTree=ETree.parse(treeFile)
-                treeFile.close()
-                
-                # This should be the <MiniML> tag. 
-                root=curTree.getroot()
+            for sample in element.getSamples():
+                if sample["type"] is not None and sample["type"]!="SRA":
+                    print("Found non-SRA sample.")
+                    continue
                 
-                for tag in root:
-                    if tag.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Sample":
-                        for child in tag:
-                            if child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Type":
-                                if child.text!="SRA":
-                                    print("Found non-SRA sample.")
-                                    break;
-                            # We want relation URLs:
-                            elif child.tag=="{http://www.ncbi.nlm.nih.gov/geo/info/MINiML}Supplementary-Data":
-                                if child.attrib["type"]=="SRA Experiment":
-                                    text=child.text.strip()
-                                    #print("Found SRA URL: %s" % text)
-                                    # But wait, there's more! Since the SRA FTP database got unexpectedly changed,
-                                    # we have to go through a lot of extra work to get a simple SRR:
-                                    
-                                    #srx=text.split("/")[-1]
-                                    #srr, srrurl=getSRALinkFromSRX(srx)
-                                    #print("SRA URL has the following SRR: %s" % srr)
-                                    #print("Adding link to set: %s" % srrurl)
-                                    #sraURLlist.append(srrurl)
-                                    sraURLlist.append(text)
+                # We want relation URLs. But wait, there's more! Since the SRA FTP database got 
+                # unexpectedly changed, we have to go through a lot of extra work to get a simple SRR
+                # (see resolveSraRuns in eutils.py).
+                sraURLlist.extend(sample["sraUrls"])
             # Now that we (hopefully) have a list of urls:
             if len(sraURLlist)==0:
                 print("No SRA links found in matrix file. Please check for data manually.")
                 return
             
-            # We now need to enumerate all SRAs defined in the FTP links:
-            """
-            print("Fetching data from specified SRA index URLs (this may take a while)...")
-            pl=Pool(500)
-            contentSet=pl.map(sraHelper, sraURLlist)
-            for c in contentSet:
-                lines=c.splitlines()
-                
-                for l in lines:
-                    sralist.append(l.split()[-1].strip())
-            
-            print("\nFound the following SRA elements for download:")
-            for s in sralist:
-                print(s)
-            """
-            
-            pl=Pool(500)
-            contentSet=pl.map(sraURLHelper, sraURLlist)
+            # Every experiment is resolved to all of its runs in a handful of batched requests:
+            print("Resolving %d SRA experiment(s)..." % len(sraURLlist))
+            srxList=[s for s in [findSrx(u) for u in sraURLlist] if s is not None]
+            runs=resolveSraRuns(getClient(), catalog.store.getIndex(), srxList)
             
-            outPath=os.path.join(basedir, p, i, "%s.sralist" % i)
+            outPath=element.getSraListPath()
             print("\nWriting list of links to %s" % outPath)
             f=open(outPath, "w")
             
-            for u in contentSet:
-                # Each URL already has a newline character in it, for better or for worse.
-                f.write("%s\n" % u.strip())
+            for srx in srxList:
+                if srx not in runs:
+                    print("Can't find runs for %s." % srx)
+                    continue
+                for srr in runs[srx]:
+                    f.write("%s\n" % getRunUrl(srr))
             
             f.close()
-            
-                
         else:
-            print("ERROR: No matrices defined in %s" % matDir)
+            print("ERROR: No matrices defined in %s" % os.path.join(element.path, "matrices"))
 
 
-def getReadyToSra(pathlist, lqf):
-    readylist=[]
-    for p in pathlist:
-        if os.path.exists(os.path.join(p, "matrices")):
-            readylist.append(p)
+def getReadyToSra(catalog, lqf):
+    readylist=catalog.getWithMatrices()
     
-    print("%d of %d elements are ready to be fetched. They are:" % (len(readylist), len(pathlist)))
+    print("%d of %d elements are ready to be fetched. They are:" % (len(readylist), len(catalog.getElements())))
     
-    for r in readylist:
-        printTitle(r)
+    printResults(readylist)
     
-    dumpLQF(readylist, lqf)
+    readylist.save(lqf)
 
 
-def listSRAs(pathlist):
-    for p in pathlist:
-        pid=p.split('/')[-1]
-        srafile=os.path.join(p, "%s.sralist" % pid)
-        if os.path.exists(srafile):
-            srafile=open(srafile, "r")
-            lines=srafile.read().splitlines()
-            srafile.close()
-            
-            printTitle(p)
-            for l in lines:
-                print("%s" % (l.split('/')[-1].split('.')[0]))
+def listSRAs(catalog):
+    for element in catalog.getWithSraLists():
+        printTitle(element)
+        for url, md5 in element.getSraList():
+            print("%s" % (url.split('/')[-1].split('.')[0]))
 
 
-def getReadyToDownload(pathlist, lqf):
+def getReadyToDownload(catalog, lqf):
     print("The following elements have SRA list files:")
-    numFound=0
-    outList=[]
-    for p in pathlist:
-        # Determine if there exists a .sralist file in this directory:
-        contents=os.listdir(p)
-        
-        for c in contents:
-            ctoks=c.split('.')
-            try:
-                if ctoks[1]=="sralist":
-                    numFound+=1
-                    printTitle(p)
-                    outList.append(p)
-            except:
-                # Do nothing
-                pass
-    
-    print("\n%d of %d elements have SRA lists and can be immediately downloaded." % (numFound, len(pathlist)))
+    # getsralist names the file after the ID:
+    outList=catalog.getWithSraLists()
+    printResults(outList)
+    
+    print("\n%d of %d elements have SRA lists and can be immediately downloaded." % (len(outList), len(catalog.getElements())))
+    
+    outList.save(lqf)
+
+
+def downloadJobs(jobs, outdir, numWorkers, perHost, maxRate=None, minFree=None, quiet=False):
+    """Downloads (url, destPath, md5) jobs in parallel, recording each file's outcome in outdir's journal.
+    maxRate caps the combined transfer rate in bytes per second. If minFree is given, a file is only
+    started while more than minFree bytes are free on its filesystem."""
+    state=JobState(os.path.join(outdir, DOWNLOAD_STATE_NAME))
+    pending=[]
+    for job in jobs:
+        name=os.path.relpath(job[1], outdir)
+        if state.isDone(name) and os.path.exists(job[1]):
+            if not quiet:
+                print("%s was already downloaded." % name)
+        else:
+            pending.append(job)
+    
+    print("Downloading %d file(s)..." % len(pending))
+    pool=WorkerPool(numWorkers, perHost)
+    progress=Progress(len(pending), limit=BandwidthLimit(maxRate) if maxRate else None)
+    
+    def runJob(job):
+        if minFree is not None and getFreeSpace(os.path.dirname(job[1]))<minFree:
+            raise IOError("not started, less than %.1f GB of disk space is free" % (minFree/1073741824.0))
+        return downloadFile(job, pool, progress)
+    
+    numFailed=0
+    # Spread the queue across servers so that per-server limits don't hold up the other workers:
+    for job, numBytes, error in pool.run(interleaveByHost(pending), runJob):
+        name=os.path.relpath(job[1], outdir)
+        if error is not None:
+            # The partial file is kept, so the next attempt resumes it:
+            state.mark(name, "failed")
+            progress.finish(name, "FAILED (%s)" % error)
+            numFailed+=1
+        else:
+            state.mark(name, "done")
+            progress.finish(name, "done")
     
-    dumpLQF(outList, lqf)
+    progress.summary()
+    return numFailed
 
 
-def download(basedir, elem, outdir, protocolSet):
+def download(store, basedir, elem, outdir, protocolSet, numWorkers=4, perHost=2, maxRate=None, minFree=None):
     # Attempt to open the file:
-    p=findProto(basedir, elem, protocolSet)
+    p=store.findProto(elem, protocolSet)
+    if p is None:
+        print("ERROR: Could not find %s in protocol(s) %s" % (elem, genProtoSetStr(protocolSet)))
+        return
     datafile=os.path.join(basedir, p, elem, "%s.sralist" % elem)
     
     try:
-        f=open(datafile, "r")
-        lines=f.read().splitlines()
-        f.close()
-        
-        # Each line should represent one URL.
-        for u in lines:
-            os.system("wget -r -nH -nd -np -R index.html* -P %s %s" % (outdir, u))
-    except:
+        entries=readSraList(datafile)
+    except IOError:
         print("Error: can't open %s" % datafile)
+        return
+    
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    
+    # Each line should represent one URL.
+    jobs=[(u, os.path.join(outdir, u.split('/')[-1]), md5) for u, md5 in entries]
+    downloadJobs(jobs, outdir, numWorkers, perHost, maxRate, minFree)
 
 
-def fetchspmats(basedir, pathlist, speciesname, seriesOnly):
+def downloadAll(store, basedir, idlist, outdir, protocolSet, numWorkers=4, perHost=2, maxRate=None, minFree=None):
+    """Downloads the SRA files of every element in idlist from one shared queue. Each element's
+    files go into a subdirectory of outdir named after its ID."""
+    jobs=[]
+    queued=set()
+    for i in idlist:
+        p=store.findProto(i, protocolSet)
+        if p is None:
+            print("ERROR: Could not find %s in protocol(s) %s" % (i, genProtoSetStr(protocolSet)))
+            continue
+        
+        datafile=os.path.join(basedir, p, i, "%s.sralist" % i)
+        if not os.path.exists(datafile):
+            print("No SRA list for %s (run getsralist %s first)" % (i, i))
+            continue
+        
+        elemDir=os.path.join(outdir, i)
+        if not os.path.exists(elemDir):
+            os.makedirs(elemDir)
+        
+        for u, md5 in readSraList(datafile):
+            destPath=os.path.join(elemDir, u.split('/')[-1])
+            if destPath not in queued:
+                queued.add(destPath)
+                jobs.append((u, destPath, md5))
+    
+    numFailed=downloadJobs(jobs, outdir, numWorkers, perHost, maxRate, minFree, True)
+    if numFailed>0:
+        print("%d file(s) could not be downloaded. Run downloadall again to retry them." % numFailed)
+
+
+def fetchspmats(catalog, speciesname, numWorkers, perHost):
     print("Attempting to fetch all matrices for '%s'..." % speciesname)
-    upperName=speciesname.upper()
-    
-    curFoundList=[]
-    # Todo: just write a function to do this lookup so we don't repeat code.
-    for p in pathlist:
-        if isSeries(p) or not seriesOnly:
-            taxon=open(os.path.join(p, "taxon.txt"), "r")
-            contents=taxon.read().split(';')
-            
-            for c in contents:
-                c=c.strip()
-                if c.upper()==upperName:
-                    curFoundList.append(p.split('/')[-1])
-                    #curFoundList.append(p)
-            taxon.close()
-            
-    fetchMatrices(basedir, curFoundList)
+    
+    curFoundList=[i for p, i in catalog.findSpecies(speciesname).getKeys()]
+    fetchMatrices(catalog.store, catalog.basedir, curFoundList, catalog.getProtocols(), numWorkers, perHost)
+
+
+def rebuildIndexes(store, protocolSet):
+    index=store.getIndex()
+    print("Rebuilding species index...")
+    index.buildTaxa(store)
+    print("Rebuilding accession index...")
+    index.buildAccessions(store)
+    print("Rebuilding display table...")
+    removeDisplayTable(store.basedir)
+    getDisplayTable(store)
+    if index.isBuilt("fulltext"):
+        print("Rebuilding full text index...")
+        index.buildFullText(store)
+    
+    for p in protocolSet:
+        print("Rebuilding ID set for %s..." % p)
+        index.buildIdSet(store, p)
+    print("Done.")
 
 
 def listProtocols(protoList):
@@ -590,211 +424,224 @@ def listProtocols(protoList):
     print("Example: -pt=gro-seq,pro-seq")
     
 
-def genIdSet(idSet, basedir, protoName, seriesOnly):
-    outSet=[]
-    
-    for i in idSet:
-        if isSeries(os.path.join(basedir, protoName, i)) or not seriesOnly:
-            outSet.append(i)
-    
-    return outSet
-
-
-def queryProtocol(basedir, protoName, idsByProto, seriesOnly, lqf):
+def queryProtocol(catalog, protoName, lqf):
     try:
-        idset=genIdSet(idsByProto[protoName], basedir, protoName, seriesOnly)
+        # The catalog has already filtered out non-series IDs if necessary:
+        found=catalog.getProtocol(protoName)
         
-        print("Found %d elements matching protocol %s.\n" % (len(idset), protoName))
+        print("Found %d elements matching protocol %s.\n" % (len(found), protoName))
         
-        for i in idset:
-            printTitle(os.path.join(basedir, protoName, i))
+        printResults(found)
         
-        dumpLQF(idset, lqf, False)
+        found.save(lqf)
     except:
         print("ERROR: Query failed for protocol %s. Is it shown by the listprotocols command?" % protoName)
 
 
-def genIntegerIdsByProto(protocolSet, idsByProto):
-    d={'%s' % p : [] for p in protocolSet}
+def protocolOverlap(catalog, args, lqf):
+    """With no arguments, prints the elements shared by every pair of protocols. Otherwise args is one of
+    matrix, or intersect, union or diff followed by the protocols to combine."""
+    protocolSet=catalog.getProtocols()
+    if len(args)==0:
+        # Pairs are listed in the same order as they always have been:
+        for j in range(len(protocolSet)):
+            for i in range(j):
+                for idNum in catalog.combineProtocols("intersect", [protocolSet[i], protocolSet[j]]).getIds():
+                    print("[%s] %d <---> [%s] %d" % (protocolSet[i], idNum, protocolSet[j], idNum))
+        return
     
-    for p in protocolSet:
-        d[p].extend([int(v) for v in idsByProto[p]])
-        d[p].sort()
+    if args[0]=="matrix":
+        matrix=catalog.getOverlapMatrix()
+        width=max([len(p) for p in protocolSet]+[8])
+        print(" "*width+"".join([" %*s" % (width, p) for p in protocolSet]))
+        for i in range(len(protocolSet)):
+            print("%*s" % (width, protocolSet[i])+"".join([" %*d" % (width, c) for c in matrix[i]]))
+        return
+    
+    protos=args[1:]
+    for p in protos:
+        if p not in protocolSet:
+            print("ERROR: %s is not one of the protocols %s" % (p, genProtoSetStr(protocolSet)))
+            return
     
-    return d
+    if args[0] not in ["intersect", "union", "diff"] or (args[0]=="diff" and len(protos)==0):
+        print("Usage: protocoloverlap [matrix | intersect <protocols> | union <protocols> | diff <protocol> <protocols to remove>]")
+        return
+    
+    found=catalog.combineProtocols(args[0], protos)
+    for idNum in found.getIds():
+        print(idNum)
+    print("%d element(s) found." % len(found))
+    found.save(lqf)
 
 
-def getCommonElements(A, B):
-    ctr1=0
-    ctr2=0
+def getByYear(catalog, yearName, lqf):
+    # Only elements for which there is a name cache are used.
+    # TODO: Add support for raw matrix reading.
+    outList=catalog.getByYear(yearName)
     
-    outList=[]
+    printResults(outList)
     
-    while ctr1<len(A) and ctr2<len(B):
-        if A[ctr1]>B[ctr2]:
-            ctr2+=1
-        elif A[ctr1]<B[ctr2]:
-            ctr1+=1
-        else:
-            outList.append(A[ctr1])
-            ctr1+=1
-            ctr2+=1
-    
-    return outList
+    outList.save(lqf)
 
 
-def genProtoTestingSet(numBits):
-    testSet=[]
+def getByContributor(catalog, contribName, lqf):
+    # Only elements for which there is a name cache are used.
+    # TODO: Add support for raw matrix reading.
+    outList=catalog.getByContributor(contribName)
+    
+    printResults(outList)
     
-    for i in range(pow(2, numBits)):
-        # Count the number of bits set in this value (IIRC, there's a clever bitwise way of doing this):
-        bitCount=0
-        bitsSet=[]
-        for j in range(numBits):
-            if (i&(1<<j))!=0:
-                bitCount+=1
-                bitsSet.append(j)
-        if bitCount==2:
-            testSet.append((bitsSet[0], bitsSet[1]))
-    return testSet
+    outList.save(lqf)
+
+
+def listYearContrib(counts, getName):
+    # Count all elements:
+    ycList=counts.items()
+    ycList=sorted(ycList, key=lambda k: k[1], reverse=True)
+    print("%s, frequency:" % getName)
+    for y in ycList:
+        if len(y[0])>1:
+            print("%s %d" % (y[0], y[1]))
+
+
+def readAccessions(args):
+    """Returns the accessions named in args. An argument of - reads accessions from stdin, and the
+    name of an existing file reads them from that file. Accessions may be separated by any whitespace."""
+    accessionList=[]
+    for a in args:
+        if a=="-":
+            accessionList.extend(sys.stdin.read().split())
+        elif os.path.isfile(a):
+            with open(a, "r") as f:
+                accessionList.extend(f.read().split())
+        else:
+            accessionList.append(a)
+    return accessionList
 
 
-def protocolOverlap(basedir, protocolSet, seriesOnly, idsByProto):
-    # This implementation should be significantly faster than the previous when input datasets get
-    # _very_ large. At the current dataset sizes used, it should probably be as fast if not slower.
-    # On the one hand, it performs a lot of operations. On the other, it eliminates a lot of string
-    # comparisons and should eventually prove to be O(n log n) bounded by sort time... kinda.
+def getByAccession(catalog, accessionList, lqf):
+    # Each accession is a single lookup in the accession index:
+    found=catalog.findAccessions(accessionList)
+    printResults(found)
+    found.save(lqf)
+
+
+def selectElements(catalog, args, lqf):
+    """Prints every element matching a filter, ie. species="Homo sapiens" and year>=2015 and has:sralist
+    If the first argument is explain, the query plan is printed first."""
+    explain=len(args)>0 and args[0]=="explain"
+    if explain:
+        args=args[1:]
     
-    # This generates a dictionary of sorted integer lists.
-    intDict=genIntegerIdsByProto(protocolSet, idsByProto)
-    matches=[]
+    try:
+        plan=catalog.planSelect(args)
+    except ValueError as e:
+        print("ERROR: %s" % e)
+        return
     
-    testSet=genProtoTestingSet(len(protocolSet))
+    if explain:
+        print("Query plan:")
+        for step in plan.describe():
+            print("  %s" % step)
+        print("")
     
-    # This should actually be pretty efficient excluding the algorithm used to generate combinations for the testing set.
-    for t in testSet:
-        commonElems=getCommonElements(intDict[protocolSet[t[0]]], intDict[protocolSet[t[1]]])
-        matchList=[t]
-        matchList.extend(commonElems)
-        matches.append(matchList)
+    found=catalog.select(plan)
+    printResults(found)
     
-    for m in matches:
-        left=protocolSet[m[0][0]]
-        right=protocolSet[m[0][1]]
-        
-        for i in m[1:]:
-            print("[%s] %d <---> [%s] %d" % (left, i, right, i))
+    print("%d element(s) found." % len(found))
+    found.save(lqf)
 
 
-def getYear(contribYearStr):
-    yearToks=[c for c in contribYearStr if c>='0' and c<='9']
-    yearStr="".join(yearToks)
+def searchText(catalog, args, lqf):
+    """Prints every element whose title or summary matches the search terms, best matches first."""
+    query=" ".join(args)
+    if len(query.strip())==0:
+        print("You must give something to search for.")
+        return
+    
+    found=catalog.search(query)
+    try:
+        # The search is run here, so that errors are reported before anything else is printed:
+        found.getKeys()
+    except (IOError, ValueError) as e:
+        print("ERROR: %s" % e)
+        return
+    
+    printResults(found)
     
-    return yearStr
+    print("%d element(s) found." % len(found))
+    found.save(lqf)
 
 
-def getContrib(contribYearStr):
-    nameToks=[c for c in contribYearStr if c>'9']
-    nameStr="".join(nameToks)
+def exportCatalog(catalog, outPath):
+    # Parquet is only written when it's asked for by name, since it needs pyarrow:
+    try:
+        with phase("exporting"):
+            if outPath.endswith(".parquet"):
+                numExported=writeParquet(catalog, outPath)
+            else:
+                numExported=writeSnapshot(catalog, outPath)
+    except IOError as e:
+        print("ERROR: %s" % e)
+        return
     
-    return nameStr
+    print("Exported %d element(s) to %s" % (numExported, outPath))
+
+
+def readQueryOperands(args):
+    """Turns a mix of query file names and ID numbers into a list of ID sets. All of the bare IDs make
+    up a single set, placed where the first of them appears, so that -lq can be mixed with query files."""
+    sets=[]
+    bare=None
+    for a in args:
+        if os.path.isfile(a):
+            sets.append(readIdFile(a))
+        elif a.isdigit():
+            if bare is None:
+                bare=[]
+                sets.append(bare)
+            bare.append(int(a))
+        else:
+            raise IOError("%s is neither a query file nor an ID number" % a)
+    return sets
 
 
-def getByYear(pathlist, yearName, lqf):
-    outList=[]
-    for p in pathlist:
-        # Only use elements for which there is a name cache file.
-        # TODO: Add support for raw matrix reading.
-        ncName=os.path.join(p, "namecache.txt")
-        if os.path.exists(ncName):
-            with open(ncName, "r") as ncFile:
-                ncContents=ncFile.read()
-                yearStr=getYear(ncContents)
-                
-                if yearStr==yearName:
-                    outList.append(p)
-    
-    for o in outList:
-        printTitle(o)
-    
-    dumpLQF(outList, lqf)
-
-
-def getByContributor(pathlist, contribName, lqf):
-    contribName=contribName.upper()
-    outList=[]
-    for p in pathlist:
-        # Only use elements for which there is a name cache file.
-        # TODO: Add support for raw matrix reading.
-        ncName=os.path.join(p, "namecache.txt")
-        if os.path.exists(ncName):
-            with open(ncName, "r") as ncFile:
-                ncContents=ncFile.read()
-                nameStr=getContrib(ncContents).upper()
-                
-                if nameStr==contribName:
-                    outList.append(p)
-    
-    for o in outList:
-        printTitle(o)
-    
-    dumpLQF(outList, lqf)
-
-
-def listYearContrib(pathlist, getFunction, getName):
-    ycDict={}
-    for p in pathlist:
-        ncName=os.path.join(p, "namecache.txt")
-        if os.path.exists(ncName):
-            with open(ncName, "r") as ncFile:
-                ncContents=ncFile.read()
-                val=getFunction(ncContents)
-                if ycDict.get(val) is None:
-                    # add to the dict
-                    ycDict.update({val: 1})
-                else:
-                    ycDict[val]+=1
-    # Count all elements:
-    ycList=ycDict.items()
-    ycList=sorted(ycList, key=lambda k: k[1], reverse=True)
-    print("%s, frequency:" % getName)
-    for y in ycList:
-        if len(y[0])>1:
-            print("%s %d" % (y[0], y[1]))
+def combineQueries(command, args, lqf):
+    """Implements qfunion, qfintersect and qfdiff. For qfdiff, the first operand is the set to remove from."""
+    try:
+        sets=readQueryOperands(args)
+    except (IOError, ValueError) as e:
+        print("ERROR: %s" % e)
+        return
+    
+    with phase("filtering"):
+        if command=="qfunion":
+            found=unionSets(sets)
+        elif command=="qfintersect":
+            found=intersectSets(sets)
+        elif len(sets)>0:
+            found=diffSets(sets[0], sets[1:])
+        else:
+            found=[]
+    
+    for idNum in found:
+        print(idNum)
+    print("%d element(s) found." % len(found))
+    dumpLQF(found, lqf)
 
 
-def getByAccession(pathList, accessionList, lqf):
-    outlist=[]
-    for a in accessionList:
-        for p in pathList:
-            accession=None
-            if os.path.exists(os.path.join(p, "accessioncache.txt")):
-                f=open(os.path.join(p, "accessioncache.txt"))
-                accession=f.read()
-                f.close()
-            else:
-                with open(os.path.join(p, "summary.txt"), "r") as summaryfile:
-                    contents=summaryfile.read()
-                    lines=contents.splitlines()
-                    
-                    for l in lines:
-                        ltoks=l.split(':')
-                        if ltoks[0]=="Accession nr":
-                            accession=ltoks[1].strip()
-                            f=open(os.path.join(p, "accessioncache.txt"), "w")
-                            f.write(accession)
-                            f.close()
-            if accession==a:
-                outlist.append(p)
-                printTitle(p)
-    dumpLQF(outlist, lqf)
-
-
-def main(args):
+# query_daemon.py passes in the catalog it keeps open as shared, so that it isn't loaded again:
+def main(args, shared=None):
     progName=args[0]
     seriesOnly=False
     lastQueryName=".lastquery"
     protocolSet=None
+    numWorkers=4
+    perHost=2
+    maxRate=None
+    minFree=None
+    snapshotPath=None
     
     # This kludge allows for switches to be specified without disrupting any other behavior.
     newArgs=[]
@@ -808,24 +655,28 @@ def main(args):
             elif aToks[0]=="-pt":
                 protocolSet=aToks[1].split(',')
             elif aToks[0]=="-lq" or aToks[0]=="--last-query":
-                if len(aToks)>1:
-                    for a in aToks[1:]:
-                        if os.path.exists(a):
-                            with open(a, "r") as lqf:
-                                contents=lqf.read()
-                                lines=contents.splitlines()
-                                newCommandArgs.extend([l.strip() for l in lines])
-                        else:
-                            print("NOTE: Could not honor %s as last query file not found!" % aToks[0])
-                elif os.path.exists(".lastquery"):
-                    with open(".lastquery", "r") as lqf:
-                        contents=lqf.read()
-                        lines=contents.splitlines()
-                        newCommandArgs=[l.strip() for l in lines]
-                else:
-                    print("NOTE: Could not honor %s as last query file not found!" % aToks[0])
+                # Query files may be in either the binary format or plain text, which may hold accessions or
+                # paper names as well as IDs and so is passed through line by line:
+                for a in (aToks[1:] if len(aToks)>1 else [".lastquery"]):
+                    if os.path.exists(a) and isIdFile(a):
+                        newCommandArgs.extend([str(i) for i in readIdFile(a)])
+                    elif os.path.exists(a):
+                        with open(a, "r") as lqf:
+                            newCommandArgs.extend([l.strip() for l in lqf.read().splitlines()])
+                    else:
+                        print("NOTE: Could not honor %s as last query file not found!" % aToks[0])
             elif aToks[0]=="-qf":
                 lastQueryName=aToks[1]
+            elif aToks[0]=="-j":
+                numWorkers=int(aToks[1])
+            elif aToks[0]=="-ph":
+                perHost=int(aToks[1])
+            elif aToks[0]=="-bw":
+                maxRate=float(aToks[1])*1048576
+            elif aToks[0]=="-mf":
+                minFree=float(aToks[1])*1073741824
+            elif aToks[0]=="--snapshot":
+                snapshotPath=aToks[1]
             else:
                 newArgs.append(a)
         args=newArgs
@@ -833,7 +684,7 @@ def main(args):
         
         
     if len(args)<3:
-        print("Usage: %s [-s,-pt,-lq] dbdir command <args>" % progName)
+        print("Usage: %s [-s,-pt,-lq,-qf,-j,-ph,-bw,-mf,--snapshot] dbdir command <args>" % progName)
         print("Query a GRO-Seq metadata database fetched with make_groseq_database.py")
         print("If -s is specified, then only series IDs will be reported on")
         print("If -pt=<comma separated list of protocols> is specified, then only IDs with a ")
@@ -842,11 +693,19 @@ def main(args):
         print("     arguments the results of the last query.")
         print("If -qf is specified, then the program will attempt to store the result of the")
         print("     current query in the file specified.")
+        print("If -j=<n> is specified, then up to n files will be fetched at once (default 4).")
+        print("If -ph=<n> is specified, then at most n connections will be made to each server (default 2).")
+        print("If -bw=<MB/s> is specified, then downloads are limited to that combined rate.")
+        print("If -mf=<GB> is specified, then no download is started with less free disk space than that.")
+        print("If --snapshot=<file> is specified, then commands that only read the database are answered from a")
+        print("     snapshot written by the export command instead.")
         print("")
         print("List of commands:")
         print("  listprotocols -- List all protocols in the current database.")
         print("  queryprotocol -- Print all elements matching a given protocol.")
         print("  protocoloverlap -- Print out the set of elements that overlap between different protocols.")
+        print("  protocoloverlap matrix -- Print the number of elements shared by every pair of protocols.")
+        print("  protocoloverlap intersect|union|diff <protocols> -- Combine the elements of several protocols.")
         print("  listspecies -- Print a listing of all species defined in the database.")
         print("  findspecies <species name in quotes> -- Find all projects that match a given species.")
         print("  getsummary <list of id numbers or paper names> -- Retrieves a summary for a given data element.")
@@ -861,116 +720,158 @@ def main(args):
         print("  listyears -- List all years appearing in data matrices.")
         print("  listcontribs -- List all contributors appearing in data matrices.")
         print("       by the first contributor.")
-        print("  getaccession -- Gets the ID numbers of elements given a set of accession numbers")
-        #print("  qfunion <list of query files and/or ID numbers> -- Generates the union of the given set of IDs.")
+        print("  getbyaccession <accessions, files of accessions or - for stdin> -- Gets the ID numbers of elements")
+        print("       given a set of accession numbers")
+        print("  select [explain] <filter> -- Finds elements matching a filter, ie. 'species=\"Homo sapiens\" and year>=2015'")
+        print("       Fields: protocol id type species accession title summary contributor year, flags: has:matrices")
+        print("       has:sralist has:data has:matrixurl has:contrib. Filters combine with and, or, not and parentheses.")
+        print("  search <words or \"phrases\"> -- Finds elements whose title or summary mentions every term, best matches first.")
+        print("  qfunion <list of query files and/or ID numbers> -- Generates the union of the given set of IDs.")
+        print("  qfintersect <list of query files and/or ID numbers> -- Generates the IDs common to every given set.")
+        print("  qfdiff <query file> <list of query files and/or ID numbers> -- Removes the later sets from the first.")
         print("  download <id or paper name> <outputdir> -- Downloads data into the specified directory")
+        print("  downloadall <outputdir> <list of id numbers> -- Downloads data for every element, ie. with -lq,")
+        print("       into a subdirectory of outputdir per element.")
         print("  listsras <list of id numbers> -- Lists all SRR ids in a given project if getsralist has been run.")
+        print("  reindex -- Rebuilds the lookup indexes kept alongside the database.")
+        print("  export <file> -- Writes the metadata of every element to a columnar snapshot file, or to a Parquet")
+        print("       file if its name ends in .parquet and pyarrow is installed.")
+        print("")
+        print("If --profile is specified, a breakdown of where the time went is written to stderr when the command")
+        print("     finishes. --profile=<file> also writes a cProfile dump, and --trace=<file> a Chrome trace.")
+        return
+    
+    # Snapshots can't be changed, so only commands that read the database can use one:
+    if snapshotPath is not None and args[2] not in DAEMON_COMMANDS:
+        print("ERROR: %s can't be run from a snapshot." % args[2])
         return
     
-    if protocolSet is None:
-        protocolSet=os.listdir(args[1])
+    # Nothing is loaded from the database until a command asks for it. Metadata is read from a 
+    # single-file store if one was created in the database directory.
+    try:
+        catalog=GeoCatalog(args[1], protocolSet, seriesOnly, shared, snapshotPath)
+    except (IOError, ValueError) as e:
+        print("ERROR: Could not open snapshot %s: %s" % (snapshotPath, e))
+        return
+    store=catalog.store
+    protocolSet=catalog.getProtocols()
     
-    pathlist=[]
-    # Store a set of IDs by requested protocol to make certain operations faster and easier.
-    idsByProto={'%s' % p: [] for p in protocolSet}
+    # The new results replace the last query only once the command is done, so that the old results
+    # can still be read by the command itself, ie. qfintersect .lastquery other.qf
+    # Each run writes to a file of its own, since several may be running in the same directory at once:
+    fd, partName=tempfile.mkstemp(prefix=os.path.basename(lastQueryName)+".", suffix=".part", dir=os.path.dirname(lastQueryName) or ".")
+    # mkstemp makes files only their owner can read, unlike open():
+    os.fchmod(fd, 0666&~UMASK)
+    lastQueryFile=os.fdopen(fd, "wb")
     
-    for p in protocolSet:
-        modifiedList=[]
-        tmpList=os.listdir(os.path.join(args[1], p))
-        newTmpList=[]
-        
-        # Filter out non-series IDs if necessary:
-        # (This is a bit of a kludge that will ultimately save a lot of hassle and time)
-        if seriesOnly:
-            for t in tmpList:
-                tPath=os.path.join(args[1], p, t)
-                if isSeries(tPath):
-                    pathlist.append(tPath)
-                    idsByProto[p].append(t)
+    try:
+        if args[2]=="listspecies":
+            genSpeciesList(catalog)
         
-        else:
-            idsByProto[p].extend(tmpList)
-            for t in tmpList:
-                modifiedList.append(os.path.join(args[1], p, t))
+        elif args[2]=="listprotocols":
+            listProtocols(protocolSet)
+        
+        elif args[2]=="queryprotocol":
+            queryProtocol(catalog, args[3], lastQueryFile)
+        
+        elif args[2]=="protocoloverlap":
+            protocolOverlap(catalog, args[3:], lastQueryFile)
+        
+        elif args[2]=="findspecies":
+            try:
+                findSpecies(catalog, args[3], lastQueryFile)
+            except:
+                print("You must specify a species name.")
+                
+        elif args[2]=="getsummary":
+            try:
+                with phase("rendering"):
+                    getSummary(catalog, args[3:])
+            except:
+                print("You must specify an element ID or paper name to get a summary.")
             
-            pathlist.extend(modifiedList)
-    
-    lastQueryFile=open(lastQueryName, "w")
-    
-    if args[2]=="listspecies":
-        genSpeciesList(pathlist, seriesOnly)
-    
-    elif args[2]=="listprotocols":
-        listProtocols(protocolSet)
-    
-    elif args[2]=="queryprotocol":
-        queryProtocol(args[1], args[3], idsByProto, seriesOnly, lastQueryFile)
-    
-    elif args[2]=="protocoloverlap":
-        protocolOverlap(args[1], protocolSet, seriesOnly, idsByProto)
-    
-    elif args[2]=="findspecies":
-        try:
-            findSpecies(pathlist, args[3], seriesOnly, protocolSet, lastQueryFile)
-        except:
-            print("You must specify a species name.")
+        elif args[2]=="fetchmatrices":
+            try:
+                fetchMatrices(store, args[1], args[3:], protocolSet, numWorkers, perHost)
+            except:
+                print("You must specify an element ID to fetch its data matrices.")
+        
+        elif args[2]=="fetchspmats":
+            try:
+                fetchspmats(catalog, args[3], numWorkers, perHost)
+            except:
+                print("You must specify a species name to fetch matrices for that species.")
+                
+        elif args[2]=="fetchallmatrices":
+            # Elements without a matrix link are skipped quietly, since most samples don't have one:
+            curlist=[i for p, i in catalog.getKeys()]
+            fetchMatrices(store, args[1], curlist, protocolSet, numWorkers, perHost, True)
             
-    elif args[2]=="getsummary":
-        try:
-            getSummary(args[1], args[3:], pathlist, protocolSet)
-        except:
-            print("You must specify an element ID or paper name to get a summary.")
+        elif args[2]=="getsralist":
+            getSraList(catalog, args[3:])
+            
+        elif args[2]=="getreadytosra":
+            getReadyToSra(catalog, lastQueryFile)
         
-    elif args[2]=="fetchmatrices":
-        try:
-            fetchMatrices(args[1], args[3:], protocolSet)
-        except:
-            print("You must specify an element ID to fetch its data matrices.")
-    
-    elif args[2]=="fetchspmats":
-        try:
-            fetchspmats(args[1], pathlist, args[3], seriesOnly)
-        except:
-            print("You must specify a species name to fetch matrices for that species.")
+        elif args[2]=="getreadytodownload":
+            getReadyToDownload(catalog, lastQueryFile)
             
-    elif args[2]=="fetchallmatrices":
-        fetchMatrices(args[1], curlist)
+        elif args[2]=="download":
+            download(store, args[1], args[3], args[4], protocolSet, numWorkers, perHost, maxRate, minFree)
         
-    elif args[2]=="getsralist":
-        getSraList(args[1], args[3:], pathlist, protocolSet)
+        elif args[2]=="downloadall":
+            downloadAll(store, args[1], args[4:], args[3], protocolSet, numWorkers, perHost, maxRate, minFree)
         
-    elif args[2]=="getreadytosra":
-        getReadyToSra(pathlist, lastQueryFile)
-    
-    elif args[2]=="getreadytodownload":
-        getReadyToDownload(pathlist, lastQueryFile)
+        elif args[2]=="getbyyear":
+            getByYear(catalog, args[3], lastQueryFile)
         
-    elif args[2]=="download":
-        download(args[1], args[3], protocolSet)
-    
-    elif args[2]=="getbyyear":
-        getByYear(pathlist, args[3], lastQueryFile)
-    
-    elif args[2]=="getbycontributor":
-        getByContributor(pathlist, args[3], lastQueryFile)
-    
-    elif args[2]=="listyears":
-        listYearContrib(pathlist, getYear, "Publication Year")
-    
-    elif args[2]=="listcontribs":
-        listYearContrib(pathlist, getContrib, "First Contributor")
-    
-    elif args[2]=="getbyaccession":
-        getByAccession(pathlist, args[3:], lastQueryFile)
-    
-    elif args[2]=="listsras":
-        listSRAs(pathlist)
+        elif args[2]=="getbycontributor":
+            getByContributor(catalog, args[3], lastQueryFile)
+        
+        elif args[2]=="listyears":
+            listYearContrib(catalog.countYears(), "Publication Year")
         
-    else:
-        print("Unknown command: %s" % args[2])
+        elif args[2]=="listcontribs":
+            listYearContrib(catalog.countContributors(), "First Contributor")
+        
+        elif args[2]=="getbyaccession":
+            getByAccession(catalog, readAccessions(args[3:]), lastQueryFile)
+        
+        elif args[2]=="select":
+            selectElements(catalog, args[3:], lastQueryFile)
+        
+        elif args[2]=="search":
+            searchText(catalog, args[3:], lastQueryFile)
+        
+        elif args[2] in ["qfunion", "qfintersect", "qfdiff"]:
+            combineQueries(args[2], args[3:], lastQueryFile)
+        
+        elif args[2]=="listsras":
+            listSRAs(catalog)
+        
+        elif args[2]=="export":
+            if len(args)<4:
+                print("You must specify a file to export the catalog to.")
+            else:
+                exportCatalog(catalog, args[3])
+        
+        elif args[2]=="reindex":
+            with phase("indexing"):
+                rebuildIndexes(store, protocolSet)
+            
+        else:
+            print("Unknown command: %s" % args[2])
+    
+    except:
+        # Leave the last query as it was:
+        lastQueryFile.close()
+        os.remove(partName)
+        raise
     
     lastQueryFile.close()
+    os.rename(partName, lastQueryName)
+    catalog.close()
 
 
 if __name__=="__main__":
-    main(sys.argv)
\ No newline at end of file
+    instrument.run(main, sys.argv)
\ No newline at end of file